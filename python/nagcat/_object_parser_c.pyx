@@ -114,24 +114,129 @@ cdef str _unescape(char *orig):
 class ParseError(errors.InitError):
     """Error while parsing a nagios object file"""
 
+# How much of the file ObjectIterator reads at a time
+CHUNK_SIZE = 262144
+
+cdef object _parse_object(char **pos, object fields):
+    """Parse the object at pos and advance pos past it.
+
+    Returns (type, attributes) or None if the input is used up.
+    """
+    cdef char *tok, *delim, *tmp
+    cdef str objtype
+    cdef dict objdata = {}
+
+    _ignore(pos)
+
+    tok = strsep(pos, " \t")
+    if not tok or not strlen(tok):
+        return None
+
+    if strcmp(tok, "define") == 0:
+        tok = strsep(pos, " \t")
+        if not tok:
+            raise ParseError("Unexpected end of input.")
+        objtype = tok
+        delim = " \t"
+    else:
+        # If tok ends with status strip it off
+        tmp = _strend(tok, "status")
+        if tmp:
+            tmp[0] = '\0'
+        objtype = tok
+        delim = "="
+
+    tok = strsep(pos, " \t\n")
+    if not tok:
+        raise ParseError("Unexpected end of input.")
+    if strcmp(tok, "{") != 0:
+        raise ParseError("Unexpected token: %s" % tok)
+
+    while True:
+        _ignore(pos)
+        if not pos[0]:
+            raise ParseError("Unexpected end of input.")
+
+        if pos[0][0] == '}':
+            pos[0] += 1
+            break
+
+        tok = strsep(pos, delim)
+        if not tok:
+            raise ParseError("Unexpected end of input.")
+
+        name = tok
+        tok = strsep(pos, "\n")
+        if not tok:
+            raise ParseError("Unexpected end of input.")
+
+        # successfully got data!
+        if fields is not None and name not in fields:
+            continue
+        elif strchr(tok, '\\'):
+            objdata[name] = _unescape(tok)
+        else:
+            objdata[name] = tok
+
+    return objtype, objdata
+
+cdef Py_ssize_t _complete(str data):
+    """Find the end of the last object closed in data.
+
+    That is just past the newline following the last line that only
+    holds a }, or 0 if there is no such line.
+    """
+    cdef Py_ssize_t close, start, end
+
+    close = data.rfind("}")
+    while close >= 0:
+        start = data.rfind("\n", 0, close) + 1
+        end = data.find("\n", close)
+        if (end >= 0 and not data[start:close].strip()
+                and not data[close+1:end].strip()):
+            return end + 1
+        close = data.rfind("}", 0, start)
+    return 0
+
+def _selected(dict obj, dict object_select):
+    for key, value in object_select.iteritems():
+        if key in obj:
+            if isinstance(value, basestring):
+                if obj[key] != value:
+                    return False
+            elif obj[key] not in value:
+                return False
+    return True
+
 cdef class ObjectParser:
     """Parse a given config file for the requested objects.
 
     Note that this expects files generated *by* Nagios
     such objects.cache or status.dat
+
+    If object_fields is given only those attributes, plus any used
+    by object_select, are kept and the rest are never unescaped.
     """
 
     # Cython >= 0.12 uses the 3.x style bytes type for its
     # raw byte string instead of the 2.x style str type.
-    cdef dict _objects, _object_select
+    cdef dict _objects, _object_select, _indexes
+    cdef object _object_fields
     cdef bytes  _buffer
     cdef char *_pos
 
-    def __init__(self, object_file, object_types=(), object_select=()):
+    def __init__(self, object_file, object_types=(), object_select=(),
+                 object_fields=()):
         self._objects = {}
+        self._indexes = {}
         for obj in object_types:
             self._objects[obj] = []
         self._object_select = dict(object_select)
+        if object_fields:
+            self._object_fields = frozenset(object_fields).union(
+                    self._object_select)
+        else:
+            self._object_fields = None
 
         try:
             if isinstance(object_file, basestring):
@@ -151,89 +256,162 @@ cdef class ObjectParser:
         # filter data after the fact, dunno if filtering during is
         # faster or slower yet, in python it seemed slower.
         if object_types or object_select:
-            for objtype in self._objects:
+            for objtype in self._objects.keys():
                 if object_types and objtype not in object_types:
                     del self._objects[objtype]
                 else:
-                    self._objects[objtype] = filter(
-                            self._select_filter,
-                            self._objects[objtype])
-
-    def _select_filter(self, obj):
-        for key, value in self._object_select.iteritems():
-            if key in obj and obj[key] != value:
-                return False
-        return True
+                    self._objects[objtype] = [obj
+                            for obj in self._objects[objtype]
+                            if _selected(obj, self._object_select)]
 
     cdef int _parse(self) except -1:
+        cdef object obj
+        cdef str objtype
         while self._pos:
-            self._parse_object()
+            obj = _parse_object(&self._pos, self._object_fields)
+            if obj is None:
+                continue
 
-    cdef int _parse_object(self) except -1:
-        cdef char *tok, *delim, *tmp
-        cdef str objtype, attr
-        cdef dict objdata = {}
-
-        _ignore(&self._pos)
+            objtype, objdata = obj
+            if objtype in self._objects:
+                self._objects[objtype].append(objdata)
+            else:
+                self._objects[objtype] = [objdata]
 
-        tok = strsep(&self._pos, " \t")
-        if not tok or not strlen(tok):
-            return 0
+    def __getitem__(self, key):
+        return self._objects[key]
 
-        if strcmp(tok, "define") == 0:
-            tok = strsep(&self._pos, " \t")
-            if not tok:
-                raise ParseError("Unexpected end of input.")
-            objtype = tok
-            delim = " \t"
-        else:
-            # If tok ends with status strip it off
-            tmp = _strend(tok, "status")
-            if tmp:
-                tmp[0] = '\0'
-            objtype = tok
-            delim = "="
-
-        tok = strsep(&self._pos, " \t\n")
-        if not tok:
-            raise ParseError("Unexpected end of input.")
-        if strcmp(tok, "{") != 0:
-            raise ParseError("Unexpected token: %s" % tok)
+    def __contains__(self, key):
+        return key in self._objects
 
-        while True:
-            _ignore(&self._pos)
+    def types(self):
+        return self._objects.keys()
 
-            if self._pos[0] == '}':
-                self._pos += 1
-                break
+    def index(self, obj_type, *keys):
+        """Get a dict of objects of the given type keyed by attributes.
+
+        With one key the dict's keys are that attribute's values, with
+        more they are tuples of values. Objects missing any of the
+        attributes are left out and if several objects have the same
+        values the first one wins. Each index is only built once.
+        """
+
+        name = (obj_type,) + keys
+        index = self._indexes.get(name, None)
+        if index is None:
+            index = {}
+            for obj in self._objects.get(obj_type, ()):
+                try:
+                    if len(keys) == 1:
+                        value = obj[keys[0]]
+                    else:
+                        value = tuple([obj[key] for key in keys])
+                except KeyError:
+                    continue
+                index.setdefault(value, obj)
+            self._indexes[name] = index
+        return index
+
+
+def iter_objects(object_file, object_types=(), object_select=(),
+                 object_fields=()):
+    """Yield (type, attributes) for each requested object in a file.
+
+    Takes the same arguments as ObjectParser but only one object is
+    held in memory at a time, the file is read in chunks.
+    """
+    return ObjectIterator(object_file, object_types,
+                          object_select, object_fields)
 
-            tok = strsep(&self._pos, delim)
-            if not tok:
-                raise ParseError("Unexpected end of input.")
+cdef class ObjectIterator:
+    """Iterator behind iter_objects()
 
-            name = tok
-            tok = strsep(&self._pos, "\n")
-            if not tok:
-                raise ParseError("Unexpected end of input.")
+    The file is read CHUNK_SIZE bytes at a time and each chunk is cut
+    after the last complete object in it, the rest is carried over to
+    the next chunk. Objects are only parsed as they are asked for.
+    """
 
-            # successfully got data!
-            if strchr(tok, '\\'):
-                objdata[name] = _unescape(tok)
-            else:
-                objdata[name] = tok
+    cdef object _file, _fd, _object_types, _object_fields
+    cdef dict _object_select
+    cdef str _rest
+    cdef bytes _buffer
+    cdef char *_pos
 
-        if objtype in self._objects:
-            self._objects[objtype].append(objdata)
+    def __init__(self, object_file, object_types=(), object_select=(),
+                 object_fields=()):
+        self._object_types = frozenset(object_types)
+        self._object_select = dict(object_select)
+        if object_fields:
+            self._object_fields = frozenset(object_fields).union(
+                    self._object_select)
         else:
-            self._objects[objtype] = [objdata]
-
-        return 0
+            self._object_fields = None
+        self._rest = ""
+
+        if isinstance(object_file, basestring):
+            try:
+                self._fd = self._file = open(object_file)
+            except IOError, ex:
+                raise ParseError(
+                        "Failed to read Nagios object file: %s" % ex)
+        else:
+            self._file = object_file
 
-    def __getitem__(self, key):
-        return self._objects[key]
+    def __iter__(self):
+        return self
 
-    def __contains__(self, key):
-        return key in self._objects
+    def __next__(self):
+        cdef object obj
+        while True:
+            if not self._pos and not self._fill():
+                raise StopIteration
+
+            obj = _parse_object(&self._pos, self._object_fields)
+            if obj is None:
+                continue
+            if self._object_types and obj[0] not in self._object_types:
+                continue
+            if self._object_select and not _selected(
+                    obj[1], self._object_select):
+                continue
+            return obj
+
+    cdef bint _fill(self) except -1:
+        """Load the next chunk of complete objects"""
+        cdef str data
+        cdef Py_ssize_t end
 
-    def types(self):
-        return self._objects.keys()
+        self._pos = NULL
+        self._buffer = None
+        while self._file is not None:
+            try:
+                data = self._file.read(CHUNK_SIZE)
+            except IOError, ex:
+                self._close()
+                raise ParseError(
+                        "Failed to read Nagios object file: %s" % ex)
+
+            if data:
+                data = self._rest + data
+                end = _complete(data)
+                self._rest = data[end:]
+                data = data[:end]
+            else:
+                data = self._rest
+                self._rest = ""
+                self._close()
+
+            if data.strip():
+                # Parsing writes to the buffer, data is always our
+                # own string from read() or a slice of one.
+                self._buffer = <bytes>data
+                self._pos = self._buffer
+                return True
+
+        return False
+
+    cdef _close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+        self._file = None
@@ -0,0 +1,256 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Chunked Python parser for nagios object files
+
+Produces the same results as _object_parser_py but instead of looking
+at one line at a time it reads large chunks and splits them with str
+methods, relying on the exact layout Nagios writes: a header line, one
+tab indented attribute per line, and a tab indented } closing it.
+Anything else is handed to _object_parser_py's line parser.
+"""
+
+from itertools import imap, izip, repeat
+from operator import contains, itemgetter
+
+from nagcat import errors, _object_parser_py
+from nagcat._object_parser_py import UNESCAPE, _unescape
+
+# How much of the file is read at a time
+CHUNK_SIZE = 4194304
+
+# How Nagios ends each object and starts each attribute line
+CLOSE = "\n\t}\n"
+ATTR = "\n\t"
+
+def iter_objects(object_file, object_types=(), object_select=(),
+                 object_fields=()):
+    """Yield (type, attributes) for each requested object in a file.
+
+    Takes the same arguments as ObjectParser, the file is read in
+    CHUNK_SIZE pieces so only one chunk is held in memory at a time.
+    """
+
+    object_select = dict(object_select)
+    if object_fields:
+        object_fields = frozenset(object_fields).union(object_select)
+    else:
+        object_fields = None
+
+    args = (object_types, object_select, object_fields)
+    fd = None
+    try:
+        if isinstance(object_file, basestring):
+            fd = open(object_file)
+            objects = _parse(fd.read, *args)
+        elif hasattr(object_file, 'read'):
+            objects = _parse(object_file.read, *args)
+        else:
+            # Some other iterable of lines
+            objects = _object_parser_py._parse(object_file, *args)
+
+        for obj in objects:
+            yield obj
+    except IOError, ex:
+        raise errors.InitError(
+                "Failed to read Nagios object cache: %s" % ex)
+    finally:
+        if fd is not None:
+            fd.close()
+
+def _parse(read, *args):
+    rest = ""
+    chunk = read(CHUNK_SIZE)
+    while chunk:
+        chunk = rest + chunk
+        end = chunk.rfind(CLOSE)
+        if end < 0:
+            rest = chunk
+        else:
+            rest = chunk[end+len(CLOSE):]
+            chunk = chunk[:end]
+            # Whitespace around attributes is rare enough that it is
+            # cheaper to look for it in the whole chunk than per object.
+            clean = _clean(chunk)
+            for record in chunk.split(CLOSE):
+                for obj in _parse_record(record, clean, *args):
+                    yield obj
+        chunk = read(CHUNK_SIZE)
+
+    # Whatever isn't followed by a CLOSE, normally just blank lines
+    if rest.strip():
+        for obj in _object_parser_py._parse(rest.split("\n"), *args):
+            yield obj
+
+def _parse_record(record, clean, object_types, object_select,
+                  object_fields):
+    """Parse one object, the text between two CLOSEs"""
+
+    lines = record.split(ATTR)
+    header = lines.pop(0)
+    start = header.rfind("\n") + 1
+    object_type = header[start:].strip()
+
+    if object_type.startswith("define") and object_type.endswith('{'):
+        object_type = object_type[7:-2]
+        define = True
+    elif object_type.endswith('status {'):
+        object_type = object_type[:-8]
+        define = False
+    elif object_type.endswith(' {'):
+        object_type = object_type[:-2]
+        define = False
+    else:
+        object_type = None
+
+    # Fall back to the line parser if anything is out of the ordinary:
+    # no header, other braces before it, lines not indented by a tab,
+    # or in status blocks whitespace to strip from the ends of lines.
+    if (not object_type or '{' in header[:start]
+            or record.count("\n", start) != len(lines)
+            or not (define or clean or _clean(record))):
+        for obj in _object_parser_py._parse(
+                (record + CLOSE).split("\n"), object_types,
+                object_select, object_fields):
+            yield obj
+        return
+
+    if object_types and object_type not in object_types:
+        return
+
+    if define:
+        object_data = _define_attrs(record, len(header), lines)
+    else:
+        object_data = _status_attrs(record, len(header), lines)
+
+    if object_select and not _selected(object_data, object_select):
+        return
+
+    if object_fields is not None:
+        object_data = dict((key, object_data[key])
+                           for key in object_fields
+                           if key in object_data)
+
+    if '\\' in record:
+        _unescape_record(record, len(header), define, object_data)
+
+    yield object_type, object_data
+
+def _clean(text):
+    """Check that no line has whitespace that needs to be stripped"""
+    return not ("\n\t\t" in text or "\n\t " in text
+                or " \n" in text or "\t\n" in text or "\r" in text
+                or text[-1:] in (" ", "\t"))
+
+_key_value = itemgetter(0, 2)
+
+def _pair(split):
+    if len(split) == 2:
+        return split
+    else:
+        return split[0], ""
+
+def _status_attrs(record, start, lines):
+    """Get the attributes of a status block, name=value per line"""
+
+    # With exactly one = per line keys and values simply alternate
+    if (record.count('=', start) == len(lines)
+            and all(imap(contains, lines, repeat('=')))):
+        pairs = iter('='.join(lines).split('='))
+        return dict(izip(pairs, pairs))
+    else:
+        return dict(imap(_key_value,
+                         imap(str.partition, lines, repeat('='))))
+
+def _define_attrs(record, start, lines):
+    """Get the attributes of a define block, name<tab>value per line"""
+
+    # With exactly one tab per line, besides the one indenting it, and
+    # no spaces around or in names keys and values simply alternate.
+    if (record.count('\t', start) == 2 * len(lines)
+            and "\n\t\t" not in record and "\t " not in record
+            and " \n" not in record and "\r" not in record
+            and record[-1:] != " "
+            and all(imap(contains, lines, repeat('\t')))):
+        pairs = iter('\t'.join(lines).split('\t'))
+        object_data = dict(izip(pairs, pairs))
+        if ' ' not in ''.join(object_data):
+            return object_data
+
+    # Same as the line parser, a name alone means an empty value
+    return dict(imap(_pair, imap(str.split, imap(str.strip, lines),
+                                 repeat(None), repeat(1))))
+
+def _unescape_record(record, start, define, object_data):
+    """Unescape the values of the lines that have a backslash"""
+
+    done = set()
+    pos = record.find('\\', start)
+    while pos >= 0:
+        line = record.rfind(ATTR, 0, pos) + len(ATTR)
+        end = record.find(ATTR, pos)
+        if end < 0:
+            end = len(record)
+
+        if define:
+            key = record[line:end].split(None, 1)[0]
+        else:
+            key = record[line:end].partition('=')[0]
+        if key in object_data and key not in done:
+            done.add(key)
+            value = object_data[key]
+            if '\\\\' in value:
+                value = UNESCAPE.sub(_unescape, value)
+            else:
+                # Every backslash starts an escape, skip the regex
+                value = value.replace('\\n', '\n').replace('\\_', '|')
+            object_data[key] = value
+
+        pos = record.find('\\', end)
+
+def _selected(object_data, object_select):
+    for key, selector in object_select.iteritems():
+        if key not in object_data:
+            continue
+        if isinstance(selector, basestring):
+            if object_data[key] != selector:
+                return False
+        elif object_data[key] not in selector:
+            return False
+    return True
+
+class ObjectParser(_object_parser_py.ObjectParser):
+    """Parse a given config file for the requested objects.
+
+    Note that this expects files generated *by* Nagios
+    such objects.cache or status.dat
+
+    If object_fields is given only those attributes, plus any used
+    by object_select, are kept and the rest are never unescaped.
+    """
+
+    def __init__(self, object_file, object_types=(), object_select=(),
+                 object_fields=()):
+        self._objects = {}
+        self._indexes = {}
+
+        for type_ in object_types:
+            self._objects[type_] = []
+
+        for type_, data in iter_objects(object_file, object_types,
+                                        object_select, object_fields):
+            if type_ not in self._objects:
+                self._objects[type_] = [data]
+            else:
+                self._objects[type_].append(data)
@@ -18,103 +18,132 @@ import re
 
 from nagcat import errors
 
+UNESCAPE = re.compile(r'(\\\\|\\n|\\_)')
+
+def _unescape(match):
+    esc = match.group(1)
+    if esc == r'\\':
+        return '\\'
+    elif esc == r'\n':
+        return '\n'
+    elif esc == r'\_':
+        return '|'
+    else:
+        assert 0
+
+def iter_objects(object_file, object_types=(), object_select=(),
+                 object_fields=()):
+    """Yield (type, attributes) for each requested object in a file.
+
+    Takes the same arguments as ObjectParser but only one object is
+    held in memory at a time, the file is read line by line.
+    """
+
+    object_select = dict(object_select)
+    if object_fields:
+        object_fields = frozenset(object_fields).union(object_select)
+    else:
+        object_fields = None
+
+    fd = None
+    try:
+        if isinstance(object_file, basestring):
+            fd = lines = open(object_file)
+        else:
+            lines = object_file
+
+        for obj in _parse(lines, object_types, object_select,
+                          object_fields):
+            yield obj
+    except IOError, ex:
+        raise errors.InitError(
+                "Failed to read Nagios object cache: %s" % ex)
+    finally:
+        if fd is not None:
+            fd.close()
+
+def _parse(object_file, object_types, object_select, object_fields):
+    splitter = None
+    object_data = None
+    object_type = None
+    for line in object_file:
+        line = line.strip()
+        if object_data is None:
+            if line.startswith("define") and line.endswith('{'):
+                type_ = line[7:-2]
+                splitter = None
+            elif line.endswith('status {'):
+                splitter = '='
+                type_ = line[:-8]
+            elif line.endswith(' {'):
+                splitter = '='
+                type_ = line[:-2]
+            else:
+                continue
+
+            assert type_
+            if object_types and type_ not in object_types:
+                continue
+            object_data = {}
+            object_type = type_
+        elif line == '}':
+            yield object_type, object_data
+            object_data = None
+            object_type = None
+        else:
+            split = line.split(splitter, 1)
+            try:
+                key, value = split
+            except ValueError:
+                key = split[0]
+                value = ""
+
+            if object_select and key in object_select:
+                selector = object_select[key]
+                if isinstance(selector, basestring):
+                    if value != selector:
+                        object_data = None
+                        object_type = None
+                        continue
+                else:
+                    if value not in selector:
+                        object_data = None
+                        object_type = None
+                        continue
+
+            if object_fields is not None and key not in object_fields:
+                continue
+
+            if '\\' in value:
+                value = UNESCAPE.sub(_unescape, value)
+            object_data[key] = value
+
 class ObjectParser(object):
     """Parse a given config file for the requested objects.
 
     Note that this expects files generated *by* Nagios
     such objects.cache or status.dat
+
+    If object_fields is given only those attributes, plus any used
+    by object_select, are kept and the rest are never unescaped.
     """
 
-    UNESCAPE = re.compile(r'(\\\\|\\n|\\_)')
+    UNESCAPE = UNESCAPE
 
-    def __init__(self, object_file, object_types=(), object_select=()):
+    def __init__(self, object_file, object_types=(), object_select=(),
+                 object_fields=()):
         self._objects = {}
-
-        object_select = dict(object_select)
-
-        try:
-            if isinstance(object_file, basestring):
-                fd = open(object_file)
-                try:
-                    self._parse(fd, object_types, object_select)
-                finally:
-                    fd.close()
-            else:
-                self._parse(object_file, object_types, object_select)
-        except IOError, ex:
-            raise errors.InitError(
-                    "Failed to read Nagios object cache: %s" % ex)
-
-    def _parse(self, object_file, object_types, object_select):
-
-        def unescape(match):
-            esc = match.group(1)
-            if esc == r'\\':
-                return '\\'
-            elif esc == r'\n':
-                return '\n'
-            elif esc == r'\_':
-                return '|'
-            else:
-                assert 0
+        self._indexes = {}
 
         for type_ in object_types:
             self._objects[type_] = []
 
-        splitter = None
-        object_data = None
-        object_type = None
-        for line in object_file:
-            line = line.strip()
-            if object_data is None:
-                if line.startswith("define") and line.endswith('{'):
-                    type_ = line[7:-2]
-                    splitter = None
-                elif line.endswith('status {'):
-                    splitter = '='
-                    type_ = line[:-8]
-                elif line.endswith(' {'):
-                    splitter = '='
-                    type_ = line[:-2]
-                else:
-                    continue
-
-                assert type_
-                if object_types and type_ not in object_types:
-                    continue
-                object_data = {}
-                object_type = type_
-            elif line == '}':
-                if object_type not in self._objects:
-                    self._objects[object_type] = [object_data]
-                else:
-                    self._objects[object_type].append(object_data)
-                object_data = None
-                object_type = None
+        for type_, data in iter_objects(object_file, object_types,
+                                        object_select, object_fields):
+            if type_ not in self._objects:
+                self._objects[type_] = [data]
             else:
-                split = line.split(splitter, 1)
-                try:
-                    key, value = split
-                except ValueError:
-                    key = split[0]
-                    value = ""
-
-                if object_select and key in object_select:
-                    selector = object_select[key]
-                    if isinstance(selector, basestring):
-                        if value != selector:
-                            object_data = None
-                            object_type = None
-                            continue
-                    else:
-                        if value not in selector:
-                            object_data = None
-                            object_type = None
-                            continue
-
-                if '\\' in value:
-                    value = self.UNESCAPE.sub(unescape, value)
-                object_data[key] = value
+                self._objects[type_].append(data)
 
     def __getitem__(self, key):
         return self._objects[key]
@@ -124,3 +153,28 @@ class ObjectParser(object):
 
     def types(self):
         return self._objects.keys()
+
+    def index(self, obj_type, *keys):
+        """Get a dict of objects of the given type keyed by attributes.
+
+        With one key the dict's keys are that attribute's values, with
+        more they are tuples of values. Objects missing any of the
+        attributes are left out and if several objects have the same
+        values the first one wins. Each index is only built once.
+        """
+
+        name = (obj_type,) + keys
+        index = self._indexes.get(name, None)
+        if index is None:
+            index = {}
+            for obj in self._objects.get(obj_type, ()):
+                try:
+                    if len(keys) == 1:
+                        value = obj[keys[0]]
+                    else:
+                        value = tuple([obj[key] for key in keys])
+                except KeyError:
+                    continue
+                index.setdefault(value, obj)
+            self._indexes[name] = index
+        return index
@@ -0,0 +1,163 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Limit the number of queries running at once.
+
+When many groups are scheduled for the same second every query they
+depend on starts at the same time which can easily open more sockets
+and processes than the system allows. The AdmissionControl object
+caps the number of queries that may be in flight globally, per query
+type and per host. Queries over the limit wait in a queue that is
+served round-robin by host so that one busy host can't starve the
+others.
+"""
+
+import time
+from collections import defaultdict, deque
+
+from twisted.internet import defer
+
+from nagcat import log
+
+class AdmissionControl(object):
+    """Global, per-type, and per-host limits on running queries.
+
+    A limit of 0 (or None) means unlimited.
+    """
+
+    def __init__(self, max_total=0, max_host=0, max_type=None):
+        self.max_total = max_total or 0
+        self.max_host = max_host or 0
+        self.max_type = dict(max_type or {})
+
+        self._running = 0
+        self._running_host = defaultdict(int)
+        self._running_type = defaultdict(int)
+
+        # Waiting queries, one queue per host and the order to visit them
+        self._queues = {}
+        self._order = deque()
+        self._waiting = 0
+
+        self._admitted = 0
+        self._delayed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _allowed(self, query):
+        if self.max_total and self._running >= self.max_total:
+            return False
+        if (self.max_host and query.host is not None and
+                self._running_host[query.host] >= self.max_host):
+            return False
+        limit = self.max_type.get(query.name, 0)
+        if limit and self._running_type[query.name] >= limit:
+            return False
+        return True
+
+    def _admit(self, query):
+        self._running += 1
+        self._running_host[query.host] += 1
+        self._running_type[query.name] += 1
+        self._admitted += 1
+
+    def acquire(self, query):
+        """Request permission to run query.
+
+        Returns a Deferred that fires once the query may start,
+        release() must be called when the query finishes.
+        """
+
+        # Don't jump ahead of queries already waiting on this host
+        if query.host not in self._queues and self._allowed(query):
+            self._admit(query)
+            return defer.succeed(None)
+
+        log.debug("Delaying start of %s", query)
+        deferred = defer.Deferred()
+        if query.host not in self._queues:
+            self._queues[query.host] = deque()
+            self._order.append(query.host)
+        self._queues[query.host].append((query, deferred, time.time()))
+        self._waiting += 1
+        self._delayed += 1
+        return deferred
+
+    def release(self, query):
+        """Record that a query admitted by acquire() has finished"""
+
+        assert self._running > 0
+        self._running -= 1
+        self._running_host[query.host] -= 1
+        if not self._running_host[query.host]:
+            del self._running_host[query.host]
+        self._running_type[query.name] -= 1
+        if not self._running_type[query.name]:
+            del self._running_type[query.name]
+
+        self._dispatch()
+
+    def _dispatch(self):
+        """Start as many waiting queries as the limits allow"""
+
+        # Hosts take turns, each turn starts at most one query.
+        # Stop once a full round fails to start anything.
+        started = True
+        while started and self._order:
+            if self.max_total and self._running >= self.max_total:
+                break
+
+            started = False
+            for i in xrange(len(self._order)):
+                host = self._order[0]
+                self._order.rotate(-1)
+                queue = self._queues[host]
+
+                if not self._allowed(queue[0][0]):
+                    continue
+
+                query, deferred, queued = queue.popleft()
+                if not queue:
+                    del self._queues[host]
+                    self._order.remove(host)
+
+                self._waiting -= 1
+                wait = time.time() - queued
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+
+                self._admit(query)
+                started = True
+                deferred.callback(None)
+                break
+
+    def stats(self):
+        """Current queue state for the monitor page"""
+
+        dequeued = self._delayed - self._waiting
+        if dequeued:
+            wait_avg = self._wait_total / dequeued
+        else:
+            wait_avg = 0.0
+
+        return {'running': self._running,
+                'waiting': self._waiting,
+                'admitted': self._admitted,
+                'delayed': self._delayed,
+                'wait_avg': wait_avg,
+                'wait_max': self._wait_max,
+                'types': dict(self._running_type),
+                'limits': {'total': self.max_total,
+                           'host': self.max_host,
+                           'types': self.max_type}}
@@ -0,0 +1,168 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fixed size latency histograms.
+
+Values are recorded in microseconds into log-linear buckets in the
+style of HdrHistogram: each power of two range is split into a fixed
+number of linear sub-buckets so the relative error of any reported
+value is bounded (about 6% with the default 16 sub-buckets) no matter
+how large it is. Every histogram is a single flat array of counts so
+recording is O(1) and merging two histograms is a simple loop.
+"""
+
+import time
+from array import array
+
+# Linear sub-buckets per power of two, must be a power of two itself
+SUB_BITS = 4
+SUB_COUNT = 1 << SUB_BITS
+
+# Enough buckets to cover a bit over an hour in microseconds
+MAX_VALUE = (1 << 32) - 1
+BUCKETS = ((MAX_VALUE.bit_length() - SUB_BITS) << SUB_BITS) + SUB_COUNT
+
+def _index(value):
+    """Bucket index for a value in microseconds"""
+    shift = max(0, value.bit_length() - SUB_BITS - 1)
+    return (shift << SUB_BITS) + (value >> shift)
+
+def _upper(index):
+    """Largest value in microseconds that falls into a bucket"""
+    if index < SUB_COUNT * 2:
+        return index
+    shift = (index >> SUB_BITS) - 1
+    return ((index - (shift << SUB_BITS) + 1) << shift) - 1
+
+class Histogram(object):
+    """Distribution of values given in seconds"""
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = array('L', [0]) * BUCKETS
+        self.clear()
+
+    def clear(self):
+        for i in xrange(BUCKETS):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        value = max(0.0, value)
+        self.counts[_index(min(int(value * 1000000), MAX_VALUE))] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        counts = self.counts
+        for i, count in enumerate(other.counts):
+            if count:
+                counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def percentile(self, pct):
+        """Value in seconds below which pct percent of values fall.
+
+        The result is the upper edge of the matching bucket so it may
+        overestimate slightly but never underestimates.
+        """
+
+        if not self.count:
+            return 0.0
+
+        target = max(1, int(round(self.count * pct / 100.0)))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(_upper(i) / 1000000.0, self.max)
+
+        return self.max
+
+    def average(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def stats(self, percentiles=(50, 90, 99, 99.9)):
+        data = {'count': self.count,
+                'max': self.max,
+                'avg': self.average(),
+                'percentiles': []}
+        for pct in percentiles:
+            data['percentiles'].append((pct, self.percentile(pct)))
+        return data
+
+class WindowedHistogram(object):
+    """Histograms over sliding windows of time.
+
+    Values go into a ring of histograms each covering slot seconds,
+    a window is the merge of the most recent slots. The window sizes
+    are rounded up to whole slots and include the current slot.
+    """
+
+    def __init__(self, period=3600, slot=15):
+        self.slot = slot
+        self._slots = [None] * int(period // slot)
+        self._current = None
+
+    def _advance(self, now):
+        current = int(now // self.slot)
+        if self._current is None:
+            self._current = current
+        elif current > self._current:
+            # Clear any slots skipped over since the last record()
+            for tick in xrange(self._current + 1,
+                    min(current, self._current + len(self._slots)) + 1):
+                hist = self._slots[tick % len(self._slots)]
+                if hist is not None:
+                    hist.clear()
+            if current - self._current > len(self._slots):
+                for hist in self._slots:
+                    if hist is not None:
+                        hist.clear()
+            self._current = current
+        return current
+
+    def record(self, value, now=None):
+        if now is None:
+            now = time.time()
+        index = self._advance(now) % len(self._slots)
+        hist = self._slots[index]
+        if hist is None:
+            hist = self._slots[index] = Histogram()
+        hist.record(value)
+
+    def window(self, seconds, now=None):
+        """Get a Histogram of values in the last seconds"""
+
+        if now is None:
+            now = time.time()
+        current = self._advance(now)
+
+        merged = Histogram()
+        count = min(len(self._slots), -(-int(seconds) // self.slot))
+        for tick in xrange(current - count + 1, current + 1):
+            hist = self._slots[tick % len(self._slots)]
+            if hist is not None and hist.count:
+                merged.merge(hist)
+        return merged
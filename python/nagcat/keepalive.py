@@ -0,0 +1,276 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent HTTP connections.
+
+By default every HTTP query opens a new connection, and for HTTPS
+does a full TLS handshake, each time it runs. Queries that opt in
+send their requests through the KeepAlive pool instead, which keeps
+idle HTTP/1.1 connections open for reuse. Connections are pooled per
+(scheme, address, port, TLS context) and each of those has its own
+limit on how many requests may be in flight at once. Pools that go
+unused for longer than the idle timeout are dropped, for example the
+old address of a host after --dns-refresh notices it has moved.
+
+Responses are converted to the same errors HTTPClientFactory
+produces so HTTPQuery can handle both the same way.
+"""
+
+import time
+from cStringIO import StringIO
+
+from twisted.internet import defer, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.endpoints import SSL4ClientEndpoint
+from twisted.python import failure
+from twisted.web import error as weberror
+
+try:
+    from twisted.web.client import Agent, HTTPConnectionPool
+    from twisted.web.client import FileBodyProducer, readBody
+    from twisted.web.client import ResponseFailed
+    from twisted.web.http_headers import Headers
+except ImportError:
+    Agent = None
+
+from nagcat import log
+
+def available():
+    """True if this version of Twisted has everything needed"""
+    return (Agent is not None
+            and hasattr(Agent, 'usingEndpointFactory'))
+
+# Same as HTTPClientFactory, other codes are errors
+SUCCESS = (200, 201, 202)
+REDIRECT = (301, 302, 303)
+
+if Agent is not None:
+    class CountingPool(HTTPConnectionPool):
+        """HTTPConnectionPool that counts reused and new connections"""
+
+        def __init__(self, reactor, idle, max_idle):
+            HTTPConnectionPool.__init__(self, reactor)
+            self.cachedConnectionTimeout = idle
+            self.maxPersistentPerHost = max_idle
+            self.hits = 0
+            self.misses = 0
+            self.opened = 0
+
+        def getConnection(self, key, endpoint):
+            opened = self.opened
+            d = HTTPConnectionPool.getConnection(self, key, endpoint)
+            if self.opened == opened:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return d
+
+        def _newConnection(self, key, endpoint):
+            # Also called to retry a request on a fresh connection
+            # when a cached one turns out to have been closed.
+            self.opened += 1
+            return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+        def idle(self):
+            return sum(len(c) for c in self._connections.itervalues())
+
+class Connections(object):
+    """The pool for one (scheme, address, port, TLS context)"""
+
+    def __init__(self, scheme, addr, port, context, idle, max_connections):
+        self.scheme = scheme
+        self.addr = addr
+        self.port = port
+        self.context = context
+        self.limit = defer.DeferredSemaphore(max_connections)
+        self.pool = CountingPool(reactor, idle, max_connections)
+        self.agent = Agent.usingEndpointFactory(reactor, self, self.pool)
+        # Connect timeout for new connections, set before each request
+        self.timeout = 30
+        # When the last request started or finished
+        self.used = time.time()
+
+    def endpointForURI(self, uri):
+        """IAgentEndpointFactory, always connect to addr and port"""
+
+        if self.context is None:
+            return TCP4ClientEndpoint(reactor, self.addr, self.port,
+                                      timeout=self.timeout)
+        else:
+            creator = self.context.creator(self.addr, self.port)
+            return SSL4ClientEndpoint(reactor, self.addr, self.port,
+                                      creator, timeout=self.timeout)
+
+    def request(self, method, path, headers, data, timeout):
+        """Send one request, returns a Deferred body"""
+
+        if data is None:
+            producer = None
+        else:
+            producer = FileBodyProducer(StringIO(data))
+
+        uri = "%s://%s:%d%s" % (self.scheme, self.addr, self.port, path)
+        self.timeout = timeout
+        d = self.agent.request(method, uri, headers, producer)
+        d.addCallback(self._response)
+        return d
+
+    def _response(self, response):
+        d = readBody(response)
+        d.addCallback(self._body, response)
+        return d
+
+    def _body(self, body, response):
+        if response.code in SUCCESS:
+            return body
+
+        status = str(response.code)
+        location = response.headers.getRawHeaders('location')
+        if response.code in REDIRECT and location:
+            raise weberror.PageRedirect(status, response.phrase,
+                                        body, location[0])
+        else:
+            raise weberror.Error(status, response.phrase, body)
+
+    def busy(self):
+        return self.limit.tokens < self.limit.limit or self.limit.waiting
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+    def stats(self):
+        return {'scheme': self.scheme,
+                'addr': self.addr,
+                'port': self.port,
+                'hits': self.pool.hits,
+                'misses': self.pool.misses,
+                'opened': self.pool.opened,
+                'idle': self.pool.idle(),
+                'active': self.limit.limit - self.limit.tokens,
+                'waiting': len(self.limit.waiting)}
+
+class KeepAlive(object):
+    """Persistent HTTP connections for every host"""
+
+    def __init__(self, idle=60, max_connections=2):
+        self.idle = idle
+        self.max_connections = max_connections
+
+        # (scheme, addr, port, context) -> Connections
+        self._connections = {}
+        self._expired = time.time()
+        self.expired = 0
+
+    def configure(self, idle, max_connections):
+        """Set limits for pools created from now on"""
+        self.idle = idle
+        self.max_connections = max_connections
+
+    def request(self, addr, port, context, method, path,
+                headers, data, timeout):
+        """Send a request using a cached connection if there is one.
+
+        context is the sslcache.ClientContext for HTTPS or None,
+        headers is a dict that should include Host and User-Agent.
+        Returns a Deferred that fires with the body of a successful
+        response and fails with the same errors as HTTPClientFactory.
+        """
+
+        assert available()
+        self.expire()
+
+        if context is None:
+            scheme = "http"
+        else:
+            scheme = "https"
+
+        key = (scheme, addr, port, context)
+        connections = self._connections.get(key, None)
+        if connections is None:
+            connections = self._connections[key] = Connections(
+                    scheme, addr, port, context,
+                    self.idle, self.max_connections)
+        connections.used = time.time()
+
+        headers = Headers(dict((k, [v]) for k, v in headers.iteritems()))
+        d = connections.limit.run(connections.request,
+                method, path, headers, data, timeout)
+
+        # The timeout covers waiting for a connection, the request
+        # and reading the body just like HTTPClientFactory's timeout.
+        call = reactor.callLater(timeout, d.cancel)
+        d.addBoth(self._done, call, connections)
+        return d
+
+    def _done(self, result, call, connections):
+        connections.used = time.time()
+        if call.active():
+            call.cancel()
+        elif isinstance(result, failure.Failure):
+            return failure.Failure(defer.TimeoutError())
+
+        if (isinstance(result, failure.Failure) and
+                isinstance(result.value, ResponseFailed) and
+                result.value.reasons):
+            # Report the underlying error, ConnectionDone for
+            # an empty response, SSL errors, and so on.
+            return result.value.reasons[0]
+
+        return result
+
+    def expire(self):
+        """Drop pools that have not been used for the idle timeout.
+
+        Their cached connections have timed out by then so this only
+        frees the pool itself. Pools are keyed by address so without
+        this one is left behind each time a host's address changes.
+        Only checks once per idle timeout, request() calls this.
+        """
+
+        now = time.time()
+        if now - self._expired < self.idle:
+            return
+        self._expired = now
+
+        for key, connections in self._connections.items():
+            if (now - connections.used >= self.idle
+                    and not connections.busy()):
+                log.debug("Dropping idle keep-alive pool for %s:%d",
+                          connections.addr, connections.port)
+                del self._connections[key]
+                connections.close()
+                self.expired += 1
+
+    def close(self):
+        """Close all idle connections"""
+
+        log.debug("Closing %d keep-alive pools", len(self._connections))
+        deferreds = [c.close() for c in self._connections.itervalues()]
+        self._connections.clear()
+        return defer.DeferredList(deferreds)
+
+    def stats(self):
+        hosts = [c.stats() for c in self._connections.itervalues()]
+        return {'pools': len(hosts),
+                'hits': sum(h['hits'] for h in hosts),
+                'misses': sum(h['misses'] for h in hosts),
+                'opened': sum(h['opened'] for h in hosts),
+                'idle': sum(h['idle'] for h in hosts),
+                'expired': self.expired,
+                'max_connections': self.max_connections,
+                'idle_timeout': self.idle,
+                'hosts': hosts}
+
+# Shared by all HTTP queries
+default = KeepAlive()
@@ -151,6 +151,11 @@ def init_stdio():
     """Signal the logger to steal sys.stdout/err"""
     _logger.stdio()
 
+def write(text):
+    """Write already formatted text such as another process's log"""
+    util.untilConcludes(_logger.log_file.write, text)
+    util.untilConcludes(_logger.log_file.flush)
+
 def _level_factory(index, name):
     """Setup the log level helper functions"""
 
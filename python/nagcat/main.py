@@ -16,12 +16,13 @@
 
 import os
 import sys
-from optparse import OptionParser
+from optparse import OptionParser, SUPPRESS_HELP
 
 from twisted.internet import reactor
 import coil
 
 from nagcat import errors, log, nagios, plugin, query, simple, util, merlin
+from nagcat import shard
 
 def parse_options():
     """Parse program options in sys.argv"""
@@ -65,12 +66,61 @@ def parse_options():
             help="path to nagios.cfg, enables Nagios support")
     parser.add_option("-T", "--tag", dest="tag",
             help="only load nagios tests with a specific tag")
+    parser.add_option("--startup-workers", type="int", default=0,
+            help="expand Nagios test configs using this many processes")
+    parser.add_option("--processes", type="int", default=1,
+            help="run Nagios tests in this many processes, sharded "
+                 "by host address")
+    parser.add_option("--shard", help=SUPPRESS_HELP)
+    parser.add_option("--submit", type="choice", default="command_file",
+            choices=("command_file", "check_result_path"),
+            help="send results to Nagios through its command_file or by "
+                 "writing them to its check_result_path [%default]")
+    parser.add_option("--batch-size", type="int", default=500,
+            help="submit up to this many results to Nagios at once, "
+                 "1 disables batching [%default]")
+    parser.add_option("--batch-delay", type="float", default=1.0,
+            metavar="SECONDS",
+            help="longest time a result waits for its batch to fill "
+                 "[%default]")
     parser.add_option("--default-timeout", type="int", default="15",
             help="default query timeout in seconds [%default]")
     parser.add_option("-C", "--core-dumps",
             help="set cwd to the given directory and enable core dumps")
     parser.add_option("--disable-snmp-bulk", action="store_true",
             help="disable the use of SNMPv2's GETBULK command")
+    parser.add_option("--timer-wheel", action="store_true", default=False,
+            help="schedule tests with a timer wheel rather than the "
+                 "reactor's heap, useful with very many tests")
+    parser.add_option("--max-queries", type="int", default=0,
+            help="limit the number of queries running at once")
+    parser.add_option("--max-host-queries", type="int", default=0,
+            help="limit the number of queries running at once per host")
+    parser.add_option("--max-type-queries", action="append", default=[],
+            metavar="TYPE=N",
+            help="limit the number of queries of the given type running "
+                 "at once, may be given multiple times")
+    parser.add_option("--adaptive-spread", action="store_true",
+            default=False,
+            help="pick start times based on the measured cost of tests "
+                 "and re-spread them when callback latency climbs")
+    parser.add_option("--dns-refresh", type="int", default=0,
+            metavar="SECONDS",
+            help="re-resolve host names in the background every "
+                 "SECONDS and update queries whose address changed")
+    parser.add_option("--stall-threshold", type="float", default=0,
+            metavar="SECONDS",
+            help="sample the reactor's stack when it has been blocked "
+                 "for SECONDS to find what is stalling it, 0 disables "
+                 "[%default]")
+    parser.add_option("--keepalive-idle", type="int", default=60,
+            metavar="SECONDS",
+            help="close persistent HTTP connections used by queries "
+                 "with keepalive set after SECONDS idle [%default]")
+    parser.add_option("--keepalive-max", type="int", default=2,
+            metavar="N",
+            help="limit queries with keepalive set to N connections "
+                 "per host [%default]")
     parser.add_option("", "--profile-init", dest="profile_init",
             action="store_true", default=False,
             help="run profiler during startup")
@@ -116,10 +166,38 @@ def parse_options():
     if options.test and (not options.host or not options.port):
         err.append("--host and --port is required with --test")
 
+    if options.processes > 1 and not options.nagios:
+        err.append("--processes requires --nagios")
+
+    if options.batch_size < 1:
+        err.append("--batch-size must be at least 1")
+
+    if options.keepalive_max < 1:
+        err.append("--keepalive-max must be at least 1")
+
+    # Set by the coordinator for worker processes: index/count
+    if options.shard:
+        try:
+            index, count = [int(x) for x in options.shard.split('/')]
+        except ValueError:
+            index, count = -1, 0
+        if not 0 <= index < count:
+            err.append("invalid --shard value '%s'" % options.shard)
+        options.shard = (index, count)
+
     if options.loglevel not in log.LEVELS:
         err.append("invalid log level '%s'" % options.loglevel)
         err.append("must be one of: %s" % " ".join(log.LEVELS))
 
+    max_type_queries = {}
+    for limit in options.max_type_queries:
+        try:
+            query_type, count = limit.split('=', 1)
+            max_type_queries[query_type.strip()] = int(count)
+        except ValueError:
+            err.append("invalid --max-type-queries value '%s'" % limit)
+    options.max_type_queries = max_type_queries
+
     if options.profile_all:
         options.profile_init = True
         options.profile_run = True
@@ -162,13 +240,42 @@ def init_plugins(options):
     snmp = plugin.search(query.IQuery, "snmp")
     snmp.use_bulk(not options.disable_snmp_bulk)
 
+def init_worker(options):
+    """Adjust options for a worker started by shard.Coordinator"""
+
+    # The coordinator already did the process setup, owns the log
+    # file (our stdout is sent to it), and serves the status port.
+    options.daemon = False
+    options.pidfile = None
+    options.logfile = None
+    options.status_port = None
+    options.user = options.group = None
+
+    worker = shard.Worker(options.shard[0], options.shard[1],
+            options.rrdcache)
+    worker.connect()
+    return worker
+
+def init_coordinator(options):
+    """Start workers instead of running tests in this process"""
+
+    argv = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
+    return shard.Coordinator(options.processes, argv, options.nagios,
+            rrdcache=options.rrdcache, monitor_port=options.status_port,
+            submit=options.submit, batch_size=options.batch_size,
+            batch_delay=options.batch_delay)
+
 def init(options):
     """Prepare to start up NagCat"""
 
-    # Set uid/gid/file_limit
-    util.setup(options.user, options.group,
-               options.file_limit,
-               options.core_dumps)
+    if options.shard:
+        worker = init_worker(options)
+    else:
+        worker = None
+        # Set uid/gid/file_limit
+        util.setup(options.user, options.group,
+                   options.file_limit,
+                   options.core_dumps)
 
     # Write out the pid to make the verify script happy
     if options.pidfile:
@@ -193,27 +300,71 @@ def init(options):
                     rrdcache=options.rrdcache,
                     monitor_port=options.status_port,
                     default_timeout=options.default_timeout,
+                    timer_wheel=options.timer_wheel,
+                    max_queries=options.max_queries,
+                    max_host_queries=options.max_host_queries,
+                    max_type_queries=options.max_type_queries,
+                    adaptive_spread=options.adaptive_spread,
+                    dns_refresh=options.dns_refresh,
+                    stall_threshold=options.stall_threshold,
+                    keepalive_idle=options.keepalive_idle,
+                    keepalive_max=options.keepalive_max,
                     test_name=options.test,
                     host=options.host, port=options.port)
+        elif options.processes > 1 and not worker and not options.verify:
+            nagcat = init_coordinator(options)
         elif options.merlin:
             nagcat = merlin.NagcatMerlin(config,
                      rradir=options.rradir,
                      rrdcache=options.rrdcache,
+                     rrdapi=worker and worker.rrdapi(),
                      monitor_port=options.status_port,
                      default_timeout=options.default_timeout,
+                     timer_wheel=options.timer_wheel,
+                     max_queries=options.max_queries,
+                     max_host_queries=options.max_host_queries,
+                     max_type_queries=options.max_type_queries,
+                     adaptive_spread=options.adaptive_spread,
+                     dns_refresh=options.dns_refresh,
+                     stall_threshold=options.stall_threshold,
+                     keepalive_idle=options.keepalive_idle,
+                     keepalive_max=options.keepalive_max,
                      nagios_cfg=options.nagios, tag=options.tag,
+                     startup_workers=options.startup_workers,
+                     shard=worker,
+                     submit=options.submit,
+                     batch_size=options.batch_size,
+                     batch_delay=options.batch_delay,
                      merlin_db_info=merlin_db_info)
         else:
             nagcat = nagios.NagcatNagios(config,
                     rradir=options.rradir,
                     rrdcache=options.rrdcache,
+                    rrdapi=worker and worker.rrdapi(),
                     monitor_port=options.status_port,
                     default_timeout=options.default_timeout,
-                    nagios_cfg=options.nagios, tag=options.tag)
+                    timer_wheel=options.timer_wheel,
+                    max_queries=options.max_queries,
+                    max_host_queries=options.max_host_queries,
+                    max_type_queries=options.max_type_queries,
+                    adaptive_spread=options.adaptive_spread,
+                    dns_refresh=options.dns_refresh,
+                    stall_threshold=options.stall_threshold,
+                    keepalive_idle=options.keepalive_idle,
+                    keepalive_max=options.keepalive_max,
+                    nagios_cfg=options.nagios, tag=options.tag,
+                    startup_workers=options.startup_workers,
+                    shard=worker,
+                    submit=options.submit,
+                    batch_size=options.batch_size,
+                    batch_delay=options.batch_delay)
     except (errors.InitError, coil.errors.CoilError), ex:
         log.error(str(ex))
         sys.exit(1)
 
+    if worker:
+        worker.setup(nagcat)
+
     reactor.callWhenRunning(start, nagcat)
 
     if options.verify:
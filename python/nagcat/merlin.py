@@ -12,82 +12,133 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import time
-
 try:
     import MySQLdb
 except ImportError:
     MySQLdb = None
 
+from twisted.enterprise import adbapi
+from twisted.internet import task
+
 from nagcat import log, merlintest, nagios
 
+# Seconds between reads of the merlin peer list
+PEER_REFRESH = 60
 
 def available():
     """Returns False if merlin support is disabled"""
     return MySQLdb is not None
 
+def read_peers(cursor):
+    """Get (peer_id, num_peers) from merlin's database.
+
+    cursor may be any DB-API cursor or an adbapi Transaction. If this
+    host is not an active peer the peer_id is None so it runs all tests.
+    """
+
+    cursor.execute("""select * from merlin_peers where state=3;""")
+    rows = cursor.fetchall()
+    peer_id = None
+    for row in rows:
+        if row[0] == "localhost":
+            peer_id = row[5]
+    return peer_id, len(rows)
+
 class NagcatMerlin(nagios.NagcatNagios):
     """NagcatNagios scheduler that load balances using merlin."""
 
     def __init__(self, config, nagios_cfg, merlin_db_info={}, **kwargs):
         assert available()
         nagios.NagcatNagios.__init__(self, config, nagios_cfg, **kwargs)
-        self._test_index = 0
-        self._merlin_db_info = merlin_db_info
-        self._peer_id = None
-        self._peer_id_timestamp = None
-        self._num_peers = None
-        self._update_peer_id()
+        self._init_peers(self._connect_pool(merlin_db_info))
+
+    def _connect_pool(self, merlin_db_info):
+        if not merlin_db_info:
+            return None
+        return adbapi.ConnectionPool("MySQLdb",
+                user=merlin_db_info['merlin_db_user'],
+                host=merlin_db_info['merlin_db_host'],
+                passwd=merlin_db_info['merlin_db_pass'],
+                db=merlin_db_info['merlin_db_name'],
+                cp_min=1, cp_max=1, cp_reconnect=True, cp_noisy=False)
+
+    def _init_peers(self, pool):
+        # The current (peer_id, num_peers) is always replaced as a
+        # whole so tests never see the id from one read and the
+        # count from another.
+        self._peers = (None, None)
+        self._peers_pool = pool
+        self._peers_call = None
+        self._peers_refreshing = None
+
+        if pool:
+            # The reactor isn't running yet so blocking here is fine
+            # and gives the first round of tests a real answer.
+            try:
+                conn = pool.connect()
+                try:
+                    self._set_peers(read_peers(conn.cursor()))
+                finally:
+                    pool.disconnect(conn)
+            except Exception, ex:
+                log.error("Error reading merlin db: %s", ex)
 
     def new_test(self, config):
-        new = merlintest.MerlinTest(self, config, self._test_index)
-        self._test_index += 1
+        new = merlintest.MerlinTest(self, config)
         self.register(new)
         if self.trend:
             self.trend.setup_test_trending(new, config)
         return new
 
-    def _set_peer_id_and_timestamp(self):
-        """ Gets a peer_id and sets a timestamp for when it acquired the peer_id
-        The peer_id comes from merlin, and is obtained by reading a database,
-        which Merlin outputs data to."""
-        try:
-            db = MySQLdb.connect(
-                user=self._merlin_db_info['merlin_db_user'],
-                host=self._merlin_db_info['merlin_db_host'],
-                passwd=self._merlin_db_info['merlin_db_pass'],
-                db=self._merlin_db_info['merlin_db_name'])
-            curs = db.cursor()
-            num_rows = curs.execute(
-                """select * from merlin_peers where state=3;""")
-            self._num_peers = num_rows
-            log.debug("Setting self._num_peers = %s", self._num_peers)
-            for i in range(num_rows):
-                row = curs.fetchone()
-                if row[0] == "localhost":
-                    self._peer_id = row[5]
-                    self._peer_id_timestamp = time.time()
-                    log.debug(("Setting self._peer_id = %s",
-                        str(self._peer_id)) +
-                        ("and self._peer_id_timestamp = %s",
-                        self._peer_id_timestamp))
-        except MySQLdb.Error, e:
-            log.error("Error reading merlin db %d: %s" % (e.args[0], e.args[1]))
-
-    def _update_peer_id(self):
-        log.debug("Updating peer_id with _merlin_db_info=%s",
-            self._merlin_db_info)
-        if self._peer_id and self._peer_id_timestamp:
-            if time.time() - self._peer_id_timestamp >= 60:
-                # peer_id should be refreshed.
-                self._set_peer_id_and_timestamp()
-            else:
-                # peer_id is still valid, return.
-                return
-        else: # We are missing peer_id or peer_id_timestamp...
-            if self._merlin_db_info:
-                self._set_peer_id_and_timestamp()
+    def start(self):
+        # Tests in a group share queries so they must all run on the
+        # same peer, use the same key for all of them.
+        for group in self._registered:
+            tests = group.getDependencies()
+            key = min(t.key() for t in tests)
+            for t in tests:
+                t.setGroupKey(key)
+
+        if self._peers_pool:
+            self._peers_call = task.LoopingCall(self.refresh_peers)
+            self._peers_call.start(PEER_REFRESH, now=False)
+
+        return super(NagcatMerlin, self).start()
+
+    def stop(self):
+        if self._peers_call:
+            self._peers_call.stop()
+            self._peers_call = None
+        super(NagcatMerlin, self).stop()
+
+    def refresh_peers(self):
+        """Read the peer list in a pool thread and swap it in.
+
+        Returns a Deferred that fires once the new list is in use.
+        """
+
+        # Don't pile up queries if the database is slow
+        if self._peers_refreshing:
+            return self._peers_refreshing
+
+        refreshing = self._peers_pool.runInteraction(read_peers)
+        refreshing.addCallbacks(self._set_peers, self._refresh_peers_failed)
+        self._peers_refreshing = refreshing
+        refreshing.addBoth(self._refresh_peers_done)
+        return refreshing
+
+    def _refresh_peers_done(self, result):
+        self._peers_refreshing = None
+        return result
+
+    def _refresh_peers_failed(self, result):
+        # Keep using the old list, it is better than nothing
+        log.error("Error reading merlin db: %s", result.value)
+
+    def _set_peers(self, peers):
+        if peers != self._peers:
+            log.info("Merlin peer_id is %s of %s peers", *peers)
+        self._peers = peers
 
     def get_peer_id_num_peers(self):
-        self._update_peer_id()
-        return self._peer_id, self._num_peers
+        return self._peers
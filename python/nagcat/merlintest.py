@@ -12,10 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+
 from twisted.internet import defer
 
 from nagcat import log, test, scheduler, simple
 
+def jump_hash(key, buckets):
+    """Pick a bucket for key using jump consistent hashing.
+
+    When the number of buckets grows from n to n+1 only 1/(n+1) of the
+    keys move, all of them to the new bucket, and when the last bucket
+    is removed only its keys move. See "A Fast, Minimal Memory,
+    Consistent Hash Algorithm" by Lamping and Veach.
+    """
+
+    key = int(hashlib.md5(key).hexdigest()[:16], 16)
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * (float(1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
 class NagcatMerlinTestDummy(scheduler.Scheduler):
     """For testing purposes."""
     def build_tests(self, config):
@@ -29,27 +48,37 @@ class NagcatMerlinTestDummy(scheduler.Scheduler):
 
 class MerlinTest(test.Test):
 
-    def __init__(self, nagcat, conf, test_index):
+    __slots__ = ('_group_key',)
+
+    def __init__(self, nagcat, conf):
         test.Test.__init__(self, nagcat, conf)
-        self._test_index = test_index
+        self._group_key = self.key()
+
+    def key(self):
+        """A name for this test that is the same on every peer"""
+        return "%s/%s" % (self.host, self._description)
+
+    def setGroupKey(self, key):
+        """Set the key used to pick a peer, see NagcatMerlin.start()"""
+        self._group_key = key
 
     def _should_run(self):
-        """Decides whether or not a test should be run, based on its task
-        index and the schedulers peer_id. Returns True if it should run, False
+        """Decides whether or not a test should be run, based on its group
+        key and the schedulers peer_id. Returns True if it should run, False
         if it should not."""
         peer_id, num_peers = self._nagcat.get_peer_id_num_peers()
-        log.debug("Running should_run, test_index=%s, num_peers=%s, peer_id=%s",
-            str(self._test_index), num_peers, peer_id)
-        if peer_id and num_peers:
-            if self._test_index % num_peers != peer_id:
+        log.debug("Running should_run, group_key=%s, num_peers=%s, peer_id=%s",
+            self._group_key, num_peers, peer_id)
+        if peer_id is not None and num_peers:
+            if jump_hash(self._group_key, num_peers) != peer_id:
                 return False
         return True
 
-    def start(self):
+    def start(self, max_age=None):
         """Decides whether or not to start the test, based on _should_run."""
         if self._should_run():
             log.debug("Running test %s", self)
-            return super(MerlinTest,self).start()
+            return super(MerlinTest,self).start(max_age)
         else:
             log.debug("Skipping start of %s", self)
             return defer.succeed(None)
@@ -103,6 +103,17 @@ class Memory(XMLPage):
 
     vm_regex = re.compile("^(Vm\w+):\s+(\d+)\s+(\w+)$")
 
+    def __init__(self):
+        XMLPage.__init__(self)
+        self.usage = []
+
+    def addUsage(self, name, func):
+        """Include a breakdown of memory used by some set of objects.
+
+        func() must return a dict of type -> (count, bytes).
+        """
+        self.usage.append((name, func))
+
     def xml(self, request):
         mem = etree.Element("Memory", version="1.0")
         status = open("/proc/self/status")
@@ -115,6 +126,18 @@ class Memory(XMLPage):
             new.text = match.group(2)
 
         status.close()
+
+        for name, func in self.usage:
+            usage = etree.SubElement(mem, name)
+            for obj_type, (count, size) in sorted(func().iteritems()):
+                if count:
+                    average = size // count
+                else:
+                    average = 0
+                etree.SubElement(usage, "Object", type=obj_type,
+                        count=str(count), bytes=str(size),
+                        average=str(average))
+
         return mem
 
 class Time(XMLPage):
@@ -188,8 +211,9 @@ class Stat(XMLPage):
         self.putChild("", self)
 
         # Pages to include in the complete XML page
+        self.memory = Memory()
         self.includeChild("ping", Ping())
-        self.includeChild("memory", Memory())
+        self.includeChild("memory", self.memory)
         self.includeChild("time", Time())
         self.includeChild("threads", Threads())
 
@@ -229,3 +253,6 @@ class MonitorSite(server.Site):
 
     def putChild(self, path, child):
         self.stat.putChild(path, child)
+
+    def addMemoryUsage(self, name, func):
+        self.stat.memory.addUsage(name, func)
@@ -14,17 +14,126 @@
 
 """NagCat->Nagios connector"""
 
-import os
-import socket
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
+from coil import struct
 from coil.errors import CoilError
-from nagcat import errors, log, nagios_api, nagios_objects, scheduler
+from nagcat import errors, log, nagios_api, nagios_objects, resolver
+from nagcat import scheduler
+
+# Test templates used by startup worker processes, set before forking.
+_worker_templates = None
+
+def _make_testconf(templates, test_defaults, test_overrides):
+    """Create a test's config from its template and Nagios service"""
+
+    testconf = templates.get(test_overrides['test'], None)
+    if testconf is None:
+        raise errors.InitError(
+                "Test template '%s' not found in config!"
+                % test_overrides['test'])
+
+    # Copy the config so we can add instance specific values
+    # such as host, port, etc.
+    testconf = testconf.copy()
+
+    for key, val in test_defaults.iteritems():
+        testconf.setdefault(key, val)
+
+    for key, val in test_overrides.iteritems():
+        testconf[key] = val
+
+    return testconf
+
+def _expand_testconf(skel):
+    """Build and fully expand a test config in a worker process.
+
+    Returns (config, error) where config is a plain dict or None if
+    the worker could not build it. In that case the main process
+    builds it the normal way so that errors in the config are
+    reported exactly as they would be without workers. error is None
+    for those and the traceback of anything unexpected otherwise.
+    """
+
+    test_defaults, test_overrides = skel
+    try:
+        testconf = _make_testconf(_worker_templates,
+                                  test_defaults, test_overrides)
+        testconf.expand()
+        return testconf.dict(), None
+    except (errors.InitError, CoilError):
+        return None, None
+    except Exception:
+        return None, str(errors.Failure())
+
+def _expand_tests(templates, skels, workers):
+    """Copy and expand test configs using a pool of processes.
+
+    Results are returned in the same order as skels so the tests
+    (and their shared queries) are created in the same order as
+    they would be without workers. Configs that could not be
+    expanded are None.
+    """
+    global _worker_templates
+
+    if multiprocessing is None:
+        log.warn("multiprocessing is not available, "
+                 "building tests in a single process")
+        return [None] * len(skels)
+
+    log.info("Expanding %d tests using %d processes", len(skels), workers)
+
+    _worker_templates = templates
+    pool = multiprocessing.Pool(workers)
+    try:
+        try:
+            chunk = max(1, len(skels) // (workers * 4))
+            results = pool.map(_expand_testconf, skels, chunk)
+        except:
+            pool.terminate()
+            raise
+        else:
+            # terminate() can hang if workers are already exiting
+            pool.close()
+    finally:
+        pool.join()
+        _worker_templates = None
+
+    expanded = []
+    for (test_defaults, test_overrides), (testconf, error) in zip(
+            skels, results):
+        if error is not None:
+            log.warn("Worker failed to expand test %s for %s %s:\n%s",
+                     test_overrides['test'], test_defaults['host'],
+                     test_defaults['description'], error)
+        expanded.append(testconf)
+
+    failed = expanded.count(None)
+    if failed:
+        log.debug("%d tests will be built without workers", failed)
+
+    return expanded
 
 class NagcatNagios(scheduler.Scheduler):
     """Setup tests defined by Nagios and report back"""
 
-    def __init__(self, config, nagios_cfg, **kwargs):
-        """Read given Nagios config file and load tests"""
+    def __init__(self, config, nagios_cfg, shard=None,
+                 submit="command_file", batch_size=500, batch_delay=1.0,
+                 **kwargs):
+        """Read given Nagios config file and load tests.
+
+        shard is a shard.Worker when running as one of several
+        processes, only that shard's tests are loaded and results
+        are sent to the coordinating process instead of Nagios.
+
+        submit picks how results reach Nagios, either through the
+        'command_file' pipe or written to the 'check_result_path'.
+        batch_size and batch_delay control how results are grouped
+        into files, see nagios_api.ResultBatcher.
+        """
 
         # TODO: The NagcatNagios class needs to be easier to test,
         # that way we can actually call the __init__ for it in unit tests
@@ -35,50 +144,66 @@ class NagcatNagios(scheduler.Scheduler):
                 ('object_cache_file', 'status_file',
                  'command_file', 'check_result_path'))
         self._nagios_obj = cfg['object_cache_file']
-        spool = nagios_api.spool_path(cfg['check_result_path'], 'nagcat')
-        self._nagios_cmd = nagios_api.NagiosCommander(
-                cfg['command_file'], spool)
+        self._shard = shard
+        if shard:
+            self._nagios_cmd = shard.commander()
+        else:
+            self._nagios_cmd = nagios_api.result_submitter(cfg, 'nagcat',
+                    submit, batch_size, batch_delay)
 
-        self._status_file = cfg['status_file']
-        self._status_cache = None
-        self._status_mtime = 0
+        # Only read when a test first asks for it, most don't
+        self._status = nagios_objects.StatusReader(cfg['status_file'])
 
         log.info("Using Nagios object cache: %s", self._nagios_obj)
-        log.info("Using Nagios command file: %s", cfg['command_file'])
-        log.info("Using Nagios status file: %s", self._status_file)
-        return super(NagcatNagios, self).__init__(config, **kwargs)
+        log.info("Using Nagios status file: %s", cfg['status_file'])
+        super(NagcatNagios, self).__init__(config, **kwargs)
+
+        if self.monitor:
+            self.monitor.includeChild("commands",
+                    nagios_api.CommandPage(self._nagios_cmd))
 
     def nagios_status(self):
-        fd = open(self._status_file, 'r')
-        try:
-            stat = os.fstat(fd.fileno())
-            if self._status_mtime < stat.st_mtime:
-                self._status_cache = nagios_objects.ObjectParser(fd)
-                self._status_mtime = stat.st_mtime
-            return self._status_cache
-        finally:
-            fd.close()
+        if not self._status.running():
+            # Never parse in the reactor thread, until the first
+            # refresh finishes the status is simply empty.
+            self._status.start(now=True)
+        return self._status.snapshot()
+
+    def stop(self):
+        self._status.stop()
+        super(NagcatNagios, self).stop()
 
     def _parse_tests(self, tag):
         """Get the list of NagCat services in the object cache"""
 
-        parser = nagios_objects.ObjectParser(
+        parser = nagios_objects.load_object_cache(
                 self._nagios_obj, ('host', 'service'))
         hosts = {}
         tests = []
 
         for host in parser['host']:
-            # Make sure host address is valid
-            addr = host.get('address', host['host_name'])
-            try:
-                addr = socket.gethostbyname(addr)
-            except socket.gaierror, ex:
-                raise errors.InitError(
-                    "Failed to resolve '%s': %s" % (addr, ex))
-            host.setdefault('address', addr)
+            host.setdefault('address', host['host_name'])
+            if self._shard and not self._shard.owns(host['address']):
+                continue
             hosts[host['host_name']] = host
 
+        if self._shard:
+            log.info("Loading %d hosts for shard %d of %d", len(hosts),
+                    self._shard.index, self._shard.count)
+
+        # Make sure host addresses are valid, looking them all up at
+        # once is much faster than one at a time as tests are built.
+        # The names stay in the config so addresses can be refreshed.
+        failed = resolver.default.resolve_many(
+                h['address'] for h in hosts.itervalues())
+        if failed:
+            addr = min(failed)
+            raise errors.InitError(
+                "Failed to resolve '%s': %s" % (addr, failed[addr]))
+
         for service in parser['service']:
+            if self._shard and service['host_name'] not in hosts:
+                continue
             host = hosts[service['host_name']]
             if "_TEST" not in service:
                 continue
@@ -106,28 +231,23 @@ class NagcatNagios(scheduler.Scheduler):
 
         return tests
 
-    def build_tests(self, templates, tag=None):
+    def build_tests(self, templates, tag=None, startup_workers=0):
         """Setup tests based on the loaded Nagios config"""
 
         skels = self._parse_tests(tag)
         tests = []
 
-        for test_defaults, test_overrides in skels:
-            testconf = templates.get(test_overrides['test'], None)
-            if testconf is None:
-                raise errors.InitError(
-                        "Test template '%s' not found in config!"
-                        % test_overrides['test'])
-
-            # Copy the config so we can add instance specific values
-            # such as host, port, etc.
-            testconf = testconf.copy()
+        if startup_workers > 1 and len(skels) > 1:
+            expanded = _expand_tests(templates, skels, startup_workers)
+        else:
+            expanded = [None] * len(skels)
 
-            for key, val in test_defaults.iteritems():
-                testconf.setdefault(key, val)
-
-            for key, val in test_overrides.iteritems():
-                testconf[key] = val
+        for (test_defaults, test_overrides), testconf in zip(skels, expanded):
+            if testconf is None:
+                testconf = _make_testconf(templates,
+                                          test_defaults, test_overrides)
+            else:
+                testconf = struct.Struct(testconf)
 
             try:
                 testobj = self.new_test(testconf)
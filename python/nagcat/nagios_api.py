@@ -32,7 +32,12 @@ from twisted.python.log import Logger
 from twisted.python import failure
 from zope.interface import implements
 
-from nagcat import errors, log, nagios_objects
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from nagcat import errors, log, monitor_api, nagios_objects
 
 def spool_path(nagios_spool, name):
     nagios_spool = os.path.abspath(nagios_spool)
@@ -123,6 +128,10 @@ class NagiosWriter(Logger, object):
         self._data_queue.append(data)
         self.startWriting()
 
+    def queued(self):
+        """Number of writes waiting for room in the pipe"""
+        return len(self._data_queue) + bool(self._data)
+
     def shutdown(self):
         """Remove any unused spool files"""
         if self._data_queue:
@@ -217,6 +226,9 @@ class NagiosCommander(object):
 
         self.writer = NagiosWriter(command_file)
 
+        # Spool files being written by threads
+        self.pending = 0
+
     def command(self, cmd_time, *args):
         """Submit a command to Nagios.
 
@@ -235,40 +247,69 @@ class NagiosCommander(object):
 
         if not cmd_time:
             cmd_time = time.time()
-        cmd_time = int(cmd_time)
+
+        self.cmdbatch([(cmd_time, cmd) for cmd in cmd_list], force)
+
+    def cmdbatch(self, batch, force=False):
+        """Submit commands that each have their own time to Nagios.
+
+        All of the commands are written to a single spool file.
+
+        @param batch: a sequence of (timestamp, (commandname, arg1...))
+        @param force: run the commands now rather than in a thread
+        """
 
         if force:
-            self._threaded_command(cmd_time, cmd_list, True)
+            self._threaded_command(batch, True)
         else:
-            reactor.callInThread(self._threaded_command, cmd_time, cmd_list)
+            self.pending += 1
+            reactor.callInThread(self._threaded_command, batch)
 
-    def _threaded_command(self, cmd_time, cmd_list, force=False):
+    def backlog(self):
+        """Number of spool files not yet handed to the writer"""
+        return self.pending
+
+    def stats(self):
+        return {'pending': self.pending, 'queued': self.writer.queued()}
+
+    def _threaded_command(self, batch, force=False):
         """Write out out the temporary command file from a thread to
         avoid any momentary delays that may be caused by creating
         creating the file.
         """
 
-        spool_fd, spool_path = tempfile.mkstemp(dir=self.spool_dir)
         try:
+            spool_fd, spool_path = tempfile.mkstemp(dir=self.spool_dir)
             try:
-                os.fchmod(spool_fd, 0644)
-                for cmd in cmd_list:
-                    text = self._format_command(cmd_time, *cmd)
-                    log.trace("Writing Nagios command to spool: %s", text)
-                    os.write(spool_fd, text)
-
-                submit = self._format_command(cmd_time,
-                        'PROCESS_FILE', spool_path, '1')
-                if force:
-                    self.writer.write(submit)
-                    self.writer.doWrite()
-                else:
-                    reactor.callFromThread(self.writer.write, submit)
-            except:
-                os.unlink(spool_path)
-                raise
+                try:
+                    os.fchmod(spool_fd, 0644)
+                    submit_time = 0
+                    for cmd_time, cmd in batch:
+                        cmd_time = int(cmd_time)
+                        submit_time = max(submit_time, cmd_time)
+                        text = self._format_command(cmd_time, *cmd)
+                        log.trace("Writing Nagios command to spool: %s",
+                                text)
+                        os.write(spool_fd, text)
+
+                    submit = self._format_command(submit_time,
+                            'PROCESS_FILE', spool_path, '1')
+                    if force:
+                        self.writer.write(submit)
+                        self.writer.doWrite()
+                    else:
+                        reactor.callFromThread(self.writer.write, submit)
+                except:
+                    os.unlink(spool_path)
+                    raise
+            finally:
+                os.close(spool_fd)
         finally:
-            os.close(spool_fd)
+            if not force:
+                reactor.callFromThread(self._spooled)
+
+    def _spooled(self):
+        self.pending -= 1
 
     def _format_command(self, cmd_time, cmd_name, *args):
         assert cmd_name in self.ALLOWED_COMMANDS
@@ -281,21 +322,8 @@ class NagiosCommander(object):
             assert '\n' not in arg and not ';' in arg
             clean_args.append(arg)
 
-        # The last argument may contain newlines but they must be escaped
-        # | is not allowed at all so we use \_ as an escape sequence.
-        def escape(match):
-            char = match.group(1)
-            if char == '\\':
-                return r'\\'
-            elif char == '\n':
-                return r'\n'
-            elif char == '|':
-                return r'\_'
-            else:
-                assert 0
-
         if args:
-            arg = self.ESCAPE.sub(escape, args[-1])
+            arg = self.escape(args[-1])
             # Workaround a bug in some Nagios versions
             arg.rstrip('\\')
             clean_args.append(arg)
@@ -310,6 +338,25 @@ class NagiosCommander(object):
 
         return formatted
 
+    @classmethod
+    def escape(cls, text):
+        """Escape the free form text that ends a command"""
+
+        # It may contain newlines but they must be escaped
+        # | is not allowed at all so we use \_ as an escape sequence.
+        def escape(match):
+            char = match.group(1)
+            if char == '\\':
+                return r'\\'
+            elif char == '\n':
+                return r'\n'
+            elif char == '|':
+                return r'\_'
+            else:
+                assert 0
+
+        return cls.ESCAPE.sub(escape, text)
+
     def _cleanup_spool(self):
         """Periodically clean up old things in the spool dir.
 
@@ -348,6 +395,266 @@ class NagiosCommander(object):
         reactor.callLater(60, reactor.callInThread, self._cleanup_spool)
 
 
+class CheckResultWriter(object):
+    """Write check results straight into Nagios' check_result_path.
+
+    This is the same format Nagios uses for its own active checks so
+    results skip the command pipe, where Nagios handles each
+    PROCESS_FILE command one at a time, and are instead reaped in
+    bulk along with everything else. Only service check results can
+    be submitted this way.
+    """
+
+    def __init__(self, check_result_path):
+        if not os.path.isdir(check_result_path):
+            raise errors.InitError(
+                    "Check result path %s is not a directory"
+                    % check_result_path)
+
+        self.path = check_result_path
+
+        # Result files being written by threads
+        self.pending = 0
+
+    def command(self, cmd_time, *args):
+        self.cmdlist(cmd_time, [args])
+
+    def cmdlist(self, cmd_time, cmd_list, force=False):
+        if not cmd_time:
+            cmd_time = time.time()
+
+        self.cmdbatch([(cmd_time, cmd) for cmd in cmd_list], force)
+
+    def cmdbatch(self, batch, force=False):
+        """Write a batch of results to a single file.
+
+        @param batch: a sequence of (timestamp, (commandname, arg1...))
+        @param force: write the file now rather than in a thread
+        """
+
+        if force:
+            self._threaded_write(batch, True)
+        else:
+            self.pending += 1
+            reactor.callInThread(self._threaded_write, batch)
+
+    def backlog(self):
+        return self.pending
+
+    def stats(self):
+        return {'pending': self.pending, 'queued': 0}
+
+    def _threaded_write(self, batch, force=False):
+        try:
+            # Nagios only reads files named 'c' plus six characters
+            # which happens to be what mkstemp gives us.
+            result_fd, result_path = tempfile.mkstemp(
+                    prefix='c', dir=self.path)
+            try:
+                try:
+                    assert len(os.path.basename(result_path)) == 7
+                    os.fchmod(result_fd, 0644)
+                    os.write(result_fd,
+                            "### Active Check Result File ###\n"
+                            "file_time=%d\n\n" % time.time())
+                    for cmd_time, cmd in batch:
+                        text = self._format_result(cmd_time, *cmd)
+                        log.trace("Writing Nagios check result: %s", text)
+                        os.write(result_fd, text)
+                finally:
+                    os.close(result_fd)
+
+                # Nagios ignores the file until the .ok file exists
+                os.close(os.open("%s.ok" % result_path,
+                        os.O_WRONLY | os.O_CREAT, 0644))
+            except:
+                os.unlink(result_path)
+                raise
+        finally:
+            if not force:
+                reactor.callFromThread(self._written)
+
+    def _written(self):
+        self.pending -= 1
+
+    def _format_result(self, cmd_time, cmd_name, *args):
+        assert cmd_name == 'PROCESS_SERVICE_CHECK_RESULT'
+        host_name, service_description, return_code, output = args
+
+        for arg in (host_name, service_description):
+            assert '\n' not in arg
+
+        # check_type 1 is a passive check, just like results
+        # submitted as PROCESS_SERVICE_CHECK_RESULT commands.
+        return ("### Nagcat Service Check Result ###\n"
+                "host_name=%s\n"
+                "service_description=%s\n"
+                "check_type=1\n"
+                "check_options=0\n"
+                "scheduled_check=0\n"
+                "reschedule_check=0\n"
+                "latency=0.0\n"
+                "start_time=%d.0\n"
+                "finish_time=%d.0\n"
+                "early_timeout=0\n"
+                "exited_ok=1\n"
+                "return_code=%d\n"
+                "output=%s\n\n" % (host_name, service_description,
+                    cmd_time, cmd_time, int(return_code),
+                    NagiosCommander.escape(output)))
+
+class ResultBatcher(object):
+    """Collect commands and submit them to Nagios in batches.
+
+    Every submission to NagiosCommander costs a thread pool job, a
+    spool file, and a PROCESS_FILE command that Nagios handles one at
+    a time. With thousands of results a minute it is much cheaper to
+    buffer them and submit each batch as one file. A batch is sent
+    once it reaches batch_size commands or the oldest command in it
+    has waited batch_delay seconds. While the commander is still
+    writing max_pending earlier batches the delay is extended so the
+    next batch grows instead of piling up more spool files.
+
+    Provides the same command() and cmdlist() methods as
+    NagiosCommander so the two are interchangeable.
+    """
+
+    def __init__(self, commander, batch_size=500, batch_delay=1.0,
+                 max_pending=2, clock=reactor):
+        self.commander = commander
+        self.clock = clock
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_pending = max_pending
+        self._buffer = []
+        self._timer = None
+
+        # Counters for stats()
+        self._batches = 0
+        self._commands = 0
+        self._largest = 0
+        self._size_flushes = 0
+        self._time_flushes = 0
+        self._delayed = 0
+
+    def command(self, cmd_time, *args):
+        self.cmdlist(cmd_time, [args])
+
+    def cmdlist(self, cmd_time, cmd_list, force=False):
+        if not cmd_time:
+            cmd_time = time.time()
+
+        for cmd in cmd_list:
+            self._buffer.append((cmd_time, cmd))
+
+        if force:
+            self.flush(True)
+        elif len(self._buffer) >= self.batch_size:
+            self._size_flushes += 1
+            self.flush()
+        elif not self._timer:
+            self._timer = self.clock.callLater(
+                    self.batch_delay, self._expired)
+
+    def _expired(self):
+        self._timer = None
+        if self.commander.backlog() >= self.max_pending:
+            self._delayed += 1
+            self._timer = self.clock.callLater(
+                    self.batch_delay, self._expired)
+        else:
+            self._time_flushes += 1
+            self.flush()
+
+    def flush(self, force=False):
+        """Submit all buffered commands now"""
+
+        if self._timer:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+
+        if not self._buffer:
+            return
+
+        batch = self._buffer
+        self._buffer = []
+        self._batches += 1
+        self._commands += len(batch)
+        self._largest = max(self._largest, len(batch))
+        self.commander.cmdbatch(batch, force)
+
+    def backlog(self):
+        return self.commander.backlog()
+
+    def stats(self):
+        data = {'buffered': len(self._buffer),
+                'batches': self._batches,
+                'commands': self._commands,
+                'largest': self._largest,
+                'size_flushes': self._size_flushes,
+                'time_flushes': self._time_flushes,
+                'delayed': self._delayed,
+                'batch_size': self.batch_size,
+                'batch_delay': self.batch_delay}
+        data.update(self.commander.stats())
+        return data
+
+def result_submitter(nagios_cfg, name, method="command_file",
+                     batch_size=500, batch_delay=1.0):
+    """Create a ResultBatcher for the chosen way of submitting results.
+
+    nagios_cfg is a ConfigParser with command_file and
+    check_result_path, name is used for the command file spool
+    directory and method is 'command_file' or 'check_result_path'.
+    Anything still buffered is written out when the reactor shuts
+    down.
+    """
+
+    if method == "check_result_path":
+        backend = CheckResultWriter(nagios_cfg['check_result_path'])
+        log.info("Using Nagios check result path: %s",
+                nagios_cfg['check_result_path'])
+    else:
+        assert method == "command_file"
+        spool = spool_path(nagios_cfg['check_result_path'], name)
+        backend = NagiosCommander(nagios_cfg['command_file'], spool)
+        log.info("Using Nagios command file: %s",
+                nagios_cfg['command_file'])
+
+    batcher = ResultBatcher(backend, batch_size, batch_delay)
+    reactor.addSystemEventTrigger('before', 'shutdown', batcher.flush, True)
+    return batcher
+
+class CommandPage(monitor_api.XMLPage):
+    """Batching of commands sent to Nagios"""
+
+    def __init__(self, batcher):
+        super(CommandPage, self).__init__()
+        self.batcher = batcher
+
+    def xml(self, request):
+        data = self.batcher.stats()
+        root = etree.Element("Commands", version="1.0",
+                batch_size=str(data['batch_size']),
+                batch_delay=str(data['batch_delay']))
+        etree.SubElement(root, "Buffered").text = str(data['buffered'])
+        etree.SubElement(root, "Batches").text = str(data['batches'])
+        etree.SubElement(root, "Commands").text = str(data['commands'])
+        etree.SubElement(root, "Largest").text = str(data['largest'])
+        etree.SubElement(root, "SizeFlushes").text = \
+                str(data['size_flushes'])
+        etree.SubElement(root, "TimeFlushes").text = \
+                str(data['time_flushes'])
+        # Backpressure: batches held back because Nagios is behind,
+        # spool files still being written, and PROCESS_FILE commands
+        # waiting for room in the pipe.
+        etree.SubElement(root, "Delayed").text = str(data['delayed'])
+        etree.SubElement(root, "Pending").text = str(data['pending'])
+        etree.SubElement(root, "Queued").text = str(data['queued'])
+        return root
+
+
 class NagiosXMLRPC(xmlrpc.XMLRPC):
     """A XMLRPC Protocol for Nagios"""
 
@@ -361,7 +668,8 @@ class NagiosXMLRPC(xmlrpc.XMLRPC):
 
         # object types we care about:
         types = ('host', 'service', 'hostgroup', 'servicegroup')
-        rawobjs = nagios_objects.ObjectParser(cfg['object_cache_file'], types)
+        rawobjs = nagios_objects.load_object_cache(
+                cfg['object_cache_file'], types)
 
         self._objects = dict([(x,{}) for x in types])
 
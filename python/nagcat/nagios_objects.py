@@ -14,18 +14,121 @@
 
 """Parsers for nagios config and object files"""
 
+import os
 import re
+import marshal
+import tempfile
+from cStringIO import StringIO
 
-from nagcat import errors
+from twisted.internet import defer, task, threads
+
+from nagcat import errors, log, _object_parser_py
 
 try:
-    from nagcat._object_parser_c import ObjectParser
+    from nagcat._object_parser_c import ObjectParser, iter_objects
 except ImportError:
-    from nagcat._object_parser_py import ObjectParser
+    from nagcat._object_parser_fast import ObjectParser, iter_objects
 
 # Make ObjectParser show in pydoc
 ObjectParser.__module__ == __name__
 
+# Identifies the snapshot format, bump if it ever changes
+SNAPSHOT_VERSION = ("nagcat-objects", 1, marshal.version)
+
+class ObjectSnapshot(_object_parser_py.ObjectParser):
+    """Objects loaded from a snapshot instead of parsed from text"""
+
+    def __init__(self, objects):
+        self._objects = objects
+        self._indexes = {}
+
+def _file_key(path):
+    info = os.stat(path)
+    return (info.st_ino, info.st_mtime, info.st_size)
+
+def load_object_cache(object_file, object_types=()):
+    """Parse Nagios' objects.cache, reusing a snapshot if possible.
+
+    Parsing the object cache of a large Nagios takes a good part of
+    the time nagcat needs to start. After parsing it the objects are
+    saved with marshal to object_file.nagcat along with the cache's
+    inode, mtime, and size. Later loads use the snapshot as long as
+    those still match so it is thrown out as soon as Nagios writes a
+    new cache. If the snapshot cannot be written, for example because
+    the directory isn't writable, the text is simply parsed each time.
+
+    The snapshot holds every object type so that callers asking for
+    different types can share it. That means a miss parses and keeps
+    all types even if object_types is given, so the first start after
+    Nagios writes a new cache is slower and briefly uses more memory
+    than parsing only the types needed.
+
+    Returns an ObjectSnapshot with the given types, or with all of
+    them if object_types is empty.
+    """
+
+    snapshot_file = "%s.nagcat" % object_file
+    try:
+        key = _file_key(object_file)
+    except OSError, ex:
+        raise errors.InitError(
+                "Failed to read Nagios object cache: %s" % ex)
+
+    objects = _read_snapshot(snapshot_file, key)
+    if objects is None:
+        parser = ObjectParser(object_file)
+        objects = dict((t, parser[t]) for t in parser.types())
+        # Only save it if Nagios didn't replace the file meanwhile
+        try:
+            if _file_key(object_file) == key:
+                _write_snapshot(snapshot_file, key, objects)
+        except OSError:
+            pass
+    else:
+        log.debug("Loaded Nagios objects from %s", snapshot_file)
+
+    if object_types:
+        objects = dict((t, objects.get(t, [])) for t in object_types)
+    return ObjectSnapshot(objects)
+
+def _read_snapshot(snapshot_file, key):
+    try:
+        fd = open(snapshot_file, 'rb')
+    except IOError:
+        return None
+
+    try:
+        try:
+            if marshal.load(fd) != (SNAPSHOT_VERSION, key):
+                return None
+            return marshal.load(fd)
+        except (EOFError, ValueError, TypeError), ex:
+            log.warn("Ignoring broken snapshot %s: %s", snapshot_file, ex)
+            return None
+    finally:
+        fd.close()
+
+def _write_snapshot(snapshot_file, key, objects):
+    directory = os.path.dirname(os.path.abspath(snapshot_file))
+    try:
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".nagcat")
+    except OSError, ex:
+        log.debug("Not saving Nagios objects snapshot: %s", ex)
+        return
+
+    try:
+        fd = os.fdopen(fd, 'wb')
+        try:
+            marshal.dump((SNAPSHOT_VERSION, key), fd)
+            marshal.dump(objects, fd)
+        finally:
+            fd.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, snapshot_file)
+    except (IOError, OSError), ex:
+        log.warn("Failed to save Nagios objects snapshot: %s", ex)
+        os.unlink(tmp)
+
 class ConfigParser(object):
     """Parser for the main nagios config file (nagios.cfg)"""
 
@@ -62,3 +165,118 @@ class ConfigParser(object):
 
     def keys(self):
         return self._config.keys()
+
+class StatusReader(object):
+    """Keep a parsed copy of Nagios' status.dat up to date.
+
+    On a large Nagios status.dat is tens of megabytes and is rewritten
+    every few seconds so parsing it when a query asks for it can block
+    the reactor for a long time. Instead the file is checked every
+    interval seconds and when it has changed a thread parses it and
+    builds the host and service indexes. The new parse then replaces
+    the old one in a single assignment so snapshot() always returns a
+    complete parse without waiting.
+
+    The thread reads the file normally with iter_objects() rather than
+    ObjectParser. The C ObjectParser parses a whole file in one call
+    without releasing the GIL, which would stall the reactor just as
+    long as parsing in the reactor thread. iter_objects() returns to
+    Python after each object so the reactor keeps running.
+    """
+
+    def __init__(self, status_file, object_types=('host', 'service'),
+                 interval=5):
+        self.status_file = status_file
+        self.object_types = object_types
+        self.interval = interval
+        self._snapshot = None
+        self._version = None
+        self._refresh_call = None
+        self._refreshing = None
+        self.parses = 0
+
+    def load(self):
+        """Parse the file now, used during startup"""
+
+        try:
+            version = self._stat()
+            self._set_snapshot(self._parse(), version)
+        except (EnvironmentError, errors.InitError), ex:
+            log.error("Failed to read Nagios status: %s", ex)
+
+    def start(self, now=False):
+        assert not self._refresh_call
+        self._refresh_call = task.LoopingCall(self.refresh)
+        self._refresh_call.start(self.interval, now=now)
+
+    def stop(self):
+        if self._refresh_call:
+            self._refresh_call.stop()
+            self._refresh_call = None
+
+    def running(self):
+        return self._refresh_call is not None
+
+    def snapshot(self):
+        """Get the most recent complete parse"""
+
+        if self._snapshot is None:
+            # Nothing has been read yet, act like the file is empty
+            return ObjectParser(StringIO(""), self.object_types)
+        return self._snapshot
+
+    def refresh(self):
+        """Parse the file in a thread if it has changed.
+
+        Returns a Deferred that fires once the new parse is in use.
+        """
+
+        # Don't pile up parses if they are slower than the interval
+        if self._refreshing:
+            return self._refreshing
+
+        try:
+            version = self._stat()
+        except OSError, ex:
+            log.warn("Failed to stat Nagios status: %s", ex)
+            return defer.succeed(None)
+
+        if version == self._version:
+            return defer.succeed(None)
+
+        refreshing = threads.deferToThread(self._parse)
+        refreshing.addCallbacks(self._set_snapshot, self._refresh_failed,
+                callbackArgs=(version,))
+        self._refreshing = refreshing
+        refreshing.addBoth(self._refresh_done)
+        return refreshing
+
+    def _refresh_done(self, result):
+        self._refreshing = None
+        return result
+
+    def _refresh_failed(self, result):
+        # Keep using the old copy, it is better than nothing
+        log.error("Failed to read Nagios status: %s", result.value)
+
+    def _stat(self):
+        # Nagios writes a new file and renames it into place so
+        # the inode changes even if the mtime and size do not.
+        info = os.stat(self.status_file)
+        return (info.st_ino, info.st_mtime, info.st_size)
+
+    def _parse(self):
+        objects = dict((t, []) for t in self.object_types)
+        for object_type, data in iter_objects(
+                self.status_file, self.object_types):
+            objects[object_type].append(data)
+
+        status = ObjectSnapshot(objects)
+        status.index('host', 'host_name')
+        status.index('service', 'host_name', 'service_description')
+        return status
+
+    def _set_snapshot(self, status, version):
+        self._snapshot = status
+        self._version = version
+        self.parses += 1
@@ -0,0 +1,149 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load aware placement of top level groups.
+
+By default the scheduler spreads the groups for each host over the
+first minute and then lets them drift. The Placement object instead
+remembers how long each group takes and how many tasks it runs and
+picks start offsets within each group's repeat interval so that the
+predicted number of running tasks stays as flat as possible.
+
+The model is deliberately simple: time is cut into buckets over a
+horizon as long as the longest repeat (capped at an hour) and each
+group adds its weight (the number of tasks it runs) to every bucket
+it is expected to be running in. Groups are placed one at a time,
+most expensive first, at the candidate offset that sees the least
+load. Exact results are not important, getting rid of the big spikes
+is.
+"""
+
+import math
+import random
+from collections import defaultdict
+
+class Placement(object):
+    """Pick start offsets for RunnableGroups"""
+
+    def __init__(self, resolution=1.0, horizon=3600,
+                 candidates=32, samples=4, alpha=0.3):
+        self.resolution = float(resolution)
+        self.horizon = horizon
+        self.candidates = candidates
+        self.samples = samples
+        self.alpha = alpha
+
+        self._duration = {}
+        self._weight = {}
+        self._started = {}
+        self._shift = {}
+
+    def weight(self, group):
+        """The number of tasks that run when group runs"""
+        try:
+            return self._weight[group]
+        except KeyError:
+            weight = len(group.getAllDependencies()) or 1
+            self._weight[group] = weight
+            return weight
+
+    def duration(self, group):
+        """Estimated run time of group, one bucket if unknown"""
+        return self._duration.get(group, self.resolution)
+
+    def record(self, group, started, duration):
+        """Record a run of group, durations are averaged (EWMA)"""
+        self._started[group] = started
+        if group in self._duration:
+            old = self._duration[group]
+            self._duration[group] = old + self.alpha * (duration - old)
+        else:
+            self._duration[group] = duration
+
+    def place(self, groups):
+        """Compute start offsets for groups.
+
+        Returns a dict of group -> offset in seconds, each offset is
+        within the group's repeat interval.
+        """
+
+        groups = [g for g in groups if g.repeat]
+        if not groups:
+            return {}
+
+        horizon = min(self.horizon, max(g.repeat for g in groups))
+        size = max(1, int(math.ceil(horizon / self.resolution)))
+        load = [0.0] * size
+        hosts = defaultdict(set)
+        offsets = {}
+
+        def cost(group):
+            return self.weight(group) * self.duration(group)
+
+        for group in sorted(groups, key=cost, reverse=True):
+            repeat = max(1, int(round(group.repeat / self.resolution)))
+            width = max(1, int(math.ceil(
+                    self.duration(group) / self.resolution)))
+            width = min(width, repeat)
+            weight = self.weight(group)
+            used = hosts[group.host]
+
+            # Check a limited number of offsets and occurrences,
+            # scoring every possible one gets expensive quickly.
+            step = max(1, repeat // self.candidates)
+            cycles = range(0, max(1, size // repeat))
+            if len(cycles) > self.samples:
+                cycles = random.sample(cycles, self.samples)
+
+            best = None
+            best_score = None
+            for offset in xrange(random.randrange(step), repeat, step):
+                score = 0.0
+                for cycle in cycles:
+                    start = offset + cycle * repeat
+                    for i in xrange(start, start + width):
+                        score = max(score, load[i % size])
+                if group.host is not None and offset % size in used:
+                    score += weight
+                if best is None or score < best_score:
+                    best = offset
+                    best_score = score
+
+            for start in xrange(best, size, repeat):
+                for i in xrange(start, start + width):
+                    load[i % size] += weight
+            used.add(best)
+
+            offsets[group] = best * self.resolution
+
+        return offsets
+
+    def respread(self, groups):
+        """Compute new offsets and remember how far each group must
+        be shifted to reach its offset. The shift is applied the
+        next time the group is rescheduled (see shift()).
+        """
+
+        offsets = self.place(groups)
+        for group, offset in offsets.iteritems():
+            if group not in self._started:
+                continue
+            phase = self._started[group] % group.repeat
+            self._shift[group] = (offset - phase) % group.repeat
+
+        return offsets
+
+    def shift(self, group):
+        """Get and clear the pending shift for group"""
+        return self._shift.pop(group, 0)
@@ -22,6 +22,10 @@ class INagcatPlugin(IPlugin):
 
     name = Attribute("Name of this plugin")
 
+# Scanning the plugin directory is slow and every query and filter
+# does a search during startup so remember what was found.
+_cache = {}
+
 _missing = object()
 def search(interface, name=None, default=_missing):
     """Search for a plugin providing a given interface.
@@ -32,12 +36,16 @@ def search(interface, name=None, default=_missing):
 
     assert issubclass(interface, INagcatPlugin)
 
-    found = {}
-    for cls in getPlugins(interface, plugins):
-        if cls.name is None:
-            continue
-        else:
-            found[cls.name] = cls
+    if interface in _cache:
+        found = _cache[interface]
+    else:
+        found = {}
+        for cls in getPlugins(interface, plugins):
+            if cls.name is None:
+                continue
+            else:
+                found[cls.name] = cls
+        _cache[interface] = found
 
     if name:
         if default is not _missing:
@@ -45,4 +53,4 @@ def search(interface, name=None, default=_missing):
         else:
             return found[name]
     else:
-        return found
+        return dict(found)
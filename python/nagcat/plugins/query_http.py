@@ -30,7 +30,7 @@ try:
 except ImportError:
     uuid = None
 
-from nagcat import errors, query
+from nagcat import errors, keepalive, query
 import coil
 
 
@@ -43,6 +43,9 @@ class HTTPQuery(query.Query):
     name = "http"
     port = 80
 
+    # SSL context, set by SSLMixin
+    context = None
+
     def __init__(self, nagcat, conf):
         super(HTTPQuery, self).__init__(nagcat, conf)
 
@@ -51,6 +54,7 @@ class HTTPQuery(query.Query):
         self.conf['port'] = int(conf.get('port', self.port))
         self.conf['path'] = conf.get('path', '/')
         self.conf['data'] = conf.get('data', None)
+        self.conf['keepalive'] = bool(conf.get('keepalive', False))
         headers = conf.get('headers', {})
         if headers:
             headers.expand()
@@ -93,6 +97,10 @@ class HTTPQuery(query.Query):
 
         self.conf['method'] = conf.get('method', method)
 
+        if self.conf['keepalive'] and not keepalive.available():
+            raise errors.InitError(
+                    "keepalive requires Twisted 15.0 or later")
+
         self.request_url = urlparse.urlunsplit((self.scheme,
                 self.headers_host, self.conf['path'], None, None))
 
@@ -105,6 +113,9 @@ class HTTPQuery(query.Query):
             self.saved['Request ID'] = request_id
             self.headers['X-Request-Id'] = request_id
 
+        if self.conf['keepalive']:
+            return self._start_keepalive()
+
         factory = HTTPClientFactory(url=self.conf['path'],
                 method=self.conf['method'], postdata=self.conf['data'],
                 headers=self.headers, agent=self.agent,
@@ -116,6 +127,18 @@ class HTTPQuery(query.Query):
         self._connect(factory)
         return factory.deferred
 
+    def _start_keepalive(self):
+        headers = InsensitiveDict({'User-Agent': self.agent})
+        headers.update(self.headers)
+        headers['Host'] = self.headers_host
+
+        d = keepalive.default.request(self.addr, self.conf['port'],
+                self.context, self.conf['method'], self.conf['path'],
+                headers, self.conf['data'], self.conf['timeout'])
+        d.addErrback(self._failure_tcp)
+        d.addErrback(self._failure_http)
+        return d
+
     @errors.callback
     def _failure_http(self, result):
         """Convert HTTP specific failures to a TestError"""
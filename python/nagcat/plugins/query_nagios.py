@@ -28,6 +28,10 @@ class HostQuery(query.Query):
     classProvides(query.IQuery)
 
     name = "host_status"
+
+    # The service description is part of the query
+    key_ignore = frozenset(('label', 'repeat', 'max_age'))
+
     _obj_type = "host"
 
     def __init__(self, nagcat, conf):
@@ -41,13 +45,13 @@ class HostQuery(query.Query):
 
     def _nagios_select(self):
         status = self._nagcat.nagios_status()
-        found = None
-        for host in status['host']:
-            if (host['host_name'] == self.host):
-                found = host
-                break
+        hosts = status.index('host', 'host_name')
+        found = hosts.get(self.host, None)
 
-        if not found:
+        if not hosts:
+            # Still waiting on the first parse of status.dat
+            raise errors.TestUnknown("Nagios status is not available yet")
+        elif not found:
             raise errors.TestCritical("No such host %s" % (self.host,))
 
         return found
@@ -95,12 +99,9 @@ class ServiceQuery(HostQuery):
 
     def _nagios_select(self):
         status = self._nagcat.nagios_status()
-        found = None
-        for service in status['service']:
-            if (service['service_description'] == self.conf['description']
-                    and service['host_name'] == self.host):
-                found = service
-                break
+        services = status.index('service',
+                'host_name', 'service_description')
+        found = services.get((self.host, self.conf['description']), None)
 
         if not found:
             raise errors.TestCritical("No such service %s/%s" %
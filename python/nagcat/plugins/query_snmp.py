@@ -36,10 +36,11 @@ class SNMPCommon(query.Query):
 
         # Unix sockets are used by the unit tests
         if protocol == 'unix':
+            self._peer = None
             self.conf['addr'] = 'unix:%s' % conf['path']
         else:
-            self.conf['addr'] = '%s:%s:%d' % (protocol,
-                    self.addr, int(conf.get('port', 161)))
+            self._peer = (protocol, int(conf.get('port', 161)))
+            self.conf['addr'] = self._peer_addr(self.addr)
 
         self.conf['version'] = str(conf.get('version', '2c'))
         if self.conf['version'] not in ('1', '2c'):
@@ -50,6 +51,14 @@ class SNMPCommon(query.Query):
         if not self.conf['community']:
             raise errors.ConfigError(conf, "SNMP community is required")
 
+    def _peer_addr(self, addr):
+        return '%s:%s:%d' % (self._peer[0], addr, self._peer[1])
+
+    def update_addr(self, addr):
+        if self._peer:
+            self.conf['addr'] = self._peer_addr(addr)
+        super(SNMPCommon, self).update_addr(addr)
+
     def check_oid(self, conf, key):
         """Check/parse an oid"""
         try:
@@ -245,8 +254,14 @@ class SNMPCombined(SNMPCommon):
         if self.conf['version'] == "1":
             self.conf['oids'] = self.oids
 
+        self.client = self._session()
+
+    def _session(self):
+        # The peer can't be changed on an existing session, remember
+        # which one we used so _start can replace it if needed.
+        self._session_addr = self.conf['addr']
         try:
-            self.client = SnmpSession(
+            return SnmpSession(
                     version=self.conf['version'],
                     community=self.conf['community'],
                     # Retry after 1 second for 'timeout' retries
@@ -263,6 +278,8 @@ class SNMPCombined(SNMPCommon):
 
     def _start(self):
         try:
+            if self._session_addr != self.conf['addr']:
+                self.client = self._session()
             self.client.open()
             if self.conf['walk']:
                 deferred = self.client.walk(self.oids, strict=True)
@@ -36,6 +36,9 @@ class LastUpdateQuery(query.Query):
 
     name = "rrd_lastupdate"
 
+    # The service description is part of the query
+    key_ignore = frozenset(('label', 'repeat', 'max_age'))
+
     def __init__(self, nagcat, conf):
         if not nagcat.trend:
             raise errors.InitError("rrdtool support is disabled")
@@ -18,44 +18,114 @@ All requests are defined as a Query class which is a Runnable.
 """
 
 import errno
+import hashlib
+from collections import defaultdict
 
 from twisted.internet import defer, reactor
 from twisted.internet import error as neterror
 
 try:
     from OpenSSL import SSL, crypto
-    from twisted.internet import ssl
 except ImportError:
     SSL = None
 
-from nagcat import errors, filters, log, plugin, runnable, util
+from coil import struct
+from nagcat import errors, filters, log, plugin, resolver, runnable
+from nagcat import sslcache, util
+
+def _canonical(value, ignore=()):
+    """Convert a query config to nested tuples with a stable repr.
+
+    Raises ValueError if it contains anything but plain values, such as
+    links that have not been expanded yet.
+    """
+
+    if isinstance(value, (struct.Struct, dict)):
+        return tuple(sorted((key, _canonical(val))
+                            for key, val in value.iteritems()
+                            if key not in ignore))
+    elif isinstance(value, list):
+        return [_canonical(val) for val in value]
+    elif value is None or isinstance(value,
+            (basestring, int, long, float, bool)):
+        return value
+    else:
+        raise ValueError("%r is not a plain value" % value)
 
 class QueryManager(object):
+    """Create Query objects, reusing identical ones.
+
+    Queries are identified by a digest of str(qobj) (their conf) but
+    that is only known after a query has been built. Many tests share
+    exactly the same query config so a second index keyed on a digest
+    of the config itself lets duplicates skip construction entirely.
+    """
 
     def __init__(self, nagcat):
         self._nagcat = nagcat
         self._queries = {}
+        self._configs = {}
 
-    def new_query(self, conf, qcls=None):
-        """Create a new query and register it or return an existing one"""
+        # query name -> [hits, misses] of old results, see start()
+        self.reuse_stats = defaultdict(lambda: [0, 0])
+
+    def query_class(self, conf, qcls=None):
+        """Find the correct Query class for this config"""
 
-        # Find the correct Query class for this type
         if not qcls:
             qtype = conf.get('type')
             qcls = plugin.search(IQuery, qtype, None)
             if not qcls:
                 raise errors.ConfigError(conf,
                         "Unknown query type '%s'" % qtype)
+        return qcls
+
+    def _config_key(self, conf, qcls):
+        """Digest of a query config, None if it can't be computed"""
+
+        conf.expand(recursive=False)
+        try:
+            ignore = qcls.ignored_keys(self, conf)
+            canon = _canonical(conf, ignore)
+        except (ValueError, errors.ConfigError):
+            return None
+
+        name = "%s.%s" % (qcls.__module__, qcls.__name__)
+        return hashlib.sha1(repr((name, canon))).digest()
+
+    def new_query(self, conf, qcls=None):
+        """Create a new query and register it or return an existing one"""
+
+        qcls = self.query_class(conf, qcls)
+
+        # Fast path, an identical config has already been seen.
+        # Only the repeat may differ, a faster repeat must go
+        # through update() for this query and its dependencies.
+        config_key = self._config_key(conf, qcls)
+        qobj = self._configs.get(config_key, None)
+        if qobj is not None:
+            try:
+                repeat = util.Interval(conf.get('repeat', '1m'))
+            except util.IntervalError:
+                repeat = None
+            if repeat is not None and repeat >= qobj.repeat:
+                log.debug("Reusing query %s", qobj)
+                return qobj
 
         qobj = qcls(self._nagcat, conf)
-        key = str(qobj)
+        key = hashlib.sha1(str(qobj)).digest()
         if key in self._queries:
-            log.debug("Reusing query '%s'", key)
+            log.debug("Reusing query %s", qobj)
             qobj = self._queries[key]
             qobj.update(conf)
         else:
-            log.debug("Adding query '%s'", key)
+            log.debug("Adding query %s", qobj)
             self._queries[key] = qobj
+            if qobj.addr_name:
+                resolver.default.watch(qobj.addr_name, qobj.update_addr)
+
+        if config_key is not None:
+            self._configs[config_key] = qobj
 
         return qobj
 
@@ -75,21 +145,41 @@ class Query(runnable.Runnable):
     Query objects are only used by SimpleTest objects.
     """
 
+    __slots__ = ('_admission', '_reuse_stats', 'conf', 'init_errors')
+
     type = "Query"
 
+    # Set to False for queries that don't do any real I/O
+    # to exempt them from the scheduler's admission control.
+    limited = True
+
+    # Config keys that never change what a query does, they are left
+    # out when looking for an identical config in QueryManager.
+    # Queries that use any of these (or look at @root) must override.
+    key_ignore = frozenset(('description', 'label', 'repeat', 'max_age'))
+
+    @classmethod
+    def ignored_keys(cls, manager, conf):
+        """Config keys to skip when identifying this config"""
+        return cls.key_ignore
+
     def __init__(self, nagcat, conf):
         super(Query, self).__init__(conf)
 
+        if self.limited:
+            self._admission = nagcat.admission
+        else:
+            self._admission = None
+
+        # [hits, misses] of old results, shared by queries of this type
+        self._reuse_stats = nagcat.query.reuse_stats[self.name]
+
         # self.conf must contain all configuration variables that
         # this object uses so identical Queries can be identified.
         self.conf = {}
 
-        # Used by the save filter and by queries to report any
-        # extra pieces of metadata such as Request ID/URL.
-        self.saved = {}
-
         # Semi-fatal init errors, forces query to UNKNOWN
-        self.init_errors = []
+        self.init_errors = ()
 
         # All queries should handle timeouts
         try:
@@ -104,13 +194,39 @@ class Query(runnable.Runnable):
                     "Invalid timeout value '%s'" % conf.get('timeout'))
 
     def _start_self(self):
-        self.saved.clear()
+        self.clearSaved()
         if self.init_errors:
             msg = '\n'.join(self.init_errors)
             return defer.fail(errors.Failure(errors.TestUnknown(msg)))
+        elif self._admission:
+            deferred = self._admission.acquire(self)
+            deferred.addCallback(lambda x: super(Query, self)._start_self())
+            deferred.addBoth(self._release)
+            return deferred
         else:
             return super(Query, self)._start_self()
 
+    def _count_start(self, reused):
+        if reused:
+            self._reuse_stats[0] += 1
+        else:
+            self._reuse_stats[1] += 1
+
+    def _release(self, result):
+        self._admission.release(self)
+        return result
+
+    def update_addr(self, addr):
+        """Switch to a new address for addr_name.
+
+        This is the one exception to never changing self.conf after
+        __init__, the query is still the same query, only the
+        address of the host has changed.
+        """
+        if self.conf.get('addr', None) == self.addr:
+            self.conf['addr'] = addr
+        super(Query, self).update_addr(addr)
+
     @errors.callback
     def _failure_tcp(self, result):
         """Catch common TCP failures and convert them to a TestError"""
@@ -185,8 +301,7 @@ class SSLMixin(Query):
                         "must be 'PEM' or 'ASN1'" % (opt, key_type))
             self.conf['ssl_%s_type'%opt] = key_type
 
-        def maybe_read(key, private=False):
-            filetype = self.conf[key+'_type']
+        def maybe_read(key):
             path = self.conf[key]
             if not path:
                 return None
@@ -200,33 +315,23 @@ class SSLMixin(Query):
                 finally:
                     fd.close()
             except IOError, ex:
-                self.init_errors.append("Failed to read %s file %s: %s" %
-                                        (key, path, ex.strerror))
+                self.init_errors += ("Failed to read %s file %s: %s" %
+                                     (key, path, ex.strerror),)
                 return None
 
             log.trace("Loaded %s:\n%s", key, data)
+            return data
 
-            if private:
-                return crypto.load_privatekey(filetype, data)
-            else:
-                return crypto.load_certificate(filetype, data)
-
+        # Queries with the same files share a context, and with it
+        # the sessions used to skip full handshakes with a server.
+        # Only the key and cert are used if both can be loaded.
         cacert = maybe_read('ssl_cacert')
-        if cacert:
-            cacert = [cacert]
-
-        # Only use both if we can load both
-        key = maybe_read('ssl_key', private=True)
+        key = maybe_read('ssl_key')
         cert = maybe_read('ssl_cert')
-        if not (key and cert):
-            key, cert = None, None
-
-        self.context = ssl.CertificateOptions(
-                privateKey=key, certificate=cert, caCerts=cacert,
-                verify=bool(cacert), method=SSL.SSLv23_METHOD)
-        # Use SSLv23 to support v3 and TLSv1 but disable v2 (below)
-        sslcontext = self.context.getContext()
-        sslcontext.set_options(SSL.OP_NO_SSLv2)
+        self.context = sslcache.default.context(
+                key, self.conf['ssl_key_type'],
+                cert, self.conf['ssl_cert_type'],
+                cacert, self.conf['ssl_cacert_type'])
 
     @errors.callback
     def _failure_tcp(self, result):
@@ -240,15 +345,30 @@ class SSLMixin(Query):
         return result
 
     def _connect(self, factory):
+        creator = self.context.creator(self.addr, self.conf['port'])
         reactor.connectSSL(self.addr, self.conf['port'],
-                factory, self.context, self.conf['timeout'])
+                factory, creator, self.conf['timeout'])
 
 class FilteredQuery(Query):
     """A query that wraps another query and applies filters to it"""
 
+    __slots__ = ('_filters', '_query')
+
     # For the scheduler stats
     name = "filter"
 
+    # Filters only process the wrapped query's result
+    limited = False
+
+    # max_age belongs to the filter, not the wrapped query
+    key_ignore = Query.key_ignore - frozenset(('max_age',))
+
+    @classmethod
+    def ignored_keys(cls, manager, conf):
+        # The wrapped query gets the same config
+        qcls = manager.query_class(conf)
+        return cls.key_ignore & qcls.ignored_keys(manager, conf)
+
     def __init__(self, nagcat, conf):
         super(FilteredQuery, self).__init__(nagcat, conf)
 
@@ -260,14 +380,26 @@ class FilteredQuery(Query):
             if expr:
                 filter_list.append("%s:%s" % (check, expr))
 
-        self._filters = [filters.Filter(self, x) for x in filter_list]
+        # How old of a result from the wrapped query is acceptable.
+        # This allows a test to share an expensive query with a test
+        # that has a faster repeat without running it at that rate.
+        if conf.get('max_age', None) is not None:
+            try:
+                self.max_age = util.Interval(conf['max_age']).seconds
+            except util.IntervalError, ex:
+                raise errors.ConfigError(conf, "Invalid max_age: %s" % ex)
+            self.conf['max_age'] = self.max_age
+
+        self._filters = tuple(filters.Filter(self, x) for x in filter_list)
         self._query = nagcat.new_query(conf)
         self.conf['filters'] = str(filter_list)
         self.conf['query'] = str(self._query)
         self.addDependency(self._query)
 
     def _start(self):
-        self.saved.update(self._query.saved)
+        saved = self._query.getSaved()
+        if saved:
+            self.saved.update(saved)
 
         deferred = defer.Deferred()
         deferred.callback(self._query.result)
@@ -0,0 +1,237 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cached host name resolution.
+
+Every Runnable with a host needs an address and looking each one up
+with a blocking gethostbyname() makes startup as slow as the sum of
+all DNS round trips. The Resolver keeps a cache of name -> address
+with a TTL, can fill that cache with many concurrent lookups before
+the objects are built, and once the reactor is running can
+periodically re-resolve names in the background. Objects that care
+about an address changing register a callback with watch().
+"""
+
+import time
+import socket
+
+from twisted.internet import defer, reactor, task
+
+try:
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    ThreadPool = None
+
+from nagcat import log
+
+def is_address(name):
+    """True if name is already a literal IPv4 or IPv6 address"""
+
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, name)
+        except (socket.error, ValueError, TypeError):
+            continue
+        else:
+            return True
+    return False
+
+def _lookup_safe(lookup, name):
+    """Wrapper for ThreadPool, errors are returned rather than raised"""
+    try:
+        return lookup(name), None
+    except socket.error, ex:
+        return None, ex
+
+class Resolver(object):
+    """Name to address cache"""
+
+    def __init__(self, ttl=300, workers=16):
+        self.ttl = ttl
+        self.workers = workers
+
+        # name -> (address, expires), expires is None for names
+        # resolved by resolve_many() until start() is called
+        self._cache = {}
+        # name -> list of callbacks
+        self._watchers = {}
+        self._refresh_call = None
+        self._refreshing = None
+
+        self._lookups = 0
+        self._hits = 0
+        self._changes = 0
+
+    def _lookup(self, name):
+        """Blocking lookup, only used before the reactor is running"""
+        return socket.gethostbyname(name)
+
+    def _lookup_async(self, name):
+        """Non-blocking lookup, returns a Deferred"""
+        return reactor.resolve(name)
+
+    def _store(self, name, addr, expires=True):
+        if expires:
+            self._cache[name] = (addr, time.time() + self.ttl)
+        else:
+            self._cache[name] = (addr, None)
+
+    def cached(self, name):
+        """Get the cached address for name or None if it has expired"""
+
+        entry = self._cache.get(name, None)
+        if entry and (entry[1] is None or entry[1] > time.time()):
+            return entry[0]
+        else:
+            return None
+
+    def lookup(self, name):
+        """Get the address for name, resolving it if it isn't cached.
+
+        Raises socket.error if the name cannot be resolved.
+        """
+
+        if is_address(name):
+            return name
+
+        addr = self.cached(name)
+        if addr is not None:
+            self._hits += 1
+            return addr
+
+        self._lookups += 1
+        addr = self._lookup(name)
+        self._store(name, addr)
+        return addr
+
+    def resolve_many(self, names):
+        """Resolve a batch of names concurrently and cache them.
+
+        This blocks until all lookups are done and is intended for
+        use during startup. The results don't expire until start()
+        is called, building the objects that use them may take longer
+        than the TTL and they shouldn't go back to looking up each
+        name one at a time. Returns a dict of name -> socket.error
+        for the names that failed.
+        """
+
+        names = [n for n in set(names)
+                 if not is_address(n) and self.cached(n) is None]
+        if not names:
+            return {}
+
+        log.info("Resolving %d host names", len(names))
+        start = time.time()
+
+        if ThreadPool is not None and self.workers > 1 and len(names) > 1:
+            pool = ThreadPool(min(self.workers, len(names)))
+            try:
+                results = pool.map(
+                        lambda n: _lookup_safe(self._lookup, n), names)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_lookup_safe(self._lookup, n) for n in names]
+
+        failed = {}
+        for name, (addr, error) in zip(names, results):
+            self._lookups += 1
+            if error is None:
+                self._store(name, addr, expires=False)
+            else:
+                failed[name] = error
+
+        log.info("Resolved %d host names in %.2f seconds",
+                len(names) - len(failed), time.time() - start)
+        return failed
+
+    def watch(self, name, callback):
+        """Call callback(addr) whenever name resolves to a new address"""
+
+        if is_address(name):
+            return
+        self._watchers.setdefault(name, []).append(callback)
+
+    def start(self, interval):
+        """Re-resolve watched names every interval seconds"""
+
+        assert not self._refresh_call
+
+        # Startup is over, the background refresh takes it from here
+        for name, (addr, expires) in self._cache.items():
+            if expires is None:
+                self._store(name, addr)
+
+        self._refresh_call = task.LoopingCall(self.refresh)
+        self._refresh_call.start(interval, now=False)
+
+    def stop(self):
+        if self._refresh_call:
+            self._refresh_call.stop()
+            self._refresh_call = None
+
+    def refresh(self):
+        """Resolve all watched names again without blocking.
+
+        Returns a Deferred that fires when all lookups are done.
+        """
+
+        # Don't pile up lookups if DNS is slower than the interval
+        if self._refreshing:
+            return self._refreshing
+
+        deferreds = []
+        for name in self._watchers:
+            self._lookups += 1
+            d = self._lookup_async(name)
+            d.addCallbacks(self._refreshed, self._refresh_failed,
+                    callbackArgs=(name,), errbackArgs=(name,))
+            deferreds.append(d)
+
+        refreshing = defer.DeferredList(deferreds)
+        self._refreshing = refreshing
+        refreshing.addBoth(self._refresh_done)
+        return refreshing
+
+    def _refresh_done(self, result):
+        self._refreshing = None
+        return result
+
+    def _refreshed(self, addr, name):
+        old = self._cache.get(name, (None, 0))[0]
+        self._store(name, addr)
+
+        if old is not None and old != addr:
+            log.info("Address of %s changed from %s to %s", name, old, addr)
+            self._changes += 1
+            for callback in self._watchers.get(name, ()):
+                try:
+                    callback(addr)
+                except Exception:
+                    log.error("Failed to update address of %s", name)
+
+    def _refresh_failed(self, result, name):
+        # Keep using the old address, it is better than nothing
+        log.warn("Failed to re-resolve %s: %s", name, result.value)
+
+    def stats(self):
+        return {'cached': len(self._cache),
+                'watched': len(self._watchers),
+                'lookups': self._lookups,
+                'hits': self._hits,
+                'changes': self._changes}
+
+# Shared by all Runnables
+default = Resolver()
@@ -12,21 +12,59 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
 import time
 import socket
+from array import array
 
 from twisted.internet import defer, reactor, task
 from twisted.python import failure
 from coil.struct import Struct
 
-from nagcat import errors, util, log
+from nagcat import errors, resolver, timing, util, log
+
+# Most runnables (every query at the bottom of the tree) never have
+# any dependencies so they all share this until the first one is added.
+_NO_DEPENDS = frozenset()
+
+def sizeof(obj):
+    """Approximate memory used by obj and the containers it owns"""
+
+    size = sys.getsizeof(obj)
+    values = []
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+        values.extend(obj.__dict__.itervalues())
+    for cls in type(obj).__mro__:
+        for slot in cls.__dict__.get('__slots__', ()):
+            if slot.startswith('__') and not slot.endswith('__'):
+                slot = "_%s%s" % (cls.__name__.lstrip('_'), slot)
+            value = getattr(obj, slot, None)
+            if value is not None:
+                values.append(value)
+
+    for value in values:
+        # Shared empty containers don't count
+        if value is _NO_DEPENDS or value is ():
+            continue
+        if isinstance(value, (dict, list, set, tuple, frozenset, array)):
+            size += sys.getsizeof(value)
+
+    return size
 
 class Runnable(object):
     """This class is used for starting various processing chunks such
     as tests and queries. Any child of this class will likely want to
     override _start to actually run its task.
+
+    There can be a very large number of these so all attributes are
+    declared in __slots__, subclasses should do the same.
     """
 
+    __slots__ = ('__depends', '_saved', '_private', '_timing', 'lastrun',
+                 'result', 'deferred', 'label', 'host', 'addr', 'addr_name',
+                 'repeat', 'max_age')
+
     # This defines how the monitor page reports this object
     type = "Runnable"
 
@@ -34,7 +72,10 @@ class Runnable(object):
     name = None
 
     def __init__(self, conf):
-        self.__depends = set()
+        self.__depends = _NO_DEPENDS
+        self._saved = None
+        self._timing = None
+        self.max_age = None
         self.lastrun = 0
         self.result = None
         self.deferred = None
@@ -51,16 +92,59 @@ class Runnable(object):
         except util.IntervalError, ex:
             raise errors.ConfigError(conf, "Invalid repeat: %s" % ex)
 
+        # addr may also be a name, usually one that was already
+        # resolved in bulk by the Nagios config loader. Names are
+        # kept in addr_name so the address can be updated later.
         if 'addr' in conf:
-            self.addr = conf['addr']
-        elif self.host:
+            addr = conf['addr']
+        else:
+            addr = self.host
+
+        if addr and not resolver.is_address(addr):
+            self.addr_name = addr
             try:
-                self.addr = socket.gethostbyname(self.host)
-            except socket.gaierror, ex:
+                self.addr = resolver.default.lookup(addr)
+            except socket.error, ex:
                 raise errors.InitError("Failed to resolve '%s': %s"
-                        % (self.host, ex))
+                        % (addr, ex))
         else:
-            self.addr = None
+            self.addr_name = None
+            self.addr = addr
+
+    def update_addr(self, addr):
+        """Called when addr_name resolves to a new address"""
+        self.addr = addr
+
+    def _get_saved(self):
+        if self._saved is None:
+            self._saved = {}
+        return self._saved
+
+    def _set_saved(self, saved):
+        self._saved = saved
+
+    saved = property(_get_saved, _set_saved, doc="""
+        Used by the save filter and by queries to report any extra
+        pieces of metadata such as Request ID/URL. The dict is only
+        created once something needs it.""")
+
+    def getSaved(self):
+        """Get the saved values without creating an empty dict"""
+        if self._saved is None:
+            return {}
+        return self._saved
+
+    def clearSaved(self):
+        self._saved = None
+
+    def getTiming(self, create=True):
+        """Get the array of timing.* counters for this object.
+
+        It is only created once the object is first started.
+        """
+        if self._timing is None and create:
+            self._timing = timing.new_record()
+        return self._timing
 
     def private(self):
         """True if this or any of its dependencies have a private config."""
@@ -84,40 +168,63 @@ class Runnable(object):
         """
         return defer.succeed(None)
 
-    def _start_dependencies(self):
+    def _start_dependencies(self, max_age=None):
         if self.__depends:
             log.debug("Starting dependencies for %s", self)
             deferlist = []
             for dep in self.__depends:
-                deferlist.append(dep.start())
+                deferlist.append(dep.start(max_age))
             return defer.DeferredList(deferlist)
         else:
             return defer.succeed(None)
 
     def _start_self(self):
         log.debug("Starting %s", self)
+        timing.default.ready(self)
         return task.deferLater(reactor, 0, self._start)
 
-    def start(self):
-        """Start a Runnable object"""
+    def start(self, max_age=None):
+        """Start a Runnable object.
+
+        max_age is the age in seconds of an old result the caller is
+        willing to accept instead, by default our repeat interval.
+        It is passed on to our dependencies unless we have our own.
+        """
+
+        if max_age is None:
+            reuse = self.repeat.seconds
+        else:
+            reuse = max_age
 
         # Don't start again if we are already running
         if self.deferred is not None:
+            self._count_start(True)
             return self.deferred
 
         # Reuse old results if our time isn't up yet
-        elif self.lastrun + self.repeat.seconds > time.time():
+        elif self.lastrun + reuse > time.time():
             log.debug("Skipping start of %s", self)
+            self._count_start(True)
+            timing.default.skipped(self)
             return defer.succeed(None)
 
         else:
+            self._count_start(False)
+            timing.default.started(self)
+            if self.max_age is not None:
+                max_age = self.max_age
+
             # use deferred instead of self.deferred because
             # __done could have been called already
-            self.deferred = deferred = self._start_dependencies()
+            self.deferred = deferred = self._start_dependencies(max_age)
             deferred.addBoth(lambda x: self._start_self())
             deferred.addBoth(self._done)
             return deferred
 
+    def _count_start(self, reused):
+        """Called by start() with True when an old result is reused"""
+        pass
+
     @errors.callback
     def _done(self, result):
         """Save the result, log unhandled errors"""
@@ -127,6 +234,7 @@ class Runnable(object):
         self.result = result
         self.lastrun = time.time()
         self.deferred = None
+        timing.default.finished(self, self.lastrun)
 
         if isinstance(result, failure.Failure):
             if isinstance(result.value, errors.TestError):
@@ -139,16 +247,22 @@ class Runnable(object):
 
     def addDependency(self, dep):
         """Declare that self depends on another Runnable"""
+        if self.__depends is _NO_DEPENDS:
+            self.__depends = set()
         self.__depends.add(dep)
 
     def addDependencies(self, group):
         """Add a group of dependencies at once"""
         if isinstance(group, Runnable):
             group = group.getDependencies()
+        if self.__depends is _NO_DEPENDS:
+            self.__depends = set()
         self.__depends.update(group)
 
     def delDependency(self, dep):
         """Remove a dependency"""
+        if self.__depends is _NO_DEPENDS:
+            raise KeyError(dep)
         self.__depends.remove(dep)
 
     def hasDependencies(self):
@@ -175,6 +289,8 @@ class RunnableGroup(Runnable):
     parent for a bunch of other Runnables that must start at the same time.
     """
 
+    __slots__ = ()
+
     type = "Group"
 
     def __init__(self, group, repeat):
@@ -29,24 +29,27 @@ Scheduling works as follows:
        This ensures that tests that need to run the same queries are
        run at the same time.
     4. All top level objects are started in a random interval between
-       now and their repeat interval to distribute things.
+       now and their repeat interval to distribute things. With
+       adaptive spreading enabled the start offsets are picked by
+       placement.Placement instead based on each group's cost.
     5. Each time a top level task finishes it will reschedule itself.
 """
 
 import time
 import random
 from collections import defaultdict, deque
-from itertools import chain
 
-from twisted.internet import defer, reactor, task
+from twisted.internet import defer, reactor
 
 try:
     from lxml import etree
 except ImportError:
     etree = None
 
-from nagcat import log, monitor_api, query, test, trend
-from nagcat.runnable import Runnable, RunnableGroup
+from nagcat import admission, histogram, log, monitor_api, placement, query
+from nagcat import keepalive, resolver, sslcache, stalls, test, timers
+from nagcat import timing, trend
+from nagcat.runnable import Runnable, RunnableGroup, sizeof
 
 class SchedulerPage(monitor_api.XMLPage):
     """Information on objects in the Nagcat scheduler"""
@@ -65,6 +68,82 @@ class SchedulerPage(monitor_api.XMLPage):
         etree.SubElement(lat, "Maximum").text = "%f" % data['latency']['max']
         etree.SubElement(lat, "Minimum").text = "%f" % data['latency']['min']
         etree.SubElement(lat, "Average").text = "%f" % data['latency']['avg']
+        for period, window in data['latency']['windows']:
+            win = etree.SubElement(lat, "Window", period=str(period),
+                    count=str(window['count']))
+            etree.SubElement(win, "Maximum").text = "%f" % window['max']
+            etree.SubElement(win, "Average").text = "%f" % window['avg']
+            for pct, value in window['percentiles']:
+                etree.SubElement(win, "Percentile",
+                        percent=str(pct)).text = "%f" % value
+
+        if 'stalls' in data:
+            st = data['stalls']
+            node = etree.SubElement(sch, "Stalls",
+                    count=str(st['stalls']), samples=str(st['samples']),
+                    interval=str(st['interval']))
+            for label, count, samples in st['sites']:
+                etree.SubElement(node, "Site", count=str(count),
+                        samples=str(samples),
+                        seconds="%f" % (samples * st['interval'])
+                        ).text = label
+
+        if 'admission' in data:
+            adm = data['admission']
+            queue = etree.SubElement(sch, "Admission")
+            etree.SubElement(queue, "Running").text = str(adm['running'])
+            etree.SubElement(queue, "Waiting").text = str(adm['waiting'])
+            etree.SubElement(queue, "Admitted").text = str(adm['admitted'])
+            etree.SubElement(queue, "Delayed").text = str(adm['delayed'])
+            etree.SubElement(queue, "WaitAverage",
+                    units="seconds").text = "%f" % adm['wait_avg']
+            etree.SubElement(queue, "WaitMaximum",
+                    units="seconds").text = "%f" % adm['wait_max']
+            for query_type, count in adm['types'].iteritems():
+                limit = adm['limits']['types'].get(query_type, 0)
+                etree.SubElement(queue, "Type", type=query_type,
+                        limit=str(limit)).text = str(count)
+
+        dns = data['resolver']
+        etree.SubElement(sch, "Resolver",
+                cached=str(dns['cached']),
+                watched=str(dns['watched']),
+                lookups=str(dns['lookups']),
+                hits=str(dns['hits']),
+                changes=str(dns['changes']))
+
+        pools = data['keepalive']
+        keep = etree.SubElement(sch, "KeepAlive",
+                pools=str(pools['pools']),
+                hits=str(pools['hits']),
+                misses=str(pools['misses']),
+                opened=str(pools['opened']),
+                idle=str(pools['idle']),
+                expired=str(pools['expired']))
+        for host in pools['hosts']:
+            etree.SubElement(keep, "Host",
+                    scheme=host['scheme'],
+                    addr=host['addr'],
+                    port=str(host['port']),
+                    hits=str(host['hits']),
+                    misses=str(host['misses']),
+                    opened=str(host['opened']),
+                    idle=str(host['idle']),
+                    active=str(host['active']),
+                    waiting=str(host['waiting']))
+
+        ssl = data['ssl']
+        etree.SubElement(sch, "SSL",
+                contexts=str(ssl['contexts']),
+                servers=str(ssl['servers']),
+                offered=str(ssl['offered']),
+                full=str(ssl['full']))
+
+        reuse = etree.SubElement(sch, "Reuse")
+        for query_type, counts in sorted(data['reuse'].iteritems()):
+            etree.SubElement(reuse, "Query", type=query_type,
+                    hits=str(counts['hits']),
+                    misses=str(counts['misses']))
 
         tasks = etree.SubElement(sch, 'Tasks',
                 count=str(data['tasks']['count']))
@@ -81,6 +160,144 @@ class SchedulerPage(monitor_api.XMLPage):
 
         return sch
 
+class TimingPage(monitor_api.XMLPage):
+    """Time spent on each type of task and the slowest queries"""
+
+    def __init__(self, scheduler):
+        super(TimingPage, self).__init__()
+        self.scheduler = scheduler
+
+    def xml(self, request):
+        root = etree.Element("Timing", version="1.0")
+
+        types = etree.SubElement(root, "Types")
+        for key, data in sorted(timing.default.stats().iteritems()):
+            node = etree.SubElement(types, "Type", type=key,
+                    runs=str(data['runs']), skips=str(data['skips']))
+            etree.SubElement(node, "Maximum").text = "%f" % data['max']
+            etree.SubElement(node, "Average").text = "%f" % data['avg']
+            etree.SubElement(node, "WaitAverage").text = \
+                    "%f" % data['wait_avg']
+            for pct, value in data['percentiles']:
+                etree.SubElement(node, "Percentile",
+                        percent=str(pct)).text = "%f" % value
+
+        queries, hosts = self.scheduler.slowest()
+
+        slow = etree.SubElement(root, "SlowestQueries")
+        for query, data in queries:
+            node = etree.SubElement(slow, "Query", type=str(query.name),
+                    host=str(query.host), runs=str(data['runs']),
+                    skips=str(data['skips']), total="%f" % data['total'],
+                    average="%f" % data['avg'], maximum="%f" % data['max'],
+                    last="%f" % data['last'])
+            node.text = str(query)
+
+        slow = etree.SubElement(root, "SlowestHosts")
+        for host, data in hosts:
+            etree.SubElement(slow, "Host", queries=str(data['count']),
+                    runs=str(data['runs']),
+                    total="%f" % data['total']).text = str(host)
+
+        return root
+
+class GroupIndex(object):
+    """Track which runnables must be grouped together.
+
+    Top level tasks that share any dependency, directly or not, must
+    be in the same RunnableGroup. This is a disjoint-set (union-find)
+    forest over all runnables, one forest per repeat value since only
+    tasks with the same repeat can be grouped. Registering a task only
+    walks dependencies that haven't been seen before in its forest so
+    building the index for N tasks is close to linear.
+    """
+
+    def __init__(self, merge):
+        # merge(group, extra_group) is called when two sets that each
+        # have a group are joined, extra_group is being dropped.
+        self._merge = merge
+        self._seen = set()
+        self._parent = defaultdict(dict)
+        self._size = defaultdict(dict)
+        self._groups = defaultdict(dict)
+
+    def __contains__(self, runnable):
+        return runnable in self._seen
+
+    def _find(self, parent, runnable):
+        root = runnable
+        while parent[root] is not root:
+            # path halving
+            parent[root] = parent[parent[root]]
+            root = parent[root]
+        return root
+
+    def _union(self, repeat, a, b):
+        parent = self._parent[repeat]
+        size = self._size[repeat]
+        groups = self._groups[repeat]
+
+        a = self._find(parent, a)
+        b = self._find(parent, b)
+        if a is b:
+            return
+
+        if size[a] < size[b]:
+            a, b = b, a
+
+        parent[b] = a
+        size[a] += size.pop(b)
+
+        a_group = groups.get(a, None)
+        b_group = groups.pop(b, None)
+        if a_group is None:
+            if b_group is not None:
+                groups[a] = b_group
+        elif b_group is not None:
+            self._merge(a_group, b_group)
+
+    def add(self, task):
+        """Add a top level task and all of its dependencies.
+
+        Returns a list of the runnables that were never seen before.
+        """
+
+        repeat = task.repeat
+        parent = self._parent[repeat]
+        size = self._size[repeat]
+        new = []
+
+        def add_one(runnable):
+            if runnable not in self._seen:
+                self._seen.add(runnable)
+                new.append(runnable)
+            if runnable in parent:
+                return False
+            parent[runnable] = runnable
+            size[runnable] = 1
+            return True
+
+        add_one(task)
+        stack = [task]
+        while stack:
+            runnable = stack.pop()
+            for dep in runnable.getDependencies():
+                if add_one(dep):
+                    stack.append(dep)
+                self._union(repeat, runnable, dep)
+
+        return new
+
+    def group(self, task):
+        """Get the group for task's set, or None"""
+        parent = self._parent[task.repeat]
+        return self._groups[task.repeat].get(self._find(parent, task))
+
+    def set_group(self, task, group):
+        parent = self._parent[task.repeat]
+        self._groups[task.repeat][self._find(parent, task)] = group
+
+
 class Scheduler(object):
     """Run things!"""
 
@@ -91,16 +308,27 @@ class Scheduler(object):
                  config=None,
                  rradir=None,
                  rrdcache=None,
+                 rrdapi=None,
                  monitor_port=None,
                  default_timeout=15,
+                 timer_wheel=False,
+                 max_queries=0,
+                 max_host_queries=0,
+                 max_type_queries=None,
+                 adaptive_spread=False,
+                 dns_refresh=0,
+                 stall_threshold=0,
+                 keepalive_idle=60,
+                 keepalive_max=2,
                  **kwargs):
 
         self._registered = set()
-        self._group_index = defaultdict(set)
+        self._group_index = GroupIndex(self._merge_groups)
         self._startup = True
         self._shutdown = None
         self._latency = deque([0], 60)
         self._latency_call = None
+        self._latency_hist = histogram.WindowedHistogram()
         self._task_stats = {
                 'count': 0,
                 'Group': {'count': 0},
@@ -111,14 +339,52 @@ class Scheduler(object):
         # Default timeout used by queries
         self.default_timeout = default_timeout
 
+        # Backend used to (re)schedule top level groups
+        if timer_wheel:
+            self._timer = timers.TimerWheel()
+        else:
+            self._timer = timers.ReactorTimer()
+
+        # Limits on the number of queries running at once
+        if max_queries or max_host_queries or max_type_queries:
+            self.admission = admission.AdmissionControl(
+                    max_queries, max_host_queries, max_type_queries)
+        else:
+            self.admission = None
+
+        # Load aware start offsets
+        if adaptive_spread:
+            self._placement = placement.Placement()
+            self._respread_time = 0
+        else:
+            self._placement = None
+
+        # Cached result of memory_usage()
+        self._memory_usage = None
+        self._memory_time = 0
+
+        # Seconds between background re-resolution of host names
+        self._dns_refresh = dns_refresh
+
+        # Limits for queries using persistent HTTP connections
+        keepalive.default.configure(keepalive_idle, keepalive_max)
+
+        # Report what the reactor was doing when it stalls
+        if stall_threshold:
+            self._stalls = stalls.StallSampler(stall_threshold)
+        else:
+            self._stalls = None
+
         if monitor_port:
             self._monitor_port = monitor_port
             self.monitor = monitor_api.MonitorSite()
             page = SchedulerPage(self)
             self.monitor.includeChild("scheduler", page)
+            self.monitor.addMemoryUsage("Tasks", self.memory_usage)
+            self.monitor.putChild("timing", TimingPage(self))
 
         if rradir:
-            self.trend = trend.TrendMaster(rradir, rrdcache)
+            self.trend = trend.TrendMaster(rradir, rrdcache, rrdapi)
 
         self.query = query.QueryManager(self)
 
@@ -145,37 +411,26 @@ class Scheduler(object):
 
         log.trace("Registering task %s", task)
 
-        task_deps = task.getAllDependencies()
-        all_groups = chain.from_iterable(self._group_index[d]
-                                         for d in task_deps)
-        groups = set(g for g in all_groups if g.repeat == task.repeat)
-
-        update_index = set(task_deps)
-        update_index.add(task)
+        for runnable in self._group_index.add(task):
+            self._update_stats(runnable)
 
-        if not groups:
+        group = self._group_index.group(task)
+        if group is None:
             group = RunnableGroup([task], task.repeat)
+            self._group_index.set_group(task, group)
             self._update_stats(group)
             self._registered.add(group)
             log.trace("Created group %s", group)
         else:
-            group = groups.pop()
             group.addDependency(task)
             log.trace("Updated group %s", group)
-            for extra_group in groups:
-                self._update_stats(extra_group, -1)
-                self._registered.remove(extra_group)
-                group.addDependencies(extra_group)
-                update_index.update(extra_group.getAllDependencies())
-                log.trace("Merged group %s", extra_group)
-
-        for runnable in update_index:
-            # If the group set is empty this runnable is new, count it.
-            if not self._group_index[runnable]:
-                self._update_stats(runnable)
-            # Add our selected group, discard extras
-            self._group_index[runnable].add(group)
-            self._group_index[runnable].difference_update(groups)
+
+    def _merge_groups(self, group, extra_group):
+        """Callback for GroupIndex, two groups now share a dependency"""
+        self._update_stats(extra_group, -1)
+        self._registered.remove(extra_group)
+        group.addDependencies(extra_group)
+        log.trace("Merged group %s", extra_group)
 
     def stats(self):
         """Get a variety of stats to report on"""
@@ -186,10 +441,69 @@ class Scheduler(object):
                 'max': max(self._latency),
                 'min': min(self._latency),
                 'avg': sum(self._latency) / len(self._latency),
+                'windows': [(period, self._latency_hist.window(period).stats())
+                            for period in (60, 900, 3600)],
             }
 
+        if self._stalls:
+            data['stalls'] = self._stalls.stats()
+
+        if self.admission:
+            data['admission'] = self.admission.stats()
+
+        data['resolver'] = resolver.default.stats()
+
+        data['keepalive'] = keepalive.default.stats()
+
+        data['ssl'] = sslcache.default.stats()
+
+        data['reuse'] = dict((name, {'hits': hits, 'misses': misses})
+                for name, (hits, misses)
+                in self.query.reuse_stats.iteritems())
+
         return data
 
+    def _all_tasks(self):
+        tasks = set(self._registered)
+        for group in self._registered:
+            tasks.update(group.getAllDependencies())
+        return tasks
+
+    def slowest(self, limit=20):
+        """Find the queries and hosts that used the most time.
+
+        Filters only wrap another query so they are left out.
+        """
+        queries = [t for t in self._all_tasks()
+                   if t.type == "Query" and t.name != "filter"]
+        return timing.slowest(queries, limit)
+
+    def memory_usage(self):
+        """Count the bytes used by each type of task.
+
+        Walking every task is slow so the result is reused for a while,
+        the set of tasks doesn't change after startup anyway.
+        """
+
+        now = time.time()
+        if self._memory_usage is not None and now - self._memory_time < 300:
+            return self._memory_usage
+
+        usage = defaultdict(lambda: (0, 0))
+        for task in self._all_tasks():
+            if task.name:
+                keys = (task.type, "%s:%s" % (task.type, task.name))
+            else:
+                keys = (task.type,)
+            size = sizeof(task)
+            for key in keys:
+                count, total = usage[key]
+                usage[key] = (count + 1, total + size)
+
+        self._memory_usage = dict(usage)
+        self._memory_time = now
+        return self._memory_usage
+
     def _update_stats(self, runnable, inc=1):
         """Record a previously unknown runnable"""
 
@@ -234,11 +548,40 @@ class Scheduler(object):
 
         self._log_stats()
 
+        for runnable in self._registered:
+            runnable.finalize()
+
+        if self._placement:
+            self._start_placed()
+        else:
+            self._start_spread()
+
+        # Start latency self-checker
+        self._latency_call = reactor.callLater(1.0, self.latency, time.time())
+
+        if self._dns_refresh:
+            resolver.default.start(self._dns_refresh)
+
+        if self._stalls:
+            self._stalls.start()
+
+        log.info("Startup complete, running...")
+        return deferred
+
+    def _start_placed(self):
+        """Schedule all runnables using load aware offsets"""
+
+        offsets = self._placement.place(self._registered)
+        for runnable in self._registered:
+            self.schedule(runnable, offsets.get(runnable, 0))
+
+    def _start_spread(self):
+        """Schedule all runnables spread over the first minute"""
+
         # Collect runnables that query the same host so that we can
         # avoid hitting a host with many queries at once
         host_groups = {}
         for runnable in self._registered:
-            runnable.finalize()
             if runnable.host in host_groups:
                 host_groups[runnable.host].append(runnable)
             else:
@@ -258,23 +601,41 @@ class Scheduler(object):
                 self.schedule(runnable, delay)
                 delay += slot
 
-        # Start latency self-checker
-        self._latency_call = reactor.callLater(1.0, self.latency, time.time())
-
-        log.info("Startup complete, running...")
-        return deferred
-
     def schedule(self, runnable, delay=None):
         """(re)schedule a top level runnable"""
+        if not runnable.repeat:
+            log.error("Task %s has no repeat value.", runnable)
+            return
+
         if delay is None:
             delay = runnable.repeat
+            if self._placement:
+                delay += self._placement.shift(runnable)
+
+        log.debug("Scheduling %s in %s seconds.", runnable, delay)
+        deferred = self._timer.deferLater(delay,
+                self._start_runnable, runnable)
+        deferred.addBoth(lambda x: self.schedule(runnable))
+
+    def _start_runnable(self, runnable):
+        started = time.time()
+        deferred = runnable.start()
+        if self._placement:
+            deferred.addBoth(self._record_runnable, runnable, started)
+        return deferred
 
-        if not delay:
-            log.error("Task %s has no repeat value.", runnable)
-        else:
-            log.debug("Scheduling %s in %s seconds.", runnable, delay)
-            deferred = task.deferLater(reactor, delay, runnable.start)
-            deferred.addBoth(lambda x: self.schedule(runnable))
+    def _record_runnable(self, result, runnable, started):
+        # Only record real runs, not reused results
+        if runnable.lastrun >= started:
+            self._placement.record(runnable, started,
+                                   runnable.lastrun - started)
+        return result
+
+    def _respread(self):
+        """Shift groups to new offsets based on measured run times"""
+        log.info("Callback latency is high, re-spreading tasks.")
+        self._respread_time = time.time()
+        self._placement.respread(self._registered)
 
     def stop(self):
         """Stop the scheduler"""
@@ -284,6 +645,12 @@ class Scheduler(object):
             self._latency_call.cancel()
             self._latency_call = None
 
+        self._timer.stop()
+        resolver.default.stop()
+        keepalive.default.close()
+        if self._stalls:
+            self._stalls.stop()
+
         deferred = self._shutdown
         self._shutdown = None
         deferred.callback(None)
@@ -294,8 +661,15 @@ class Scheduler(object):
 
         latency = now - last - 1.0
         self._latency.append(latency)
+        self._latency_hist.record(latency, now)
 
         if latency > 5.0:
             log.error("Callback latency: %s" % latency)
         elif latency > 1.5:
             log.warn("Callback latency: %s" % latency)
+
+        # Try to fix sustained latency by moving things around,
+        # but no more than once every 10 minutes.
+        if (self._placement and now - self._respread_time > 600 and
+                sum(list(self._latency)[-10:]) / 10 > 1.0):
+            self._respread()
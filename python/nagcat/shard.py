@@ -0,0 +1,449 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run tests in several processes.
+
+A single reactor can only keep one core busy. With --processes N the
+main process becomes a Coordinator which starts N copies of nagcat as
+workers. Each worker only builds the tests for hosts whose address
+hashes to its shard so all the tests for a host, and the queries they
+share, end up in the same process. Workers talk to the coordinator
+over AMP on two extra pipes: check results and rrdcached updates are
+sent up to the coordinator, which owns the Nagios command pipe and the
+rrdcached connection, and the coordinator's monitor pages collect the
+same page from every worker.
+"""
+
+import os
+import time
+import zlib
+
+from twisted.internet import defer, protocol, reactor, stdio
+from twisted.protocols import amp
+from twisted.web import server
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from nagcat import errors, log, monitor_api, nagios_api, nagios_objects
+from nagcat import scheduler, trend
+
+# Extra file descriptors in each worker used for AMP
+FROM_WORKER = 3
+TO_WORKER = 4
+
+# AMP values are limited to 64k so pages are sent in pieces
+PAGE_CHUNK = 60000
+
+# Seconds to wait before replacing a worker that died
+RESPAWN_DELAY = 5
+
+# Seconds to wait for workers to exit before killing them
+STOP_TIMEOUT = 10
+
+def shard_of(key, count):
+    """Pick a shard for a key, usually a host address"""
+    return (zlib.crc32(str(key)) & 0xffffffff) % count
+
+class SubmitCommands(amp.Command):
+    """Worker -> coordinator: send commands to Nagios"""
+    arguments = [('time', amp.Integer()),
+                 ('commands', amp.ListOf(amp.ListOf(amp.String())))]
+    requiresAnswer = False
+
+class UpdateTrend(amp.Command):
+    """Worker -> coordinator: update an RRD via rrdcached"""
+    arguments = [('filename', amp.String()),
+                 ('time', amp.Float()),
+                 ('values', amp.ListOf(amp.String()))]
+    requiresAnswer = False
+
+class GetPage(amp.Command):
+    """Coordinator -> worker: fetch part of a monitor page"""
+    arguments = [('path', amp.String()),
+                 ('offset', amp.Integer())]
+    response = [('data', amp.String()),
+                ('size', amp.Integer())]
+
+def fetch_page(proto, path):
+    """Fetch a whole page from a worker, returns a Deferred string"""
+
+    chunks = []
+    def got(result):
+        chunks.append(result['data'])
+        size = sum(len(c) for c in chunks)
+        if result['data'] and size < result['size']:
+            deferred = proto.callRemote(GetPage, path=path, offset=size)
+            deferred.addCallback(got)
+            return deferred
+        return "".join(chunks)
+
+    deferred = proto.callRemote(GetPage, path=path, offset=0)
+    deferred.addCallback(got)
+    return deferred
+
+class WorkerProtocol(amp.AMP):
+    """The worker's end of the AMP connection"""
+
+    def __init__(self, worker):
+        amp.AMP.__init__(self)
+        self.worker = worker
+
+    @GetPage.responder
+    def get_page(self, path, offset):
+        data = self.worker.render(path, offset == 0)
+        return {'data': data[offset:offset+PAGE_CHUNK], 'size': len(data)}
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.worker.lost(reason)
+
+class WorkerCommander(object):
+    """Stand-in for NagiosCommander that sends commands to the coordinator"""
+
+    def __init__(self, proto):
+        self._proto = proto
+
+    def command(self, cmd_time, *args):
+        self.cmdlist(cmd_time, [args])
+
+    def cmdlist(self, cmd_time, cmd_list, force=False):
+        if not cmd_time:
+            cmd_time = time.time()
+
+        # The coordinator will truncate commands anyway, doing it
+        # here keeps large outputs under the AMP size limit.
+        limit = nagios_api.NagiosCommander.MAX_EXTERNAL_COMMAND_LENGTH
+        commands = []
+        for cmd in cmd_list:
+            cmd = [str(arg) for arg in cmd]
+            cmd[-1] = cmd[-1][:limit]
+            commands.append(cmd)
+
+        self._proto.callRemote(SubmitCommands,
+                time=int(cmd_time), commands=commands)
+
+def _rrd_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    else:
+        return str(value)
+
+class WorkerRRDAPI(object):
+    """Read RRDs directly but send updates to the coordinator"""
+
+    def __init__(self, proto, local=None):
+        self._proto = proto
+        if local is None:
+            local = trend.RRDTwistedAPI()
+        self._local = local
+
+    def update(self, filename, timestamp, values):
+        self._proto.callRemote(UpdateTrend, filename=filename,
+                time=float(timestamp),
+                values=[_rrd_value(v) for v in values])
+        return defer.succeed(None)
+
+    def __getattr__(self, name):
+        return getattr(self._local, name)
+
+class Worker(object):
+    """Everything a worker process needs to know about its shard"""
+
+    def __init__(self, index, count, rrdcache=None):
+        assert 0 <= index < count
+        self.index = index
+        self.count = count
+        self._rrdcache = rrdcache
+        self._proto = WorkerProtocol(self)
+        self._pages = {}
+        self._rendered = {}
+
+    def connect(self):
+        """Start talking to the coordinator"""
+        stdio.StandardIO(self._proto, stdin=TO_WORKER, stdout=FROM_WORKER)
+
+    def owns(self, key):
+        return shard_of(key, self.count) == self.index
+
+    def commander(self):
+        return WorkerCommander(self._proto)
+
+    def rrdapi(self):
+        """RRD API for TrendMaster, None if updates should be direct"""
+        if self._rrdcache and trend.rrdtool is not None:
+            return WorkerRRDAPI(self._proto)
+        else:
+            return None
+
+    def setup(self, nagcat):
+        """Add the pages the coordinator will ask for"""
+
+        memory = monitor_api.Memory()
+        memory.addUsage("Tasks", nagcat.memory_usage)
+        self.addPage("memory", memory)
+        self.addPage("scheduler", scheduler.SchedulerPage(nagcat))
+        self.addPage("timing", scheduler.TimingPage(nagcat))
+
+    def addPage(self, path, page):
+        self._pages[path] = page
+
+    def render(self, path, fresh=True):
+        """Render a page, reusing the last copy unless fresh is set"""
+
+        if fresh or path not in self._rendered:
+            page = self._pages[path]
+            self._rendered[path] = etree.tostring(page.xml(None))
+        return self._rendered[path]
+
+    def lost(self, reason):
+        if reactor.running:
+            log.error("Lost connection to the coordinator, exiting.")
+            reactor.stop()
+
+class _WorkerPipe(object):
+    """Transport for AMP over a worker's extra pipes"""
+
+    def __init__(self, process):
+        self._process = process
+
+    def write(self, data):
+        self._process.transport.writeToChild(TO_WORKER, data)
+
+    def writeSequence(self, data):
+        self.write("".join(data))
+
+    def loseConnection(self):
+        self._process.transport.closeChildFD(TO_WORKER)
+
+    def getPeer(self):
+        return "worker %d" % self._process.index
+
+    def getHost(self):
+        return "coordinator"
+
+class CoordinatorProtocol(amp.AMP):
+    """The coordinator's end of the AMP connection to one worker"""
+
+    def __init__(self, coordinator):
+        amp.AMP.__init__(self)
+        self.coordinator = coordinator
+
+    @SubmitCommands.responder
+    def submit_commands(self, time, commands):
+        self.coordinator.commander.cmdlist(time, commands)
+        return {}
+
+    @UpdateTrend.responder
+    def update_trend(self, filename, time, values):
+        self.coordinator.update_trend(filename, time, values)
+        return {}
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """A running worker as seen by the coordinator"""
+
+    def __init__(self, coordinator, index):
+        self.coordinator = coordinator
+        self.index = index
+        self.running = False
+        self.ended = defer.Deferred()
+        self.amp = CoordinatorProtocol(coordinator)
+        self._lock = defer.DeferredLock()
+        self._output = {1: "", 2: ""}
+
+    def connectionMade(self):
+        self.running = True
+        self.amp.makeConnection(_WorkerPipe(self))
+
+    def childDataReceived(self, fd, data):
+        if fd == FROM_WORKER:
+            self.amp.dataReceived(data)
+        elif fd in self._output:
+            # Workers log to stdout, pass complete lines to our log
+            lines = (self._output[fd] + data).split("\n")
+            self._output[fd] = lines.pop()
+            for line in lines:
+                log.write("%s\n" % line)
+
+    def processEnded(self, reason):
+        self.running = False
+        for fd, text in self._output.iteritems():
+            if text:
+                log.write("%s\n" % text)
+        self.amp.connectionLost(reason)
+        self.coordinator.worker_ended(self, reason)
+        self.ended.callback(None)
+
+    def fetch(self, path):
+        """Get a monitor page from this worker as an XML string"""
+        if not self.running:
+            return defer.fail(errors.Failure(
+                    errors.InitError("worker is not running")))
+        return self._lock.run(fetch_page, self.amp, path)
+
+class ShardedPage(monitor_api.XMLPage):
+    """The same page collected from every worker"""
+
+    def __init__(self, coordinator, path):
+        super(ShardedPage, self).__init__()
+        self.coordinator = coordinator
+        self.path = path
+
+    def render_GET(self, request):
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        deferred = self.coordinator.fetch(self.path)
+        deferred.addCallback(self._render, request, finished)
+        return server.NOT_DONE_YET
+
+    def _render(self, results, request, finished):
+        root = etree.Element("Shards", version="1.0")
+        for worker, (success, result) in results:
+            node = etree.SubElement(root, "Shard", index=str(worker.index),
+                    restarts=str(self.coordinator.restarts[worker.index]))
+            if worker.transport and worker.transport.pid:
+                node.set("pid", str(worker.transport.pid))
+            if success:
+                node.append(etree.fromstring(result))
+            else:
+                node.set("error", str(result.value))
+
+        if not finished:
+            request.write(etree.tostring(root, pretty_print=True))
+            request.finish()
+
+class Coordinator(object):
+    """Start, watch, and stop the worker processes"""
+
+    def __init__(self, count, argv, nagios_cfg, rrdcache=None,
+                 monitor_port=None, submit="command_file",
+                 batch_size=500, batch_delay=1.0):
+        self.count = count
+        self.restarts = [0] * count
+        self._argv = argv
+        # Workers get any relative paths from us, even after we
+        # have daemonized and moved to /
+        self._cwd = os.getcwd()
+        self._workers = [None] * count
+        self._stopping = False
+
+        cfg = nagios_objects.ConfigParser(nagios_cfg,
+                ('command_file', 'check_result_path'))
+        self.commander = nagios_api.result_submitter(cfg, 'nagcat',
+                submit, batch_size, batch_delay)
+
+        if rrdcache:
+            if trend.rrdtool is None:
+                raise errors.InitError(
+                        "The python module 'rrdtool' is not installed")
+            self._rrdapi = trend.RRDTwistedAPI()
+            deferred = self._rrdapi.open(rrdcache)
+            deferred.addCallback(lambda x:
+                    log.info("Connected to rrdcached on %s", rrdcache))
+            deferred.addErrback(lambda x:
+                    log.error("Failed to connect to rrdcached: %s" % x))
+        else:
+            self._rrdapi = None
+
+        if monitor_port:
+            self._monitor_port = monitor_port
+            self.monitor = monitor_api.MonitorSite()
+            for path in ("scheduler", "timing", "memory"):
+                self.monitor.putChild(path, ShardedPage(self, path))
+            self.monitor.includeChild("commands",
+                    nagios_api.CommandPage(self.commander))
+        else:
+            self.monitor = None
+
+    def start(self):
+        """Start all workers.
+
+        Returns a Deferred like Scheduler.start() but it never fires,
+        the coordinator runs until the reactor is stopped.
+        """
+
+        if self.monitor:
+            # The shard pages replace the combined /stat/scheduler
+            reactor.listenTCP(self._monitor_port, self.monitor)
+
+        log.info("Starting %d worker processes", self.count)
+        for index in xrange(self.count):
+            self._spawn(index)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        return defer.Deferred()
+
+    def _spawn(self, index):
+        if self._stopping:
+            return
+
+        worker = WorkerProcess(self, index)
+        argv = self._argv + ["--shard", "%d/%d" % (index, self.count)]
+        reactor.spawnProcess(worker, argv[0], argv, env=os.environ,
+                path=self._cwd, childFDs={0: 'w', 1: 'r', 2: 'r',
+                    FROM_WORKER: 'r', TO_WORKER: 'w'})
+        self._workers[index] = worker
+        log.info("Started worker %d, pid %s", index, worker.transport.pid)
+
+    def worker_ended(self, worker, reason):
+        if self._stopping:
+            log.info("Worker %d stopped", worker.index)
+            return
+
+        log.error("Worker %d exited unexpectedly: %s",
+                worker.index, reason.value)
+        self.restarts[worker.index] += 1
+        reactor.callLater(RESPAWN_DELAY, self._spawn, worker.index)
+
+    def update_trend(self, filename, timestamp, values):
+        if self._rrdapi is None:
+            log.error("Worker sent a trend update but there is no rrdcached")
+            return
+
+        def errcb(failure):
+            log.error("Update to %s failed: %s", filename, failure.value)
+
+        deferred = self._rrdapi.update(filename, timestamp, values)
+        deferred.addErrback(errcb)
+
+    def fetch(self, path):
+        """Get a page from every worker, see ShardedPage"""
+
+        workers = [w for w in self._workers if w is not None]
+        deferred = defer.DeferredList([w.fetch(path) for w in workers],
+                consumeErrors=True)
+        deferred.addCallback(lambda results: zip(workers, results))
+        return deferred
+
+    def stop(self):
+        """Ask all workers to exit, kill any that don't"""
+
+        self._stopping = True
+        running = [w for w in self._workers if w is not None and w.running]
+        for worker in running:
+            worker.transport.signalProcess('TERM')
+
+        def kill():
+            for worker in running:
+                if worker.running:
+                    log.warn("Killing worker %d", worker.index)
+                    worker.transport.signalProcess('KILL')
+
+        timeout = reactor.callLater(STOP_TIMEOUT, kill)
+        deferred = defer.DeferredList([w.ended for w in running])
+        deferred.addCallback(lambda x: timeout.active() and timeout.cancel())
+        return deferred
@@ -28,6 +28,19 @@ class ObjectDummy(defaultdict):
     def types(self):
         return self.keys()
 
+    def index(self, obj_type, *keys):
+        index = {}
+        for obj in self.get(obj_type, ()):
+            try:
+                if len(keys) == 1:
+                    value = obj[keys[0]]
+                else:
+                    value = tuple([obj[key] for key in keys])
+            except KeyError:
+                continue
+            index.setdefault(value, obj)
+        return index
+
 class NagcatDummy(scheduler.Scheduler):
     """For testing"""
 
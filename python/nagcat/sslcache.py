@@ -0,0 +1,150 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shared SSL client contexts and session resumption.
+
+Queries that use the same key, certificate and CA certificate share
+one ClientContext rather than each building their own. Sessions
+belong to a context so sharing it also lets every connection to a
+server offer the session from the last handshake with that server,
+which the server may accept in place of a full handshake.
+"""
+
+from zope.interface import implements
+
+try:
+    from OpenSSL import SSL, crypto
+    from twisted.internet import ssl
+except ImportError:
+    SSL = None
+
+try:
+    from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+except ImportError:
+    IOpenSSLClientConnectionCreator = None
+
+def _options(key, key_type, cert, cert_type, cacert, cacert_type):
+    if key:
+        key = crypto.load_privatekey(key_type, key)
+        cert = crypto.load_certificate(cert_type, cert)
+
+    if cacert:
+        cacert = [crypto.load_certificate(cacert_type, cacert)]
+
+    options = ssl.CertificateOptions(
+            privateKey=key, certificate=cert, caCerts=cacert,
+            verify=bool(cacert), method=SSL.SSLv23_METHOD)
+    # Use SSLv23 to support v3 and TLSv1 but disable v2 (below)
+    context = options.getContext()
+    context.set_options(SSL.OP_NO_SSLv2)
+    return options
+
+class SessionCreator(object):
+    """Creates connections to one server for connectSSL"""
+
+    if IOpenSSLClientConnectionCreator is not None:
+        implements(IOpenSSLClientConnectionCreator)
+
+    def __init__(self, context, server):
+        self.context = context
+        self.server = server
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        return self.context.connection(self.server)
+
+class ClientContext(object):
+    """One SSL context and the last session with each server"""
+
+    def __init__(self, options):
+        self.options = options
+
+        # (addr, port) -> [last connection, last usable session]
+        self._servers = {}
+        self.offered = 0
+        self.full = 0
+
+    def getContext(self):
+        return self.options.getContext()
+
+    def creator(self, addr, port):
+        """Get the context factory to give connectSSL for a server"""
+
+        if IOpenSSLClientConnectionCreator is None:
+            # Too old to create connections ourselves, no sessions.
+            return self.options
+        else:
+            return SessionCreator(self, (addr, port))
+
+    def connection(self, server):
+        """Create a new connection, resuming the last session if possible"""
+
+        connection = SSL.Connection(self.getContext(), None)
+
+        last = self._servers.get(server, None)
+        if last is None:
+            session = None
+        else:
+            # Only take the session from a completed handshake, with
+            # TLS 1.3 it may not arrive until after the handshake so
+            # don't look for it until the connection is done with.
+            session = last[1]
+            if last[0].get_peer_finished() is not None:
+                session = last[0].get_session() or session
+
+        if session is None:
+            self.full += 1
+        else:
+            connection.set_session(session)
+            self.offered += 1
+
+        self._servers[server] = [connection, session]
+        return connection
+
+class ContextCache(object):
+    """ClientContexts keyed by the key, cert and CA cert they use"""
+
+    def __init__(self):
+        self._contexts = {}
+
+    def context(self, key, key_type, cert, cert_type, cacert, cacert_type):
+        """Get the ClientContext for the given files.
+
+        key, cert and cacert are the contents of each file or None,
+        the key and cert are only used if both are given. The types
+        are crypto.FILETYPE_PEM or crypto.FILETYPE_ASN1. Raises
+        crypto.Error if anything can't be loaded.
+        """
+
+        if not (key and cert):
+            key, cert = None, None
+
+        index = (key, key_type, cert, cert_type, cacert, cacert_type)
+        context = self._contexts.get(index, None)
+        if context is None:
+            options = _options(*index)
+            context = self._contexts[index] = ClientContext(options)
+        return context
+
+    def clear(self):
+        self._contexts.clear()
+
+    def stats(self):
+        contexts = self._contexts.values()
+        return {'contexts': len(contexts),
+                'servers': sum(len(c._servers) for c in contexts),
+                'offered': sum(c.offered for c in contexts),
+                'full': sum(c.full for c in contexts)}
+
+# Shared by all SSL queries
+default = ContextCache()
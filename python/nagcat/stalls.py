@@ -0,0 +1,163 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Find out what is blocking the reactor.
+
+The scheduler's latency check can tell that the reactor was stuck but
+not what it was stuck on since by the time it runs again the offending
+callback has returned. StallSampler runs a small watchdog thread that
+notices when the reactor stops ticking and samples the reactor
+thread's stack while it is still stuck, counting samples per function.
+Stalls are logged by the reactor thread once it is running again.
+"""
+
+import os
+import sys
+import time
+import thread
+import threading
+
+from twisted.internet import reactor, task
+
+import nagcat
+from nagcat import log
+
+_nagcat_dir = os.path.dirname(os.path.abspath(nagcat.__file__))
+
+def frame_label(frame):
+    """Name the function responsible for a stack.
+
+    The innermost nagcat function is the most useful answer since the
+    frames below it are usually library code doing what it was asked,
+    if no nagcat code is on the stack use the innermost frame.
+    """
+
+    chosen = frame
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(_nagcat_dir):
+            chosen = frame
+            break
+        frame = frame.f_back
+
+    code = chosen.f_code
+    filename = code.co_filename
+    if filename.startswith(_nagcat_dir):
+        filename = "nagcat%s" % filename[len(_nagcat_dir):]
+    return "%s:%d:%s" % (filename, code.co_firstlineno, code.co_name)
+
+class StallSampler(object):
+    """Sample the reactor thread's stack while it is stalled"""
+
+    def __init__(self, threshold=1.0, interval=0.1, clock=reactor):
+        self.threshold = threshold
+        self.interval = interval
+        self._clock = clock
+        self._beat_call = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self._reactor_thread = None
+        self._last_beat = 0
+        self._stalled_since = None
+        self._lock = threading.Lock()
+
+        # label -> [stalls, samples]
+        self._sites = {}
+        # (label, beat) of stalls not logged yet
+        self._pending = []
+        self._stalls = 0
+        self._samples = 0
+
+    def start(self):
+        """Start sampling, must be called from the reactor thread"""
+
+        assert not self._thread
+        self._reactor_thread = thread.get_ident()
+        self._last_beat = time.time()
+        self._beat_call = task.LoopingCall(self._beat)
+        self._beat_call.clock = self._clock
+        self._beat_call.start(self.interval)
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._watch,
+                name="StallSampler")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        if self._beat_call:
+            self._beat_call.stop()
+            self._beat_call = None
+        if self._thread:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _beat(self):
+        self._last_beat = now = time.time()
+
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, []
+        finally:
+            self._lock.release()
+
+        for label, beat in pending:
+            log.debug("Reactor stalled for %.1f seconds in %s",
+                    now - beat, label)
+
+    def _watch(self):
+        while not self._stopping.isSet():
+            self._stopping.wait(self.interval)
+            if time.time() - self._last_beat > self.threshold:
+                frame = sys._current_frames().get(self._reactor_thread)
+                if frame is not None:
+                    self.sample(frame, self._last_beat)
+                del frame
+
+    def sample(self, frame, beat):
+        """Record one sample of a stalled stack.
+
+        beat is the time of the last reactor tick and identifies the
+        stall so a long stall counts once even with many samples.
+        """
+
+        label = frame_label(frame)
+        self._lock.acquire()
+        try:
+            site = self._sites.setdefault(label, [0, 0])
+            if self._stalled_since != beat:
+                self._stalled_since = beat
+                self._stalls += 1
+                site[0] += 1
+                self._pending.append((label, beat))
+            site[1] += 1
+            self._samples += 1
+        finally:
+            self._lock.release()
+
+    def stats(self, limit=20):
+        """Get the sites with the most stalled time"""
+
+        self._lock.acquire()
+        try:
+            sites = sorted(self._sites.iteritems(),
+                    key=lambda x: x[1][1], reverse=True)[:limit]
+            return {'stalls': self._stalls,
+                    'samples': self._samples,
+                    'interval': self.interval,
+                    'sites': [(label, stalls, samples)
+                              for label, (stalls, samples) in sites]}
+        finally:
+            self._lock.release()
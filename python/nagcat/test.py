@@ -72,6 +72,8 @@ Investigation:
 class BaseTest(runnable.Runnable):
     """Shared base between SimpleTest and Test"""
 
+    __slots__ = ('_port', '_now', '_filters')
+
     type = "Test"
 
     def __init__(self, conf):
@@ -80,8 +82,6 @@ class BaseTest(runnable.Runnable):
         self._port = conf.get('port', None)
         # used in return and report
         self._now = time.time()
-        # Used by the save filter and report
-        self.saved = {}
 
         # Create the filter objects
         filter_list = conf.get('filters', [])
@@ -91,11 +91,11 @@ class BaseTest(runnable.Runnable):
             if expr:
                 filter_list.append("%s:%s" % (check, expr))
 
-        self._filters = [filters.Filter(self, x) for x in filter_list]
+        self._filters = tuple(filters.Filter(self, x) for x in filter_list)
 
     def _start(self):
         # Subclasses must override this and fire the deferred!
-        self.saved.clear()
+        self.clearSaved()
 
         deferred = defer.Deferred()
 
@@ -117,6 +117,11 @@ class ChildError(errors.TestError):
 class Test(BaseTest):
     """Main test class"""
 
+    __slots__ = ('_nagcat', '_test', '_description', '_documentation',
+                 '_investigation', '_priority', '_url', '_subtests',
+                 '_warning_time_limit', '_compound', '_return',
+                 '_report_callbacks')
+
     def __init__(self, nagcat, conf):
         BaseTest.__init__(self, conf)
 
@@ -187,13 +192,14 @@ class Test(BaseTest):
                             "Unknown sub-query in return: %s" % ex)
         else:
             self._compound = False
+            self._return = None
             qconf = conf.get('query')
             self._addDefaults(qconf)
             self._subtests['query'] = nagcat.new_query(qconf,
                     qcls=query.FilteredQuery)
             self.addDependency(self._subtests['query'])
 
-        self._report_callbacks = []
+        self._report_callbacks = ()
 
     def _addDefaults(self, conf):
         """Add default values based on this test to a subtest config"""
@@ -203,7 +209,7 @@ class Test(BaseTest):
         conf.setdefault('repeat', str(self.repeat))
 
         if conf['host'] == self.host:
-            conf.setdefault('addr', self.addr)
+            conf.setdefault('addr', self.addr_name or self.addr)
 
     def _start(self):
         self._now = time.time()
@@ -250,20 +256,16 @@ class Test(BaseTest):
         """
 
         assert callable(func)
-        self._report_callbacks.append((func, args, kwargs))
+        self._report_callbacks += ((func, args, kwargs),)
 
     def _apply_time_limit(self, state):
         if not self._warning_time_limit or state != "WARNING":
             return state
 
         status = self._nagcat.nagios_status()
-
-        found = None
-        for service in status['service']:
-            if (service['service_description'] == self._description
-                    and service['host_name'] == self.host):
-                found = service
-                break
+        services = status.index('service',
+                'host_name', 'service_description')
+        found = services.get((self.host, self._description), None)
 
         if not found:
             return state
@@ -350,7 +352,7 @@ class Test(BaseTest):
         results = {}
         for subname, subtest in self._subtests.iteritems():
             subextra = ""
-            for savedname, savedval in subtest.saved.iteritems():
+            for savedname, savedval in subtest.getSaved().iteritems():
                 subextra += "    %s:\n" % savedname
                 subextra += indent(str(savedval), " "*8)
 
@@ -0,0 +1,225 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Timer backends used by the scheduler.
+
+The default backend simply hands every call to the reactor which keeps
+all pending calls in a heap. That is fine for a few thousand tasks but
+every insertion pays for the size of the heap so with many thousands
+of top level groups it starts to show up in profiles.
+
+TimerWheel is an alternative backend that buckets calls into slots of a
+hierarchical wheel and only keeps a single call in the reactor which
+fires once per slot. Inserting or cancelling a call is O(1) no matter
+how many calls are pending, the cost is that calls are only accurate
+to the wheel's resolution.
+"""
+
+import math
+
+from twisted.internet import defer, reactor, task
+from twisted.python import failure
+
+from nagcat import log
+
+class ReactorTimer(object):
+    """Schedule calls directly in the reactor (the classic behavior)"""
+
+    def __init__(self, clock=reactor):
+        self._clock = clock
+
+    def callLater(self, delay, func, *args, **kwargs):
+        return self._clock.callLater(delay, func, *args, **kwargs)
+
+    def deferLater(self, delay, func, *args, **kwargs):
+        return task.deferLater(self._clock, delay, func, *args, **kwargs)
+
+    def pending(self):
+        return len(self._clock.getDelayedCalls())
+
+    def stop(self):
+        pass
+
+class WheelCall(object):
+    """A pending call in a TimerWheel, similar to a DelayedCall"""
+
+    def __init__(self, wheel, tick, time, func, args, kwargs):
+        self._wheel = wheel
+        self.tick = tick
+        self.time = time
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.called = False
+        self.cancelled = False
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        assert self.active()
+        self.cancelled = True
+        self._wheel._cancelled(self)
+
+    def __repr__(self):
+        return "<WheelCall %s at %s>" % (self.func, self.time)
+
+class TimerWheel(object):
+    """A hierarchical timer wheel.
+
+    The wheel has a number of levels, each with 2**bits slots. Level 0
+    slots are resolution seconds wide, each level above is 2**bits
+    times wider than the one below it. Calls are placed in the lowest
+    level that can hold them and are cascaded down a level each time
+    the level below wraps around, just like the Linux kernel's timers.
+    Calls that are further out than the top level can hold are parked
+    in the top level and re-inserted when their slot comes up.
+    """
+
+    def __init__(self, resolution=0.5, bits=6, levels=4, clock=reactor):
+        assert resolution > 0
+        assert bits > 0 and levels > 0
+        self.resolution = float(resolution)
+        self._bits = bits
+        self._size = 1 << bits
+        self._mask = self._size - 1
+        self._levels = [[[] for i in xrange(self._size)]
+                        for l in xrange(levels)]
+        self._clock = clock
+        self._origin = clock.seconds()
+        self._tick = 0
+        self._count = 0
+        self._call = None
+        self._running = False
+
+    def _now_tick(self):
+        return int((self._clock.seconds() - self._origin) / self.resolution)
+
+    def callLater(self, delay, func, *args, **kwargs):
+        """Call func(*args, **kwargs) in delay seconds.
+
+        The call happens on the first wheel tick at or after delay.
+        """
+        assert delay >= 0
+
+        if not self._count:
+            # The wheel was idle, fast forward to the current time.
+            self._tick = max(self._tick, self._now_tick())
+
+        when = self._clock.seconds() + delay
+        tick = int(math.ceil((when - self._origin) / self.resolution))
+        tick = max(tick, self._tick + 1)
+
+        call = WheelCall(self, tick, when, func, args, kwargs)
+        self._insert(call)
+        self._count += 1
+
+        if self._call is None and not self._running:
+            self._schedule()
+
+        return call
+
+    def deferLater(self, delay, func, *args, **kwargs):
+        """Same as twisted.internet.task.deferLater but using the wheel"""
+        deferred = defer.Deferred()
+        deferred.addCallback(lambda ignored: func(*args, **kwargs))
+        self.callLater(delay, deferred.callback, None)
+        return deferred
+
+    def pending(self):
+        return self._count
+
+    def stop(self):
+        """Stop ticking, all pending calls are dropped."""
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        for level in self._levels:
+            for slot in level:
+                del slot[:]
+        self._count = 0
+
+    def _insert(self, call):
+        diff = call.tick - self._tick
+        for index, level in enumerate(self._levels):
+            shift = self._bits * index
+            if diff < (1 << (shift + self._bits)):
+                break
+
+        # Either the level that can hold it or the top level
+        level[(call.tick >> shift) & self._mask].append(call)
+
+    def _cancelled(self, call):
+        # Cancelled calls are left in their slot and dropped when the
+        # slot is processed, that keeps cancel O(1).
+        self._count -= 1
+        if not self._count and self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _schedule(self):
+        next_time = self._origin + (self._tick + 1) * self.resolution
+        delay = max(0, next_time - self._clock.seconds())
+        self._call = self._clock.callLater(delay, self._run)
+
+    def _cascade(self):
+        """Move calls from upper levels down as lower levels wrap"""
+
+        for index in xrange(1, len(self._levels)):
+            shift = self._bits * index
+            # Only cascade this level if all levels below wrapped
+            if self._tick & ((1 << shift) - 1):
+                break
+
+            slot = self._levels[index][(self._tick >> shift) & self._mask]
+            calls = slot[:]
+            del slot[:]
+            for call in calls:
+                if not call.cancelled:
+                    self._insert(call)
+
+    def _run(self):
+        self._call = None
+        self._running = True
+        target = self._now_tick()
+
+        while self._count and self._tick < target:
+            self._tick += 1
+            self._cascade()
+
+            slot = self._levels[0][self._tick & self._mask]
+            if not slot:
+                continue
+
+            calls = slot[:]
+            del slot[:]
+            for call in calls:
+                if call.cancelled:
+                    continue
+                assert call.tick == self._tick
+                call.called = True
+                self._count -= 1
+                try:
+                    call.func(*call.args, **call.kwargs)
+                except:
+                    log.error("Unhandled error in timer call %s:\n%s" %
+                            (call, failure.Failure().getTraceback()))
+
+        self._tick = max(self._tick, target)
+        self._running = False
+        if self._count:
+            self._schedule()
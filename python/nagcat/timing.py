@@ -0,0 +1,161 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Track how long Runnables take.
+
+Each Runnable that has been started keeps a small array of doubles
+with its own counters and every (type, name) pair, such as
+("Query", "http"), has a TypeTiming with totals and a histogram of
+run durations. The time a Runnable spends waiting on its dependencies
+is counted separately from the time it spends running itself.
+"""
+
+import time
+from array import array
+
+from nagcat import histogram
+
+# Fields in each Runnable's array
+RUNS, SKIPS, STARTED, READY, LAST, TOTAL, MAX, WAIT = range(8)
+FIELDS = 8
+
+def new_record():
+    return array('d', [0.0]) * FIELDS
+
+class TypeTiming(object):
+    """Totals for one type of Runnable"""
+
+    __slots__ = ('runs', 'skips', 'wait', 'durations')
+
+    def __init__(self):
+        self.runs = 0
+        self.skips = 0
+        self.wait = 0.0
+        self.durations = histogram.Histogram()
+
+    def stats(self):
+        data = self.durations.stats()
+        data['runs'] = self.runs
+        data['skips'] = self.skips
+        if self.runs:
+            data['wait_avg'] = self.wait / self.runs
+        else:
+            data['wait_avg'] = 0.0
+        return data
+
+class Timing(object):
+    """Collects timing for all Runnables"""
+
+    def __init__(self):
+        # (type, name) -> TypeTiming
+        self._types = {}
+
+    def _type(self, runnable):
+        key = (runnable.type, runnable.name)
+        timing = self._types.get(key, None)
+        if timing is None:
+            timing = self._types[key] = TypeTiming()
+        return timing
+
+    def skipped(self, runnable):
+        """The lastrun + repeat check skipped a start"""
+        record = runnable.getTiming()
+        record[SKIPS] += 1
+        self._type(runnable).skips += 1
+
+    def started(self, runnable):
+        """Dependencies are starting"""
+        record = runnable.getTiming()
+        record[STARTED] = record[READY] = time.time()
+
+    def ready(self, runnable):
+        """Dependencies are done, the runnable itself is starting"""
+        record = runnable.getTiming()
+        record[READY] = time.time()
+
+    def finished(self, runnable, now):
+        record = runnable.getTiming()
+        duration = max(0.0, now - record[READY])
+        wait = max(0.0, record[READY] - record[STARTED])
+        record[RUNS] += 1
+        record[LAST] = duration
+        record[TOTAL] += duration
+        record[WAIT] += wait
+        if duration > record[MAX]:
+            record[MAX] = duration
+
+        timing = self._type(runnable)
+        timing.runs += 1
+        timing.wait += wait
+        timing.durations.record(duration)
+
+    def stats(self):
+        """Get {"type:name": stats} for every type seen so far"""
+
+        data = {}
+        for (rtype, name), timing in self._types.iteritems():
+            if name:
+                key = "%s:%s" % (rtype, name)
+            else:
+                key = rtype
+            data[key] = timing.stats()
+        return data
+
+    def reset(self):
+        self._types.clear()
+
+def record_stats(record):
+    """Summarize a Runnable's array as a dict"""
+
+    runs = record[RUNS]
+    if runs:
+        avg = record[TOTAL] / runs
+        wait_avg = record[WAIT] / runs
+    else:
+        avg = wait_avg = 0.0
+    return {'runs': int(runs), 'skips': int(record[SKIPS]),
+            'last': record[LAST], 'max': record[MAX],
+            'total': record[TOTAL], 'avg': avg, 'wait_avg': wait_avg}
+
+def slowest(runnables, limit=20):
+    """Find the runnables and hosts that took the most time.
+
+    Returns two lists sorted by total time, the first of
+    (runnable, stats) and the second of (host, stats).
+    """
+
+    tasks = []
+    hosts = {}
+    for runnable in runnables:
+        record = runnable.getTiming(create=False)
+        if record is None or not record[RUNS]:
+            continue
+        tasks.append((record[TOTAL], runnable, record))
+
+        host = hosts.setdefault(runnable.host, [0, 0.0, 0.0])
+        host[0] += 1
+        host[1] += record[RUNS]
+        host[2] += record[TOTAL]
+
+    tasks.sort(key=lambda x: x[0], reverse=True)
+    tasks = [(r, record_stats(rec)) for t, r, rec in tasks[:limit]]
+
+    hosts = sorted(hosts.iteritems(), key=lambda x: x[1][2], reverse=True)
+    hosts = [(h, {'count': c, 'runs': int(n), 'total': t})
+             for h, (c, n, t) in hosts[:limit]]
+
+    return tasks, hosts
+
+# Shared by all Runnables
+default = Timing()
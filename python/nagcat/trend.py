@@ -36,7 +36,7 @@ class MismatchError(errors.InitError):
 
 class TrendMaster(object):
 
-    def __init__(self, rradir, rrdcache=None):
+    def __init__(self, rradir, rrdcache=None, rrdapi=None):
         if rrdtool is None:
             raise errors.InitError(
                     "The python module 'rrdtool' is not installed")
@@ -59,13 +59,17 @@ class TrendMaster(object):
             log.error("Failed to connect to rrdcached: %s" % result)
 
         self._rradir = rradir
-        self._rrdapi = RRDTwistedAPI()
-        if rrdcache:
-            d = self._rrdapi.open(rrdcache)
-            d.addCallback(opened_ok)
-            d.addErrback(opened_fail)
+        if rrdapi is not None:
+            # Updates are handled elsewhere, see shard.WorkerRRDAPI
+            self._rrdapi = rrdapi
         else:
-            log.info("No rrdcached, updates will be direct.")
+            self._rrdapi = RRDTwistedAPI()
+            if rrdcache:
+                d = self._rrdapi.open(rrdcache)
+                d.addCallback(opened_ok)
+                d.addErrback(opened_fail)
+            else:
+                log.info("No rrdcached, updates will be direct.")
 
     def setup_test_trending(self, testobj, testconf):
         """Setup a Trend object for the given test."""
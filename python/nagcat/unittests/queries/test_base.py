@@ -107,3 +107,39 @@ class NoOpQueryTestCase(QueryTestCase):
         d = self.startQuery(type="noop", data="bogus data")
         d.addBoth(self.assertEquals, "bogus data")
         return d
+
+    def testMaxAge(self):
+        # A slow test's filter reuses the wrapped query's result
+        # while a fast test's filter without max_age runs it again.
+        fast = self.nagcat.new_query(Struct({
+                'type': "noop", 'data': "something", 'repeat': "1m"}),
+                qcls=query.FilteredQuery)
+        slow = self.nagcat.new_query(Struct({
+                'type': "noop", 'data': "something", 'repeat': "1m",
+                'max_age': "10m"}),
+                qcls=query.FilteredQuery)
+        self.assertNotIdentical(fast, slow)
+        inner = list(fast.getDependencies())[0]
+        self.assertEquals(list(slow.getDependencies()), [inner])
+
+        d = fast.start()
+        d.addCallback(self.endMaxAge, fast, slow, inner)
+        return d
+
+    def endMaxAge(self, result, fast, slow, inner):
+        stats = self.nagcat.query.reuse_stats
+        self.assertEquals(stats['noop'], [0, 1])
+
+        # Pretend the last run was 5 minutes ago
+        inner.lastrun -= 300
+        fast.lastrun = slow.lastrun = 0
+        d = slow.start()
+        d.addCallback(lambda x: self.assertEquals(stats['noop'], [1, 1]))
+        d.addCallback(lambda x: fast.start())
+        d.addCallback(lambda x: self.assertEquals(stats['noop'], [1, 2]))
+        return d
+
+    def testBadMaxAge(self):
+        config = Struct({'type': "noop", 'data': "x", 'max_age': "soon"})
+        self.assertRaises(errors.ConfigError,
+                query.FilteredQuery, self.nagcat, config)
@@ -12,10 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from twisted.trial import unittest
 from twisted.internet import reactor
 from nagcat.unittests.queries import QueryTestCase
 from nagcat.unittests import dummy_server
-from nagcat import errors
+from nagcat import errors, keepalive
 from coil.struct import Struct
 
 
@@ -48,6 +49,70 @@ class HTTPQueryTestCase(QueryTestCase):
     def tearDown(self):
         return self.server.loseConnection()
 
+class HTTPKeepAliveTestCase(HTTPQueryTestCase):
+
+    if not keepalive.available():
+        skip = "keepalive requires Twisted 15.0 or later"
+
+    def setUp(self):
+        super(HTTPKeepAliveTestCase, self).setUp()
+        self.config['keepalive'] = True
+
+    def testReuse(self):
+        def check(result):
+            self.assertEquals(result, "other\n")
+            stats = keepalive.default.stats()
+            self.assertEquals(stats['pools'], 1)
+            self.assertEquals(stats['hits'], 1)
+            self.assertEquals(stats['misses'], 1)
+            self.assertEquals(stats['opened'], 1)
+            self.assertEquals(stats['idle'], 1)
+
+        d = self.startQuery(self.config)
+        d.addCallback(lambda x: self.startQuery(self.config, path="other"))
+        d.addCallback(check)
+        return d
+
+    def testNotFound(self):
+        def check(result):
+            self.assertIsInstance(result, errors.Failure)
+            self.assertIsInstance(result.value, errors.TestCritical)
+            self.assertIn("404", str(result.value))
+
+        d = self.startQuery(self.config, path="missing")
+        d.addBoth(check)
+        return d
+
+    def testExpire(self):
+        pool = keepalive.KeepAlive(idle=60)
+        headers = {'Host': "localhost"}
+
+        def moved(result):
+            # Pretend a minute has passed and the host moved
+            for connections in pool._connections.itervalues():
+                connections.used -= 60
+            pool._expired -= 60
+            return pool.request("localhost", self.port, None, "GET",
+                                "/other", headers, None, 15)
+
+        def check(result):
+            self.assertEquals(result, "other\n")
+            stats = pool.stats()
+            self.assertEquals(stats['pools'], 1)
+            self.assertEquals(stats['expired'], 1)
+            self.assertEquals(stats['hosts'][0]['addr'], "localhost")
+
+        d = pool.request("127.0.0.1", self.port, None, "GET", "/",
+                         headers, None, 15)
+        d.addCallback(moved)
+        d.addCallback(check)
+        d.addBoth(lambda x: pool.close().addCallback(lambda y: x))
+        return d
+
+    def tearDown(self):
+        d = keepalive.default.close()
+        d.addCallback(lambda x: self.server.loseConnection())
+        return d
 
 class HTTPEmptyResponseTestCase(QueryTestCase):
     """Test handling of an empty response from an http request"""
@@ -66,6 +131,19 @@ class HTTPEmptyResponseTestCase(QueryTestCase):
         d.addBoth(self.assertIsInstance, errors.Failure)
         return d
 
+    def testEmptyKeepAlive(self):
+        if not keepalive.available():
+            raise unittest.SkipTest("keepalive is not available")
+
+        def check(result):
+            self.assertIsInstance(result, errors.Failure)
+            self.assertEquals(str(result.value), "Empty HTTP Response")
+
+        d = self.startQuery(self.config, keepalive=True)
+        d.addBoth(check)
+        d.addBoth(lambda x: keepalive.default.close())
+        return d
+
     def tearDown(self):
         return self.server.loseConnection()
 
@@ -52,3 +52,44 @@ class ManagerTestCase(unittest.TestCase):
                                            'repeat': '1m'}))
         self.assertTrue(q1 is q2)
         self.assertEquals(q1.repeat, util.Interval('1m'))
+
+    def testSkipBuild(self):
+        # An identical config is found before a new object is built
+        class Counted(query.Query):
+            built = 0
+            def __init__(self, nagcat, conf):
+                super(Counted, self).__init__(nagcat, conf)
+                self.conf['data'] = conf['data']
+                Counted.built += 1
+
+        for i in range(3):
+            self.nagcat.new_query(Struct({'data': 'q1',
+                                          'description': str(i)}),
+                                  qcls=Counted)
+        self.assertEquals(Counted.built, 1)
+
+    def testFilteredFaster(self):
+        # The wrapped query must pick up a faster repeat too
+        conf = {'type': 'noop', 'data': 'q1', 'critical': '> 1'}
+        f1 = self.nagcat.new_query(Struct(conf, repeat='1h'),
+                                   qcls=query.FilteredQuery)
+        f2 = self.nagcat.new_query(Struct(conf, repeat='1m'),
+                                   qcls=query.FilteredQuery)
+        self.assertTrue(f1 is f2)
+        for q in [f1] + list(f1.getDependencies()):
+            self.assertEquals(q.repeat, util.Interval('1m'))
+
+    def testConfigKey(self):
+        manager = self.nagcat.query
+        k1 = manager._config_key(Struct({'type': 'noop', 'data': '1',
+                                         'description': 'a'}),
+                                 query.Query)
+        k2 = manager._config_key(Struct({'type': 'noop', 'data': '1',
+                                         'description': 'b'}),
+                                 query.Query)
+        k3 = manager._config_key(Struct({'type': 'noop', 'data': 1}),
+                                 query.Query)
+        self.assertEquals(k1, k2)
+        self.assertNotEquals(k1, k3)
+        self.assertEquals(manager._config_key(
+                Struct({'data': object()}), query.Query), None)
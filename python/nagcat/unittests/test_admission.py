@@ -0,0 +1,95 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.trial import unittest
+from nagcat import admission
+
+class DummyQuery(object):
+
+    def __init__(self, host, name="tcp"):
+        self.host = host
+        self.name = name
+
+    def __repr__(self):
+        return "<DummyQuery %s %s>" % (self.name, self.host)
+
+class AdmissionTestCase(unittest.TestCase):
+
+    def start(self, control, query):
+        d = control.acquire(query)
+        d.addCallback(lambda x: self.started.append(query))
+        return d
+
+    def setUp(self):
+        self.started = []
+
+    def testUnlimited(self):
+        control = admission.AdmissionControl()
+        queries = [DummyQuery("a") for i in range(10)]
+        for q in queries:
+            self.start(control, q)
+        self.assertEquals(self.started, queries)
+        self.assertEquals(control.stats()['running'], 10)
+
+    def testTotal(self):
+        control = admission.AdmissionControl(max_total=2)
+        queries = [DummyQuery(str(i)) for i in range(4)]
+        for q in queries:
+            self.start(control, q)
+        self.assertEquals(self.started, queries[:2])
+        self.assertEquals(control.stats()['waiting'], 2)
+        control.release(queries[0])
+        self.assertEquals(self.started, queries[:3])
+        control.release(queries[1])
+        control.release(queries[2])
+        self.assertEquals(self.started, queries)
+        stats = control.stats()
+        self.assertEquals(stats['waiting'], 0)
+        self.assertEquals(stats['running'], 1)
+        self.assertEquals(stats['delayed'], 2)
+
+    def testHost(self):
+        control = admission.AdmissionControl(max_host=1)
+        a1, a2 = DummyQuery("a"), DummyQuery("a")
+        b1 = DummyQuery("b")
+        for q in (a1, a2, b1):
+            self.start(control, q)
+        self.assertEquals(self.started, [a1, b1])
+        control.release(a1)
+        self.assertEquals(self.started, [a1, b1, a2])
+
+    def testType(self):
+        control = admission.AdmissionControl(max_type={'snmp': 1})
+        s1, s2 = DummyQuery("a", "snmp"), DummyQuery("b", "snmp")
+        t1 = DummyQuery("c", "tcp")
+        for q in (s1, s2, t1):
+            self.start(control, q)
+        self.assertEquals(self.started, [s1, t1])
+        control.release(s1)
+        self.assertEquals(self.started, [s1, t1, s2])
+
+    def testFair(self):
+        # A host with a long queue shouldn't starve other hosts
+        control = admission.AdmissionControl(max_total=1)
+        first = DummyQuery("x")
+        self.start(control, first)
+        busy = [DummyQuery("a") for i in range(3)]
+        other = [DummyQuery("b"), DummyQuery("c")]
+        for q in busy + other:
+            self.start(control, q)
+
+        expect = [first, busy[0], other[0], other[1], busy[1], busy[2]]
+        for q in expect[:-1]:
+            control.release(q)
+        self.assertEquals(self.started, expect)
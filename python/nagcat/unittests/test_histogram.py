@@ -0,0 +1,101 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import time
+from twisted.trial import unittest
+from nagcat import histogram, stalls
+
+class HistogramTestCase(unittest.TestCase):
+
+    def testBuckets(self):
+        last = -1
+        for value in (0, 1, 31, 32, 33, 1000, 10**6, histogram.MAX_VALUE):
+            index = histogram._index(value)
+            self.assert_(index >= last)
+            self.assert_(index < histogram.BUCKETS)
+            upper = histogram._upper(index)
+            self.assert_(value <= upper)
+            # Error is bounded by the sub-bucket size
+            self.assert_(upper - value <= value / histogram.SUB_COUNT)
+            last = index
+
+    def testPercentiles(self):
+        hist = histogram.Histogram()
+        for i in xrange(1, 1001):
+            hist.record(i / 1000.0)
+        self.assertEquals(hist.count, 1000)
+        self.assertAlmostEquals(hist.average(), 0.5005)
+        self.assertAlmostEquals(hist.percentile(50), 0.5, 1)
+        self.assertAlmostEquals(hist.percentile(99), 0.99, 1)
+        self.assertEquals(hist.percentile(100), 1.0)
+        self.assert_(hist.percentile(50) >= 0.5)
+
+    def testEmpty(self):
+        hist = histogram.Histogram()
+        hist.record(-1)
+        self.assertEquals(hist.max, 0)
+        self.assertEquals(histogram.Histogram().percentile(99), 0)
+
+    def testWindows(self):
+        hist = histogram.WindowedHistogram(period=3600, slot=15)
+        hist.record(1.0, now=0)
+        hist.record(2.0, now=600)
+        hist.record(3.0, now=1000)
+        self.assertEquals(hist.window(60, now=1000).count, 1)
+        self.assertEquals(hist.window(900, now=1000).count, 2)
+        self.assertEquals(hist.window(3600, now=1000).count, 3)
+        self.assertEquals(hist.window(3600, now=1000).max, 3.0)
+
+        # Old slots are dropped as time moves on
+        self.assertEquals(hist.window(3600, now=3610).count, 2)
+        self.assertEquals(hist.window(3600, now=9000).count, 0)
+        hist.record(4.0, now=9000)
+        self.assertEquals(hist.window(60, now=9000).max, 4.0)
+
+class StallTestCase(unittest.TestCase):
+
+    def testLabel(self):
+        label = stalls.frame_label(sys._getframe())
+        self.assert_(label.startswith("nagcat/unittests/test_histogram.py"))
+        self.assert_(label.endswith(":testLabel"))
+
+    def testSample(self):
+        sampler = stalls.StallSampler()
+        frame = sys._getframe()
+        sampler.sample(frame, 1)
+        sampler.sample(frame, 1)
+        sampler.sample(frame, 2)
+        data = sampler.stats()
+        self.assertEquals(data['stalls'], 2)
+        self.assertEquals(data['samples'], 3)
+        self.assertEquals(data['sites'],
+                [(stalls.frame_label(frame), 2, 3)])
+
+        # Logging waits for the reactor thread's next beat
+        label = stalls.frame_label(frame)
+        self.assertEquals(sampler._pending, [(label, 1), (label, 2)])
+        sampler._beat()
+        self.assertEquals(sampler._pending, [])
+
+    def testBlocked(self):
+        sampler = stalls.StallSampler(threshold=0.1, interval=0.02)
+        sampler.start()
+        try:
+            time.sleep(0.5)
+        finally:
+            sampler.stop()
+        data = sampler.stats()
+        self.assertEquals(data['stalls'], 1)
+        self.assert_(data['sites'][0][0].endswith(":testBlocked"))
@@ -13,18 +13,23 @@
 # limitations under the License.
 
 from twisted.trial import unittest
+from twisted.enterprise import adbapi
 from nagcat import simple, merlin, scheduler
 from coil.struct import Struct
 import os
+import sqlite3
 import warnings
 
 try:
     import MySQLdb
 except ImportError:
-    skip = "MySQLdb is not available"
+    MySQLdb = None
 
 class TestNagcatMerlinCase(unittest.TestCase):
 
+    if MySQLdb is None:
+        skip = "MySQLdb is not available"
+
     _merlin_db_info = {
         'merlin_db_user': os.environ.get('MYSQL_USER', None),
         'merlin_db_host': os.environ.get('MYSQL_HOST', None),
@@ -76,6 +81,7 @@ class TestNagcatMerlinCase(unittest.TestCase):
             merlin_db_info=self._merlin_db_info)
         self.assertEquals(nagcatMerlin.get_peer_id_num_peers(),
             (0,2))
+        nagcatMerlin._peers_pool.close()
 
     def tearDown(self):
         db = MySQLdb.connect(
@@ -86,14 +92,73 @@ class TestNagcatMerlinCase(unittest.TestCase):
         curs = db.cursor()
         curs.execute("""DROP table merlin_peers;""")
 
+class TestMerlinPeersCase(unittest.TestCase):
+    """Peer list handling using sqlite in place of MySQL"""
+
+    def setUp(self):
+        path = self.mktemp()
+        self.db = sqlite3.connect(path)
+        self.db.execute("""create table merlin_peers(
+                name    varchar(70) NOT NULL PRIMARY KEY,
+                id      int(22),
+                sock    int(22),
+                type    int(1) NOT NULL,
+                state   int(22) NOT NULL,
+                peer_id int(22) NOT NULL);""")
+        self.db.execute("""insert into merlin_peers
+                values('localhost', 1, 1, 1, 3, 0);""")
+        self.db.execute("""insert into merlin_peers
+                values('otherhost', 1, 1, 1, 3, 1);""")
+        self.db.commit()
+
+        self.pool = adbapi.ConnectionPool("sqlite3", path,
+                check_same_thread=False, cp_min=1, cp_max=1)
+        self.nagcat = NagcatMerlinDummy(pool=self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+        self.db.close()
+
+    def testReadPeers(self):
+        self.assertEquals(merlin.read_peers(self.db.cursor()), (0, 2))
+        self.db.execute("""update merlin_peers set state=0
+                where name='localhost';""")
+        self.assertEquals(merlin.read_peers(self.db.cursor()), (None, 1))
+
+    def testInitial(self):
+        self.assertEquals(self.nagcat.get_peer_id_num_peers(), (0, 2))
+
+    def testRefresh(self):
+        self.db.execute("""update merlin_peers set peer_id=2
+                where name='localhost';""")
+        self.db.execute("""insert into merlin_peers
+                values('thirdhost', 1, 1, 1, 3, 0);""")
+        self.db.commit()
+
+        d = self.nagcat.refresh_peers()
+        # Tests keep using the old list until the read finishes
+        self.assertEquals(self.nagcat.get_peer_id_num_peers(), (0, 2))
+        self.assertIdentical(self.nagcat.refresh_peers(), d)
+        d.addCallback(lambda x: self.assertEquals(
+                self.nagcat.get_peer_id_num_peers(), (2, 3)))
+        return d
+
+    def testRefreshFailed(self):
+        self.db.execute("""drop table merlin_peers;""")
+        self.db.commit()
+
+        d = self.nagcat.refresh_peers()
+        d.addCallback(lambda x: self.assertEquals(
+                self.nagcat.get_peer_id_num_peers(), (0, 2)))
+        return d
+
 class NagcatMerlinDummy(merlin.NagcatMerlin):
     """For testing purposes."""
-    def __init__(self, merlin_db_info={}):
-        self._merlin_db_info = merlin_db_info
+    def __init__(self, merlin_db_info={}, pool=None):
         scheduler.Scheduler.__init__(self)
-        self._peer_id = None
-        self._num_rows = None
-        self._peer_id_timestamp = None
+        if pool is None:
+            pool = self._connect_pool(merlin_db_info)
+        self._init_peers(pool)
 
     def build_tests(self, config):
         return []
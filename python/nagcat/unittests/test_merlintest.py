@@ -16,6 +16,13 @@ from twisted.trial import unittest
 from nagcat import merlintest
 from coil.struct import Struct
 
+def key_for(peer_id, num_peers):
+    """Find a group key that belongs to the given peer"""
+    i = 0
+    while merlintest.jump_hash("group%d" % i, num_peers) != peer_id:
+        i += 1
+    return "group%d" % i
+
 class TestMerlinTestCase(unittest.TestCase):
 
     def testMerlinTestDontRun(self):
@@ -33,14 +40,15 @@ class TestMerlinTestCase(unittest.TestCase):
                     'return': "$(test-a) + $(test-b)",
                 },
             })
-        t = merlintest.MerlinTest(merlintest.NagcatMerlinTestDummy(), config, 1)
+        t = merlintest.MerlinTest(merlintest.NagcatMerlinTestDummy(), config)
+        t.setGroupKey(key_for(1, 2))
         d = t.start()
-        d.addBoth(self.endMerlinTestRun, t)
+        d.addBoth(self.endMerlinTestDontRun, t)
         return d
 
     def endMerlinTestDontRun(self, result, t):
-        assertEquals(result, None)
-        assertIsNone(t.result['output'])
+        self.assertEquals(result, None)
+        self.assertIdentical(t.result, None)
 
     def testMerlinTestRun(self):
         config = Struct({
@@ -57,7 +65,8 @@ class TestMerlinTestCase(unittest.TestCase):
                     'return': "$(test-a) + $(test-b)",
                 },
             })
-        t = merlintest.MerlinTest(merlintest.NagcatMerlinTestDummy(), config, 0)
+        t = merlintest.MerlinTest(merlintest.NagcatMerlinTestDummy(), config)
+        t.setGroupKey(key_for(0, 2))
         d = t.start()
         d.addBoth(self.endMerlinTestRun, t)
         return d
@@ -65,3 +74,24 @@ class TestMerlinTestCase(unittest.TestCase):
     def endMerlinTestRun(self, result, t):
         self.assertEquals(result, None)
         self.assertEquals(t.result['output'], '3')
+
+    def testMembership(self):
+        keys = ["host%d/service%d" % (i // 10, i) for i in xrange(10000)]
+
+        def assign(num_peers):
+            return [merlintest.jump_hash(k, num_peers) for k in keys]
+
+        three = assign(3)
+        four = assign(4)
+        for peer in range(4):
+            self.assert_(2000 < four.count(peer) < 3000)
+
+        # A peer joining only takes about 1/4 of the tests
+        moved = [(a, b) for a, b in zip(three, four) if a != b]
+        self.assert_(2000 < len(moved) < 3000)
+        self.assert_(all(b == 3 for a, b in moved))
+
+        # And leaving again only moves the tests it had
+        self.assertEquals(assign(3), three)
+        moved = sum(1 for a, b in zip(four, three) if a != b)
+        self.assertEquals(moved, four.count(3))
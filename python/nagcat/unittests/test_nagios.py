@@ -0,0 +1,96 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.trial import unittest
+from coil.struct import Struct
+from nagcat import errors, nagios, simple
+
+class TestConfTestCase(unittest.TestCase):
+
+    templates = Struct({
+            'a': {
+                'query': {
+                    'type': "compound",
+                    'one': {'type': "noop", 'data': "1"},
+                    'two': {'type': "noop", 'data': "2"},
+                    'return': "$(one) + $(two)",
+                },
+            },
+            'b': {
+                'query': {'type': "noop", 'data': "b"},
+                'critical': "!= b",
+            },
+        })
+
+    skels = [({'host': "host%d" % i, 'addr': "127.0.0.1",
+               'description': "test %d" % i},
+              {'test': t, 'repeat': "5m"})
+             for i in range(5) for t in ('a', 'b')]
+
+    def setUp(self):
+        nagios._worker_templates = self.templates
+
+    def tearDown(self):
+        nagios._worker_templates = None
+
+    def testMissing(self):
+        self.assertRaises(errors.InitError, nagios._make_testconf,
+                self.templates, {}, {'test': "c"})
+        self.assertEquals(nagios._expand_testconf(({}, {'test': "c"})),
+                          (None, None))
+
+    def testUnexpected(self):
+        testconf, error = nagios._expand_testconf(({}, {}))
+        self.assertEquals(testconf, None)
+        self.assertIn("KeyError", error)
+
+    def testOverrides(self):
+        conf = nagios._make_testconf(self.templates, *self.skels[0])
+        self.assertEquals(conf['host'], "host0")
+        self.assertEquals(conf['repeat'], "5m")
+        self.assertEquals(conf['query.type'], "compound")
+        # The template must not be modified
+        self.assertEquals(self.templates['a'].get('host'), None)
+
+    def testSameQueries(self):
+        serial = simple.NagcatDummy()
+        for skel in self.skels:
+            serial.new_test(nagios._make_testconf(self.templates, *skel))
+
+        workers = simple.NagcatDummy()
+        for skel in self.skels:
+            workers.new_test(Struct(nagios._expand_testconf(skel)[0]))
+
+        self.assertEquals(sorted(serial.query._queries),
+                          sorted(workers.query._queries))
+
+    def testPool(self):
+        if nagios.multiprocessing is None:
+            raise unittest.SkipTest("multiprocessing is not available")
+
+        skels = self.skels + [({}, {'test': "c"})]
+        expanded = nagios._expand_tests(self.templates, skels, 2)
+        self.assertEquals(len(expanded), len(skels))
+        self.assertEquals(expanded[-1], None)
+        self.assertIdentical(nagios._worker_templates, None)
+
+        serial = simple.NagcatDummy()
+        workers = simple.NagcatDummy()
+        for skel, testconf in zip(self.skels, expanded):
+            serial.new_test(nagios._make_testconf(self.templates, *skel))
+            workers.new_test(Struct(testconf))
+
+        self.assertNotEquals(len(serial.query._queries), 0)
+        self.assertEquals(sorted(serial.query._queries),
+                          sorted(workers.query._queries))
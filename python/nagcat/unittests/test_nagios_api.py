@@ -0,0 +1,159 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from twisted.trial import unittest
+from twisted.internet import reactor, task
+from nagcat import nagios_api
+
+class CommanderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        path = self.mktemp()
+        os.mkdir(path)
+        self.fifo = "%s/nagios.cmd" % path
+        os.mkfifo(self.fifo)
+        # Nagios' end of the pipe
+        self.reader = os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK)
+        self.commander = nagios_api.NagiosCommander(
+                self.fifo, "%s/spool" % path)
+
+    def tearDown(self):
+        self.commander.writer._close_file()
+        os.close(self.reader)
+
+    def checkSpool(self, expect):
+        submit = os.read(self.reader, 4096)
+        self.assert_(submit.startswith("[300] PROCESS_FILE;"))
+        spool = submit.split(';')[1]
+        self.assertEquals(open(spool).read(), expect)
+
+    def testBatch(self):
+        self.commander.cmdbatch([
+            (100, ('PROCESS_SERVICE_CHECK_RESULT', 'a', 'b', 0, 'ok')),
+            (300, ('PROCESS_SERVICE_CHECK_RESULT', 'a', 'c', 2, 'bad')),
+            ], force=True)
+        self.checkSpool("[100] PROCESS_SERVICE_CHECK_RESULT;a;b;0;ok\n"
+                        "[300] PROCESS_SERVICE_CHECK_RESULT;a;c;2;bad\n")
+
+    def testThreaded(self):
+        self.commander.cmdlist(300, [
+            ('PROCESS_SERVICE_CHECK_RESULT', 'a', 'b', 0, 'ok')])
+        self.assertEquals(self.commander.backlog(), 1)
+
+        def check():
+            if self.commander.backlog():
+                return task.deferLater(reactor, 0.01, check)
+            self.checkSpool("[300] PROCESS_SERVICE_CHECK_RESULT;a;b;0;ok\n")
+
+        return task.deferLater(reactor, 0.01, check)
+
+class DummyCommander(object):
+
+    def __init__(self):
+        self.batches = []
+        self.pending = 0
+
+    def cmdbatch(self, batch, force=False):
+        self.batches.append(batch)
+
+    def backlog(self):
+        return self.pending
+
+    def stats(self):
+        return {'pending': self.pending, 'queued': 0}
+
+class BatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.commander = DummyCommander()
+        self.batcher = nagios_api.ResultBatcher(self.commander,
+                batch_size=3, batch_delay=1.0, clock=self.clock)
+
+    def testSize(self):
+        for i in xrange(7):
+            self.batcher.command(i, 'PROCESS_SERVICE_CHECK_RESULT', i)
+        self.assertEquals(len(self.commander.batches), 2)
+        self.assertEquals(self.commander.batches[1][0],
+                (3, ('PROCESS_SERVICE_CHECK_RESULT', 3)))
+        self.assertEquals(self.batcher.stats()['buffered'], 1)
+
+        self.clock.advance(1.0)
+        self.assertEquals([len(b) for b in self.commander.batches],
+                [3, 3, 1])
+        stats = self.batcher.stats()
+        self.assertEquals(stats['size_flushes'], 2)
+        self.assertEquals(stats['time_flushes'], 1)
+        self.assertEquals(stats['commands'], 7)
+
+    def testBackpressure(self):
+        self.commander.pending = 2
+        self.batcher.command(1, 'PROCESS_SERVICE_CHECK_RESULT', 1)
+        self.clock.advance(1.0)
+        self.clock.advance(1.0)
+        self.assertEquals(self.commander.batches, [])
+        self.assertEquals(self.batcher.stats()['delayed'], 2)
+
+        self.commander.pending = 1
+        self.clock.advance(1.0)
+        self.assertEquals(len(self.commander.batches), 1)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testForce(self):
+        self.batcher.command(1, 'PROCESS_SERVICE_CHECK_RESULT', 1)
+        self.batcher.cmdlist(2, [('PROCESS_SERVICE_CHECK_RESULT', 2)],
+                force=True)
+        self.assertEquals(len(self.commander.batches), 1)
+        self.assertEquals(len(self.commander.batches[0]), 2)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+class CheckResultTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        os.mkdir(self.path)
+        self.writer = nagios_api.CheckResultWriter(self.path)
+
+    def testWrite(self):
+        self.writer.cmdbatch([
+            (100, ('PROCESS_SERVICE_CHECK_RESULT', 'a', 'b', 0, 'ok')),
+            (200, ('PROCESS_SERVICE_CHECK_RESULT', 'a', 'c', 2, 'x\n|y')),
+            ], force=True)
+
+        files = sorted(os.listdir(self.path))
+        self.assertEquals(len(files), 2)
+        self.assertEquals(len(files[0]), 7)
+        self.assert_(files[0].startswith("c"))
+        self.assertEquals(files[1], "%s.ok" % files[0])
+
+        text = open("%s/%s" % (self.path, files[0])).read()
+        results = text.split("\n\n")
+        self.assert_(results[0].startswith("### Active Check Result File"))
+        self.assertEquals(len(results), 4)
+        self.assertEquals(results[3], "")
+
+        first = dict(l.split("=", 1) for l in results[1].splitlines()[1:])
+        self.assertEquals(first['host_name'], "a")
+        self.assertEquals(first['service_description'], "b")
+        self.assertEquals(first['return_code'], "0")
+        self.assertEquals(first['finish_time'], "100.0")
+        self.assertEquals(first['output'], "ok")
+        self.assert_(results[2].endswith("return_code=2\noutput=x\\n\\_y"))
+
+    def testNotService(self):
+        self.assertRaises(AssertionError, self.writer.cmdbatch,
+                [(100, ('SCHEDULE_HOST_DOWNTIME', 'a', 1, 2, 1, 0, 0,
+                        'me', 'down'))], True)
+        self.assertEquals(os.listdir(self.path), [])
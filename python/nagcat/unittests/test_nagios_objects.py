@@ -12,9 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import re
+import time
 from twisted.trial import unittest
-from nagcat import nagios_objects, _object_parser_py
+from twisted.internet import task
+from nagcat import nagios_objects, _object_parser_py, _object_parser_fast
 
 try:
     from nagcat import _object_parser_c
@@ -25,7 +28,7 @@ except ImportError:
 class ModuleTestcase(unittest.TestCase):
 
     def testObjectParser(self):
-        expect = [_object_parser_py.ObjectParser]
+        expect = [_object_parser_fast.ObjectParser]
         if _object_parser_c:
             expect.append(_object_parser_c.ObjectParser)
         self.assertIn(nagios_objects.ObjectParser, expect)
@@ -33,7 +36,9 @@ class ModuleTestcase(unittest.TestCase):
 class ObjectsPyTestCase(unittest.TestCase):
 
     parser = _object_parser_py.ObjectParser
+    iter_objects = staticmethod(_object_parser_py.iter_objects)
     status = False
+    indent = "    "
 
     objects = {
             'host': [
@@ -84,10 +89,12 @@ class ObjectsPyTestCase(unittest.TestCase):
                 for attr, value in obj.iteritems():
                     value = self.escape(value)
                     if self.status:
-                        file_obj.write("    %s=%s\n" % (attr, value))
+                        file_obj.write("%s%s=%s\n" %
+                                (self.indent, attr, value))
                     else:
-                        file_obj.write("    %s %s\n" % (attr, value))
-                file_obj.write("    }\n")
+                        file_obj.write("%s%s %s\n" %
+                                (self.indent, attr, value))
+                file_obj.write("%s}\n" % self.indent)
         file_obj.close()
         return file_path
 
@@ -121,6 +128,60 @@ class ObjectsPyTestCase(unittest.TestCase):
                 'service': self.objects['service'][:1]}
         self.assertEquals(parsed, expect)
 
+    def testFields(self):
+        parser = self.parser(self.mkfile(self.objects),
+                object_fields=('host_name',))
+        self.assertEquals(parser['host'],
+                [{'host_name': 'host1'}, {'host_name': 'host2'}])
+        self.assertEquals(parser['service'],
+                [{'host_name': 'host1'}, {'host_name': 'host2'}])
+
+        # Attributes used to select objects are always kept
+        parser = self.parser(self.mkfile(self.objects),
+                object_types=('host',), object_select={'alias': "Host 2"},
+                object_fields=('host_name',))
+        self.assertEquals(self.todict(parser),
+                {'host': self.objects['host'][1:]})
+
+    def testIndex(self):
+        objects = dict(self.objects)
+        objects['service'] = objects['service'] + [
+                {'service_description': "Service 1",
+                 'host_name': 'host1', 'alias': "duplicate"},
+                {'service_description': "No host"}]
+        parser = self.parser(self.mkfile(objects))
+
+        hosts = parser.index('host', 'host_name')
+        self.assertEquals(sorted(hosts), ['host1', 'host2'])
+        self.assertEquals(hosts['host2'], self.objects['host'][1])
+        self.assertIdentical(parser.index('host', 'host_name'), hosts)
+
+        services = parser.index('service',
+                'host_name', 'service_description')
+        self.assertEquals(len(services), 2)
+        self.assertEquals(services['host1', "Service 1"],
+                self.objects['service'][0])
+        self.assertEquals(parser.index('contact', 'contact_name'), {})
+
+    def testIter(self):
+        parsed = {}
+        for obj_type, obj in self.iter_objects(self.mkfile(self.objects)):
+            parsed.setdefault(obj_type, []).append(obj)
+        self.assertEquals(parsed, self.objects)
+
+        objects = list(self.iter_objects(self.mkfile(self.objects),
+                object_types=('service',), object_select={'host_name':
+                "host2"}, object_fields=('service_description',)))
+        self.assertEquals(objects, [('service', {'host_name': 'host2',
+                'service_description': "Service 2"})])
+
+    def testIterLarge(self):
+        # Enough to span several chunks, including a } in values
+        hosts = [{'host_name': "host%d" % i, 'alias': "{Host %d}" % i}
+                 for i in xrange(10000)]
+        path = self.mkfile({'host': hosts})
+        objects = self.iter_objects(open(path))
+        self.assertEquals([obj for obj_type, obj in objects], hosts)
 
 class StatusPyTestCase(ObjectsPyTestCase):
 
@@ -129,11 +190,232 @@ class StatusPyTestCase(ObjectsPyTestCase):
 class ObjectsCTestCase(ObjectsPyTestCase):
     if _object_parser_c:
         parser = _object_parser_c.ObjectParser
+        iter_objects = staticmethod(_object_parser_c.iter_objects)
     else:
         skip = "C module missing"
 
 class StatusCTestCase(StatusPyTestCase):
     if _object_parser_c:
         parser = _object_parser_c.ObjectParser
+        iter_objects = staticmethod(_object_parser_c.iter_objects)
     else:
         skip = "C module missing"
+
+class ObjectsFastTestCase(ObjectsPyTestCase):
+
+    parser = _object_parser_fast.ObjectParser
+    iter_objects = staticmethod(_object_parser_fast.iter_objects)
+    indent = "\t"
+
+class StatusFastTestCase(ObjectsFastTestCase):
+
+    status = True
+
+class FastParserTestCase(unittest.TestCase):
+
+    def compare(self, text):
+        path = self.mktemp()
+        fd = open(path, 'w')
+        fd.write(text)
+        fd.close()
+
+        self.patch(_object_parser_fast, 'CHUNK_SIZE', 16)
+        expect = list(_object_parser_py.iter_objects(path))
+        self.assertEquals(list(_object_parser_fast.iter_objects(path)),
+                expect)
+        return expect
+
+    def testIrregular(self):
+        # Everything here differs from what Nagios writes in some way
+        # and must be parsed exactly like the line parser does.
+        objects = self.compare(
+                "# comment {\n"
+                "define host {\n"
+                "\thost_name\thost1\n"
+                "\talias  Host 1 \n"
+                "\tparents\n"
+                "\tnotes\t\n"
+                "\t}\n"
+                "define host {\n"
+                "\thost_name\thost2\n"
+                "\t\taddress\t\tlocalhost\n"
+                "\tdisplay name\tHost 2\n"
+                "\t}\n"
+                "define command {\n"
+                "    command_name check\n"
+                "    }\n"
+                "hoststatus {\n"
+                "\thost_name=host1\n"
+                "\tplugin_output=OK \n"
+                "\tperformance_data=time=1s\n"
+                "\tempty\n"
+                "\t}\n"
+                "servicestatus {\r\n"
+                "\thost_name=host1\r\n"
+                "\tlong_plugin_output=a\\nb\\\\n\\_\r\n"
+                "\t}\n"
+                "servicestatus {\n"
+                "\thost_name=host2\n")
+        # The last object is incomplete and dropped
+        self.assertEquals(len(objects), 5)
+        self.assertEquals(objects[4][1]['long_plugin_output'], "a\nb\\n|")
+
+class StatusReaderTestCase(unittest.TestCase):
+
+    def mkstatus(self, hosts):
+        tmp = "%s.tmp" % self.path
+        fd = open(tmp, 'w')
+        for host in hosts:
+            fd.write("hoststatus {\n    host_name=%s\n    }\n" % host)
+        fd.close()
+        os.rename(tmp, self.path)
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.mkstatus(["host1"])
+        self.reader = nagios_objects.StatusReader(self.path)
+
+    def testLoad(self):
+        self.assertEquals(self.reader.snapshot()['host'], [])
+        self.reader.load()
+        status = self.reader.snapshot()
+        self.assertEquals(status['host'], [{'host_name': "host1"}])
+        self.assertEquals(status['service'], [])
+
+    def testMissing(self):
+        os.unlink(self.path)
+        self.reader.load()
+        self.assertEquals(self.reader.snapshot()['host'], [])
+        return self.reader.refresh()
+
+    def testRefresh(self):
+        self.reader.load()
+        old = self.reader.snapshot()
+        self.mkstatus(["host1", "host2"])
+
+        d = self.reader.refresh()
+        self.assertIdentical(self.reader.snapshot(), old)
+
+        def check(result):
+            status = self.reader.snapshot()
+            self.assertEquals(sorted(status.index('host', 'host_name')),
+                    ["host1", "host2"])
+            self.assertEquals(self.reader.parses, 2)
+            # Nothing changed so there is nothing to do
+            return self.reader.refresh()
+
+        d.addCallback(check)
+        d.addCallback(lambda x: self.assertEquals(self.reader.parses, 2))
+        return d
+
+    def testStartNow(self):
+        # The first parse happens in a thread, not in start()
+        self.reader.start(now=True)
+        self.assertEquals(self.reader.snapshot()['host'], [])
+        self.assertEquals(self.reader.parses, 0)
+
+        def check(result):
+            self.reader.stop()
+            self.assertEquals(self.reader.snapshot()['host'],
+                    [{'host_name': "host1"}])
+
+        d = self.reader.refresh()
+        d.addCallback(check)
+        return d
+
+    def testNonBlocking(self):
+        fd = open(self.path, 'w')
+        for i in xrange(60000):
+            fd.write("servicestatus {\n"
+                     "\thost_name=host%d\n"
+                     "\tservice_description=service%d\n"
+                     "\tcurrent_state=0\n"
+                     "\tplugin_output=OK: everything is fine\n"
+                     "\tlong_plugin_output=\n"
+                     "\tperformance_data=time=0.1s;;;0.0\n"
+                     "\tlast_check=1300000000\n"
+                     "\tlast_hard_state=0\n"
+                     "\tlast_hard_state_change=1300000000\n"
+                     "\t}\n\n" % (i // 10, i))
+        fd.close()
+
+        # The reactor should keep running while the thread parses
+        gaps = []
+        last = [time.time()]
+        def beat():
+            now = time.time()
+            gaps.append(now - last[0])
+            last[0] = now
+        ticker = task.LoopingCall(beat)
+        ticker.start(0.01)
+
+        start = time.time()
+        d = self.reader.refresh()
+
+        def check(result):
+            beat()
+            elapsed = last[0] - start
+            ticker.stop()
+            status = self.reader.snapshot()
+            self.assertEquals(len(status['service']), 60000)
+            self.assert_(max(gaps) < elapsed / 2,
+                    "reactor blocked for %.3f of %.3f seconds"
+                    % (max(gaps), elapsed))
+
+        d.addCallback(check)
+        return d
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def mkcache(self, hosts):
+        tmp = "%s.tmp" % self.path
+        fd = open(tmp, 'w')
+        for host in hosts:
+            fd.write("define host {\n    host_name %s\n    }\n" % host)
+        fd.close()
+        os.rename(tmp, self.path)
+
+    def setUp(self):
+        self.dir = self.mktemp()
+        os.mkdir(self.dir)
+        self.path = "%s/objects.cache" % self.dir
+        self.mkcache(["host1"])
+
+    def testSnapshot(self):
+        objects = nagios_objects.load_object_cache(self.path)
+        self.assertEquals(objects['host'], [{'host_name': "host1"}])
+        self.assert_(os.path.exists("%s.nagcat" % self.path))
+
+        def fail(*args):
+            self.fail("The object cache should not be parsed")
+
+        self.patch(nagios_objects, 'ObjectParser', fail)
+        objects = nagios_objects.load_object_cache(self.path,
+                ('host', 'service'))
+        self.assertEquals(objects['host'], [{'host_name': "host1"}])
+        self.assertEquals(objects['service'], [])
+        self.assertEquals(objects.index('host', 'host_name').keys(),
+                ["host1"])
+
+    def testInvalidate(self):
+        nagios_objects.load_object_cache(self.path)
+        self.mkcache(["host1", "host2"])
+        objects = nagios_objects.load_object_cache(self.path)
+        self.assertEquals(len(objects['host']), 2)
+
+    def testBroken(self):
+        open("%s.nagcat" % self.path, 'w').write("garbage")
+        objects = nagios_objects.load_object_cache(self.path)
+        self.assertEquals(objects['host'], [{'host_name': "host1"}])
+
+    def testReadOnly(self):
+        os.chmod(self.dir, 0555)
+        try:
+            objects = nagios_objects.load_object_cache(self.path)
+        finally:
+            os.chmod(self.dir, 0755)
+        self.assertEquals(objects['host'], [{'host_name': "host1"}])
+        self.failIf(os.path.exists("%s.nagcat" % self.path))
+
+    if os.getuid() == 0:
+        testReadOnly.skip = "root can write anywhere"
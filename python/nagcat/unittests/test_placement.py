@@ -0,0 +1,73 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.trial import unittest
+from nagcat import placement
+
+class DummyGroup(object):
+
+    def __init__(self, repeat, host=None, deps=1):
+        self.repeat = repeat
+        self.host = host
+        self._deps = set(object() for i in range(deps))
+
+    def getAllDependencies(self):
+        return self._deps
+
+class PlacementTestCase(unittest.TestCase):
+
+    def testRange(self):
+        p = placement.Placement()
+        groups = [DummyGroup(r) for r in (30, 60, 300, 3600, 7200)]
+        offsets = p.place(groups)
+        self.assertEquals(len(offsets), len(groups))
+        for group in groups:
+            self.assert_(0 <= offsets[group] < group.repeat)
+
+    def testFlat(self):
+        # 60 one second groups in a 60 second repeat should never overlap
+        p = placement.Placement(candidates=60)
+        groups = [DummyGroup(60) for i in range(60)]
+        offsets = p.place(groups)
+        self.assertEquals(sorted(offsets.values()), range(60))
+
+    def testWeight(self):
+        # The heavy group should not share a slot with anything
+        p = placement.Placement(candidates=10)
+        heavy = DummyGroup(10, deps=20)
+        light = [DummyGroup(10) for i in range(12)]
+        offsets = p.place([heavy] + light)
+        others = [offsets[g] for g in light]
+        self.assertNotIn(offsets[heavy], others)
+
+    def testDuration(self):
+        p = placement.Placement(candidates=60)
+        slow = DummyGroup(60)
+        fast = [DummyGroup(60) for i in range(30)]
+        p.record(slow, 0, 30)
+        offsets = p.place([slow] + fast)
+        # The slow group fills 30 buckets, the rest fill the other half
+        busy = set((offsets[slow] + i) % 60 for i in range(30))
+        for group in fast:
+            self.assertNotIn(offsets[group], busy)
+
+    def testRespread(self):
+        p = placement.Placement()
+        group = DummyGroup(60)
+        p.record(group, 1000, 1)
+        offsets = p.respread([group])
+        shift = p.shift(group)
+        self.assert_(0 <= shift < 60)
+        self.assertEquals((1000 + shift) % 60, offsets[group])
+        self.assertEquals(p.shift(group), 0)
@@ -0,0 +1,132 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+from twisted.trial import unittest
+from twisted.internet import defer
+from coil.struct import Struct
+from nagcat import errors, resolver, runnable
+
+class DummyResolver(resolver.Resolver):
+    """Resolve names from a dict instead of DNS"""
+
+    def __init__(self, table, **kwargs):
+        super(DummyResolver, self).__init__(**kwargs)
+        self.table = table
+        self.calls = []
+
+    def _lookup(self, name):
+        self.calls.append(name)
+        try:
+            return self.table[name]
+        except KeyError:
+            raise socket.gaierror(-2, "Name or service not known")
+
+    def _lookup_async(self, name):
+        return defer.maybeDeferred(self._lookup, name)
+
+class ResolverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.table = {'a': "10.0.0.1", 'b': "10.0.0.2"}
+        self.resolver = DummyResolver(self.table)
+
+    def testAddress(self):
+        self.assertTrue(resolver.is_address("127.0.0.1"))
+        self.assertTrue(resolver.is_address("::1"))
+        self.assertFalse(resolver.is_address("localhost"))
+        self.assertFalse(resolver.is_address(None))
+        self.assertEquals(self.resolver.lookup("10.1.2.3"), "10.1.2.3")
+        self.assertEquals(self.resolver.calls, [])
+
+    def testCache(self):
+        self.assertEquals(self.resolver.lookup("a"), "10.0.0.1")
+        self.assertEquals(self.resolver.lookup("a"), "10.0.0.1")
+        self.assertEquals(self.resolver.calls, ["a"])
+        self.assertRaises(socket.error, self.resolver.lookup, "c")
+
+    def testExpire(self):
+        self.resolver.ttl = -1
+        self.resolver.lookup("a")
+        self.resolver.lookup("a")
+        self.assertEquals(self.resolver.calls, ["a", "a"])
+
+    def testMany(self):
+        failed = self.resolver.resolve_many(["a", "b", "c", "a"])
+        self.assertEquals(failed.keys(), ["c"])
+        self.assertEquals(sorted(self.resolver.calls), ["a", "b", "c"])
+        self.assertEquals(self.resolver.cached("b"), "10.0.0.2")
+        self.resolver.lookup("b")
+        self.assertEquals(len(self.resolver.calls), 3)
+
+    def testManyStartup(self):
+        # Startup may take longer than the TTL
+        self.resolver.ttl = -1
+        self.resolver.resolve_many(["a", "b"])
+        self.resolver.lookup("a")
+        self.assertEquals(len(self.resolver.calls), 2)
+
+        # Once running they expire as usual
+        self.resolver.start(60)
+        self.resolver.stop()
+        self.assertEquals(self.resolver.cached("a"), None)
+        self.resolver.lookup("a")
+        self.assertEquals(len(self.resolver.calls), 3)
+
+    def testRefresh(self):
+        changed = []
+        self.resolver.lookup("a")
+        self.resolver.watch("a", changed.append)
+        self.resolver.refresh()
+        self.assertEquals(changed, [])
+
+        self.table['a'] = "10.0.0.3"
+        self.resolver.refresh()
+        self.assertEquals(changed, ["10.0.0.3"])
+        self.assertEquals(self.resolver.cached("a"), "10.0.0.3")
+
+        # Failed lookups keep the old address
+        del self.table['a']
+        self.resolver.refresh()
+        self.assertEquals(changed, ["10.0.0.3"])
+        self.assertEquals(self.resolver.cached("a"), "10.0.0.3")
+
+class RunnableAddrTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.default = resolver.default
+        resolver.default = DummyResolver({'a': "10.0.0.1"})
+
+    def tearDown(self):
+        resolver.default = self.default
+
+    def testHost(self):
+        r = runnable.Runnable(Struct({'host': "a"}))
+        self.assertEquals(r.addr, "10.0.0.1")
+        self.assertEquals(r.addr_name, "a")
+        r.update_addr("10.0.0.2")
+        self.assertEquals(r.addr, "10.0.0.2")
+
+    def testAddr(self):
+        r = runnable.Runnable(Struct({'host': "x", 'addr': "127.0.0.1"}))
+        self.assertEquals(r.addr, "127.0.0.1")
+        self.assertEquals(r.addr_name, None)
+
+        r = runnable.Runnable(Struct({'host': "x", 'addr': "a"}))
+        self.assertEquals(r.addr, "10.0.0.1")
+        self.assertEquals(r.addr_name, "a")
+
+    def testFailed(self):
+        self.assertRaises(errors.InitError, runnable.Runnable,
+                Struct({'host': "x"}))
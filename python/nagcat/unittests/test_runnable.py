@@ -12,9 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
+
 from twisted.trial import unittest
+from twisted.internet import reactor, task
 from coil.struct import Struct
-from nagcat import runnable
+from nagcat import runnable, timing
+
+class Slow(runnable.Runnable):
+    __slots__ = ()
+    type = "Slow"
+
+    def _start(self):
+        return task.deferLater(reactor, 0.1, lambda: None)
 
 class RunnableTestCase(unittest.TestCase):
 
@@ -26,3 +36,70 @@ class RunnableTestCase(unittest.TestCase):
 
     def endSingle(self, ignore, r):
         self.assertIdentical(r.result, None)
+
+    def testCompact(self):
+        a = runnable.Runnable(Struct({'repeat': None}))
+        b = runnable.Runnable(Struct({'repeat': None}))
+        self.assertFalse(hasattr(a, '__dict__'))
+        self.assertRaises(AttributeError, setattr, a, 'bogus', 1)
+
+        # Empty containers are shared until something is added
+        self.assertIdentical(a.getDependencies(), b.getDependencies())
+        a.addDependency(b)
+        self.assertEquals(a.getDependencies(), set([b]))
+        self.assertEquals(b.getDependencies(), set())
+        self.assertRaises(KeyError, b.delDependency, a)
+        a.delDependency(b)
+        self.assertRaises(KeyError, a.delDependency, b)
+
+        self.assertEquals(a.getSaved(), {})
+        self.assertIdentical(a._saved, None)
+        a.saved['x'] = 1
+        self.assertEquals(a.getSaved(), {'x': 1})
+        a.clearSaved()
+        self.assertEquals(a.getSaved(), {})
+
+        self.assert_(runnable.sizeof(a) > runnable.sizeof(b))
+
+    def testMaxAge(self):
+        r = runnable.Runnable(Struct({'repeat': 60}))
+        r.lastrun = time.time() - 30
+        r.start()
+        self.assertIdentical(r.deferred, None)
+        r.start(max_age=45)
+        self.assertIdentical(r.deferred, None)
+        d = r.start(max_age=10)
+        self.assertIdentical(r.deferred, d)
+        return d
+
+    def testTiming(self):
+        parent = runnable.Runnable(Struct({'repeat': 60}))
+        child = Slow(Struct({'repeat': 60}))
+        parent.addDependency(child)
+        self.assertIdentical(child.getTiming(create=False), None)
+
+        def check(ignore):
+            record = child.getTiming()
+            self.assertEquals(record[timing.RUNS], 1)
+            self.assert_(record[timing.LAST] >= 0.09)
+            self.assert_(record[timing.WAIT] < 0.09)
+
+            record = parent.getTiming()
+            self.assert_(record[timing.WAIT] >= 0.09)
+            self.assert_(record[timing.LAST] < 0.09)
+
+            # Within the repeat interval so this is a skip
+            child.start()
+            self.assertEquals(child.getTiming()[timing.SKIPS], 1)
+
+            queries, hosts = timing.slowest([parent, child])
+            self.assertIdentical(queries[0][0], child)
+            self.assertEquals(hosts[0][1]['runs'], 2)
+
+            data = timing.default.stats()['Slow']
+            self.assert_(data['runs'] >= 1)
+            self.assert_(data['skips'] >= 1)
+
+        d = parent.start()
+        d.addCallback(check)
+        return d
@@ -66,3 +66,31 @@ class SchedulerTestCase(unittest.TestCase):
                   'Group': {'count': 2},
                   'Query': {'count': 0}}
         self.assertEquals(stats['tasks'], expect)
+
+    def testMergeGrouping(self):
+        s = simple.NagcatDummy()
+        r1 = runnable.Runnable(Struct({'repeat': 60}))
+        r2 = runnable.Runnable(Struct({'repeat': 60}))
+        r3 = runnable.Runnable(Struct({'repeat': 60}))
+        r3.addDependency(r2)
+        t1 = runnable.Runnable(Struct({'repeat': 60}))
+        t1.addDependency(r1)
+        s.register(t1)
+        t2 = runnable.Runnable(Struct({'repeat': 60}))
+        t2.addDependency(r2)
+        s.register(t2)
+        # t3 shares a dependency with both t1 and t2 (indirectly
+        # through r3 for t2) so all three end up in a single group.
+        t3 = runnable.Runnable(Struct({'repeat': 60}))
+        t3.addDependency(r1)
+        t3.addDependency(r3)
+        s.register(t3)
+        stats = s.stats()
+        expect = {'count': 7,
+                  'Test': {'count': 0},
+                  'Runnable': {'count': 6},
+                  'Group': {'count': 1},
+                  'Query': {'count': 0}}
+        self.assertEquals(stats['tasks'], expect)
+        group = s._registered.pop()
+        self.assertEquals(group.getDependencies(), set([t1, t2, t3]))
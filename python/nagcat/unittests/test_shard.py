@@ -0,0 +1,111 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.trial import unittest
+from twisted.protocols import loopback
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from nagcat import monitor_api, nagios_api, shard
+
+class DummyWorker(shard.Worker):
+
+    def lost(self, reason):
+        pass
+
+class DummyCoordinator(object):
+
+    def __init__(self):
+        self.commander = self
+        self.commands = []
+        self.updates = []
+
+    def cmdlist(self, cmd_time, cmd_list, force=False):
+        self.commands.append((cmd_time, cmd_list))
+
+    def update_trend(self, filename, timestamp, values):
+        self.updates.append((filename, timestamp, values))
+
+class BigPage(monitor_api.XMLPage):
+
+    def xml(self, request):
+        root = etree.Element("Big")
+        for i in xrange(20000):
+            etree.SubElement(root, "Item").text = str(i)
+        return root
+
+class ShardTestCase(unittest.TestCase):
+
+    def testShardOf(self):
+        counts = [0] * 4
+        for i in xrange(1000):
+            index = shard.shard_of("10.0.%d.%d" % (i // 256, i % 256), 4)
+            self.assertEquals(index, shard.shard_of(
+                    "10.0.%d.%d" % (i // 256, i % 256), 4))
+            counts[index] += 1
+        for count in counts:
+            self.assert_(150 < count < 350, counts)
+
+    def testOwns(self):
+        workers = [shard.Worker(i, 3) for i in xrange(3)]
+        for host in ("a", "b", "c", "d"):
+            self.assertEquals(
+                    sum(1 for w in workers if w.owns(host)), 1)
+
+class ConnectionTestCase(unittest.TestCase):
+
+    if etree is None:
+        skip = "lxml is not installed"
+
+    def setUp(self):
+        self.worker = DummyWorker(0, 1)
+        self.worker.addPage("big", BigPage())
+        self.coordinator = DummyCoordinator()
+        self.proto = shard.CoordinatorProtocol(self.coordinator)
+        self.done = loopback.loopbackAsync(self.worker._proto, self.proto)
+
+    def tearDown(self):
+        self.proto.transport.loseConnection()
+        return self.done
+
+    def testMessages(self):
+        limit = nagios_api.NagiosCommander.MAX_EXTERNAL_COMMAND_LENGTH
+        commander = self.worker.commander()
+        commander.command(10, 'PROCESS_SERVICE_CHECK_RESULT',
+                "host", "service", 2, "x" * 70000)
+        rrdapi = shard.WorkerRRDAPI(self.worker._proto, local=object())
+        rrdapi.update("a.rrd", 20, [0.1, 2, "U"])
+
+        # Replies come back in order so this is after the others
+        deferred = shard.fetch_page(self.proto, "big")
+
+        def check(data):
+            self.assertEquals(len(self.coordinator.commands), 1)
+            cmd_time, cmd_list = self.coordinator.commands[0]
+            self.assertEquals(cmd_time, 10)
+            self.assertEquals(cmd_list[0][:4], [
+                'PROCESS_SERVICE_CHECK_RESULT', "host", "service", "2"])
+            self.assertEquals(len(cmd_list[0][4]), limit)
+            self.assertEquals(self.coordinator.updates,
+                    [("a.rrd", 20.0, ["0.1", "2", "U"])])
+
+            self.assert_(len(data) > shard.PAGE_CHUNK)
+            self.assertEquals(data, self.worker.render("big", False))
+            self.assertEquals(len(etree.fromstring(data)), 20000)
+
+        deferred.addCallback(check)
+        return deferred
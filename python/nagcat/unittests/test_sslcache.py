@@ -0,0 +1,104 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.trial import unittest
+from twisted.internet import reactor
+from coil.struct import Struct
+from nagcat.unittests import dummy_server
+from nagcat import keepalive, simple, sslcache
+
+class ContextCacheTestCase(unittest.TestCase):
+
+    if sslcache.SSL is None:
+        skip = "SSL not supported!"
+
+    def setUp(self):
+        self.old_default = sslcache.default
+        sslcache.default = sslcache.ContextCache()
+        self.nagcat = simple.NagcatDummy()
+        context = dummy_server.ssl_context("localhost-a.key",
+                                           "localhost-a.cert")
+        self.server = reactor.listenSSL(0, dummy_server.HTTP(), context)
+        self.config = {'type': "https", 'host': "localhost",
+                       'port': self.server.getHost().port}
+
+    def tearDown(self):
+        sslcache.default = self.old_default
+        return self.server.loseConnection()
+
+    def query(self, **kwargs):
+        config = self.config.copy()
+        config.update(kwargs)
+        return self.nagcat.new_query(Struct(config))
+
+    def testShared(self):
+        cacert = dummy_server.ssl_path("ca.cert")
+        q1 = self.query(path="/")
+        q2 = self.query(path="/other")
+        q3 = self.query(path="/", ssl_cacert=cacert)
+        q4 = self.query(path="/other", ssl_cacert=cacert)
+        self.assertIdentical(q1.context, q2.context)
+        self.assertIdentical(q3.context, q4.context)
+        self.assertNotIdentical(q1.context, q3.context)
+        self.assertEquals(sslcache.default.stats()['contexts'], 2)
+
+    def testKeyWithoutCert(self):
+        # Like before the cache, a key alone is ignored
+        key = dummy_server.ssl_path("localhost-b.key")
+        q1 = self.query(path="/")
+        q2 = self.query(path="/other", ssl_key=key)
+        self.assertIdentical(q1.context, q2.context)
+
+    def testResume(self):
+        q1 = self.query(path="/")
+        q2 = self.query(path="/other")
+
+        def check(result):
+            self.assertEquals(result, "other\n")
+            stats = sslcache.default.stats()
+            self.assertEquals(stats['servers'], 1)
+            self.assertEquals(stats['full'], 1)
+            self.assertEquals(stats['offered'], 1)
+
+            lib = getattr(sslcache.SSL, '_lib', None)
+            if hasattr(lib, 'SSL_session_reused'):
+                connection = q2.context._servers.values()[0][0]
+                self.assertTrue(lib.SSL_session_reused(connection._ssl))
+
+        d = q1.start()
+        d.addCallback(lambda x: q2.start())
+        d.addCallback(lambda x: q2.result)
+        d.addCallback(check)
+        return d
+
+    def testKeepAlive(self):
+        if not keepalive.available():
+            raise unittest.SkipTest("keepalive is not available")
+
+        q1 = self.query(path="/", keepalive=True)
+        q2 = self.query(path="/other", keepalive=True)
+
+        def check(result):
+            self.assertEquals(result, "other\n")
+            stats = keepalive.default.stats()
+            self.assertEquals(stats['pools'], 1)
+            self.assertEquals(stats['opened'], 1)
+
+        d = q1.start()
+        d.addCallback(lambda x: q2.start())
+        d.addCallback(lambda x: q2.result)
+        d.addCallback(check)
+        d.addBoth(lambda x: keepalive.default.close().addCallback(
+                            lambda y: x))
+        return d
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
 from twisted.trial import unittest
 from nagcat import simple, test
 from coil.struct import Struct
@@ -59,3 +60,40 @@ class TestTestCase(unittest.TestCase):
     def endCompound(self, result, t):
         self.assertEquals(result, None)
         self.assertEquals(t.result['output'], "3")
+
+    def testWarningTimeLimit(self):
+        config = Struct({
+                'host': "localhost",
+                'description': "svc",
+                'warning_time_limit': 60,
+                'warning': "> 1",
+                'query': {
+                    'type': "noop",
+                    'data': "5",
+                },
+            })
+
+        nagcat = StatusDummy()
+        nagcat.status['service'].append({
+                'host_name': "localhost",
+                'service_description': "svc",
+                'last_hard_state': "1",
+                'last_hard_state_change': str(int(time.time() - 120)),
+            })
+
+        reports = []
+        t = test.Test(nagcat, config)
+        t.addReportCallback(reports.append)
+        d = t.start()
+        d.addBoth(lambda x: self.assertEquals(
+                [r['state'] for r in reports], ["CRITICAL"]))
+        return d
+
+class StatusDummy(simple.NagcatDummy):
+
+    def __init__(self):
+        simple.NagcatDummy.__init__(self)
+        self.status = simple.ObjectDummy()
+
+    def nagios_status(self):
+        return self.status
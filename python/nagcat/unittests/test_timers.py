@@ -0,0 +1,87 @@
+# Copyright 2011 Google, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+from twisted.trial import unittest
+from twisted.internet import task
+from nagcat import timers
+
+class TimerWheelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = timers.TimerWheel(resolution=1.0, bits=2, levels=2,
+                                       clock=self.clock)
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append((name, self.clock.seconds()))
+
+    def testSimple(self):
+        self.wheel.callLater(2, self.fire, "a")
+        self.wheel.callLater(0.5, self.fire, "b")
+        self.assertEquals(self.wheel.pending(), 2)
+        self.clock.advance(1)
+        self.assertEquals(self.fired, [("b", 1)])
+        self.clock.advance(1)
+        self.assertEquals(self.fired, [("b", 1), ("a", 2)])
+        self.assertEquals(self.wheel.pending(), 0)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testCancel(self):
+        call = self.wheel.callLater(3, self.fire, "a")
+        self.wheel.callLater(4, self.fire, "b")
+        self.assertTrue(call.active())
+        call.cancel()
+        self.assertFalse(call.active())
+        self.clock.pump([1]*5)
+        self.assertEquals(self.fired, [("b", 4)])
+
+    def testCancelAll(self):
+        call = self.wheel.callLater(3, self.fire, "a")
+        call.cancel()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testCascade(self):
+        # With 4 slots and 2 levels the wheel covers 16 ticks directly,
+        # anything further out gets parked in the top level.
+        delays = range(1, 40)
+        random.shuffle(delays)
+        for delay in delays:
+            self.wheel.callLater(delay, self.fire, delay)
+        self.clock.pump([1]*40)
+        self.assertEquals(self.fired, [(d, d) for d in range(1, 40)])
+
+    def testReschedule(self):
+        def again(count):
+            self.fire(count)
+            if count:
+                self.wheel.callLater(5, again, count - 1)
+        self.wheel.callLater(5, again, 3)
+        self.clock.pump([1]*30)
+        self.assertEquals(self.fired, [(3, 5), (2, 10), (1, 15), (0, 20)])
+
+    def testLate(self):
+        # If the reactor is stalled calls fire late but still in order
+        self.wheel.callLater(1, self.fire, "a")
+        self.wheel.callLater(2, self.fire, "b")
+        self.clock.advance(5)
+        self.assertEquals(self.fired, [("a", 5), ("b", 5)])
+
+    def testDeferLater(self):
+        d = self.wheel.deferLater(2, lambda: "done")
+        d.addCallback(self.assertEquals, "done")
+        self.clock.pump([1, 1])
+        self.assertTrue(d.called)
+        return d